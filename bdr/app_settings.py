@@ -24,10 +24,71 @@ BDR_UNCOMPRESS_BIN
 
         ``BDR_ARCHIVE_READERS = ['bdr.utils.archives.CompressArchive']``
 
+BDR_GZIP_THREADS
+    The number of threads used to decompress a BGZF file, the blocked gzip
+    format used for sequence alignments and variant calls, by the
+    :py:class:`bdr.utils.archives.GzipArchive` class. Other gzip files are
+    always decompressed by a single thread. The default is 1.
+
 BDR_REMOTE_TRANSPORTS
     A dictionary that maps URL scheme names to qualified class names. These
     classes must extend the `Transport` class defined in the
     `bdr.utils.transports` module.
+
+BDR_LOCAL_ROOTS
+    A list of local directories from which ``file`` URLs may be read by the
+    :py:class:`bdr.utils.transports.LocalTransport` class. A source naming any
+    other path cannot be read. The default is empty, so local sources are
+    disabled until this setting is configured.
+
+BDR_SPOOL_DIR
+    The path to the directory in which remote resources are written as they
+    are downloaded. Partial downloads are kept here so that a failed transfer
+    can be resumed by the next update. The default is the ``bdr-spool``
+    subdirectory of the system's temporary directory.
+
+BDR_TRANSPORT_TIMEOUT
+    The time, in seconds, to wait when connecting to, or reading from, a remote
+    source before the attempt fails. The default is 30 seconds.
+
+BDR_BUFFERED_CODEC_LIMIT
+    The size, in bytes, of the largest file that will be encoded by an
+    in-process codec such as :py:class:`bdr.utils.deltas.BsdiffCodec`. Larger
+    files are encoded with xdelta3 instead. The default is 1 MiB; if zero,
+    there is no limit.
+
+BDR_DELTA_CODEC
+    The qualified class name of the codec used to encode revisions. The class
+    must extend the `Codec` class defined in the `bdr.utils.deltas` module.
+    Revisions are always decoded by the codec that encoded them, so this
+    setting can be changed at any time. The default is
+    ``bdr.utils.deltas.XDeltaCodec``.
+
+BDR_XDELTA_SOURCE_WINDOW
+    The size, in bytes, of the window that xdelta3 holds in memory when
+    decoding against a base that is streamed rather than read from disk. The
+    default is 64 MiB.
+
+BDR_KEYFRAME_INTERVAL
+    The maximum number of decoding steps required to read any revision of a
+    file. Every time a chain of delta-encoded revisions would exceed this
+    length, a self-contained revision (a keyframe) is retained instead. If
+    zero (the default), revisions are only stored self-contained when they are
+    the latest revision of a file.
+
+BDR_KEYFRAME_THRESHOLD
+    The maximum combined size, in bytes, of the delta-encoded revisions that
+    follow a keyframe. When exceeded, a new keyframe is retained. If zero (the
+    default), the size of deltas is not considered.
+
+BDR_REVISION_CACHE_DIR
+    The path to the directory in which decoded revisions are cached. The
+    default is the ``cache`` subdirectory of ``MEDIA_ROOT``.
+
+BDR_REVISION_CACHE_SIZE
+    The maximum combined size, in bytes, of the decoded revisions held in the
+    cache. The least recently used revisions are discarded when this limit is
+    exceeded. If zero (the default), decoded revisions are not cached.
 """
 
 from django.conf import settings
@@ -55,13 +116,36 @@ __license__ = """
 
 ARCHIVE_READERS = getattr(settings, 'BDR_ARCHIVE_READERS', [])
 ARCHIVE_READERS.extend(['bdr.utils.archives.TarArchive', 'bdr.utils.archives.ZipArchive',
-                        'bdr.utils.archives.GzipArchive', 'bdr.utils.archives.MockArchive'])
+                        'bdr.utils.archives.GzipArchive', 'bdr.utils.archives.Bzip2Archive',
+                        'bdr.utils.archives.XzArchive', 'bdr.utils.archives.ZstdArchive',
+                        'bdr.utils.archives.MockArchive'])
 
 UNCOMPRESS_BIN = getattr(settings, 'BDR_UNCOMPRESS_BIN', None)
+GZIP_THREADS = getattr(settings, 'BDR_GZIP_THREADS', 1)
 
 REMOTE_TRANSPORTS = getattr(settings, 'BDR_REMOTE_TRANSPORTS', {})
-REMOTE_TRANSPORTS.update({'ftp': 'bdr.utils.transports.FtpTransport',
+REMOTE_TRANSPORTS.update({'file': 'bdr.utils.transports.LocalTransport',
+                          'ftp': 'bdr.utils.transports.FtpTransport',
                           'http': 'bdr.utils.transports.HttpTransport',
                           'https': 'bdr.utils.transports.HttpTransport'})
 
+LOCAL_ROOTS = getattr(settings, 'BDR_LOCAL_ROOTS', [])
+
+SPOOL_DIR = getattr(settings, 'BDR_SPOOL_DIR', None)
+TRANSPORT_TIMEOUT = getattr(settings, 'BDR_TRANSPORT_TIMEOUT', 30)
+
 XDELTA_BIN = getattr(settings, 'BDR_XDELTA_BIN')
+
+DELTA_CODEC = getattr(settings, 'BDR_DELTA_CODEC', 'bdr.utils.deltas.XDeltaCodec')
+
+BUFFERED_CODEC_LIMIT = getattr(settings, 'BDR_BUFFERED_CODEC_LIMIT', 1024 * 1024)
+
+XDELTA_SOURCE_WINDOW = getattr(settings, 'BDR_XDELTA_SOURCE_WINDOW', 64 * 1024 * 1024)
+
+KEYFRAME_INTERVAL = getattr(settings, 'BDR_KEYFRAME_INTERVAL', 0)
+
+KEYFRAME_THRESHOLD = getattr(settings, 'BDR_KEYFRAME_THRESHOLD', 0)
+
+REVISION_CACHE_DIR = getattr(settings, 'BDR_REVISION_CACHE_DIR', None)
+
+REVISION_CACHE_SIZE = getattr(settings, 'BDR_REVISION_CACHE_SIZE', 0)
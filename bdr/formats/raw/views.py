@@ -2,6 +2,7 @@
 This module defines classes for displaying raw type formats.
 """
 
+from wsgiref.util import FileWrapper
 import os.path
 
 from django.http import StreamingHttpResponse
@@ -47,7 +48,7 @@ class RawRevisionExportView(SingleObjectMixin, View):
     """
     This view streams a compressed file to the client.
 
-    File compression is performed on the fly.
+    Both decoding and file compression are performed on the fly.
 
     This class overrides the get method of the Django View class. For more
     information see
@@ -56,6 +57,8 @@ class RawRevisionExportView(SingleObjectMixin, View):
 
     model = Revision
     pk_url_kwarg = "rpk"
+    chunk_size = 64 * 1024
+    """The number of bytes sent to the client at a time."""
 
     @method_decorator(gzip_page)
     def get(self, *args, **kwargs):
@@ -67,6 +70,7 @@ class RawRevisionExportView(SingleObjectMixin, View):
         :param kwargs: The keyword argument extracted from the route.
         """
         revision = self.get_object()
-        response = StreamingHttpResponse(revision.data.chunks(), content_type="application/octet-stream")
+        stream = revision.data.storage.open_stream(revision.data.name)
+        response = StreamingHttpResponse(FileWrapper(stream, self.chunk_size), content_type="application/octet-stream")
         response["Content-Disposition"] = "attachment; filename={:s}".format(os.path.basename(revision.file.name))
         return response
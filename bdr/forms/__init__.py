@@ -17,7 +17,7 @@ This following classes are exported:
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse_lazy
 from django.forms import CharField, FileField, ModelChoiceField
-from django.forms import FileInput, HiddenInput, Textarea, TextInput
+from django.forms import FileInput, HiddenInput, Textarea, TextInput, URLInput
 from django.forms import Form, ModelForm
 
 from .fields import SelectableCharField
@@ -134,7 +134,10 @@ class SourceForm(ModelForm):
         model = Source
         fields = "__all__"
         widgets = {
-            "period": ScaledNumberInput([(1, "hours"), (24, "days"), (168, "weeks")], default=1)
+            "url": URLInput(),
+            "period": ScaledNumberInput([(1, "hours"), (24, "days"), (168, "weeks")], default=1),
+            "min_segment_size": ScaledNumberInput([(1, "bytes"), (1024, "KiB"), (1024 * 1024, "MiB")],
+                                                  default=1024 * 1024)
         }
 
 
@@ -0,0 +1,142 @@
+"""
+Specifies a command for comparing the performance of the delta codecs
+available to the repository.
+"""
+
+from optparse import make_option
+from tempfile import NamedTemporaryFile
+import importlib
+import os
+import random
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...utils.deltas import Codec
+
+__all__ = ["Command"]
+__author__ = "Michael Winter (mail@michael-winter.me.uk)"
+__license__ = """
+    Biological Dataset Repository: data archival and retrieval.
+    Copyright (C) 2015  Michael Winter
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+    """
+
+_DEFAULT_CODECS = "bdr.utils.deltas.XDeltaCodec,bdr.utils.deltas.BsdiffCodec"
+_DEFAULT_SIZES = "4096,65536,1048576,16777216"
+
+
+class Command(BaseCommand):
+    """
+    Times the encoding and decoding of synthetic revisions of various sizes
+    with each of the given codecs.
+
+    Each pair of revisions differs in roughly one line in a hundred, which is
+    typical of updates to flat-file databases.
+    """
+
+    help = ("Compares the time taken by delta codecs to encode and decode revisions"
+            " of various sizes.")
+    """A short description of the command to be printed in help messages."""
+    option_list = BaseCommand.option_list + (
+        make_option("--codecs", default=_DEFAULT_CODECS,
+                    help="A comma-separated list of qualified codec class names [default: %default]."),
+        make_option("--sizes", default=_DEFAULT_SIZES,
+                    help="A comma-separated list of file sizes in bytes [default: %default]."),
+        make_option("--repeat", type="int", default=5,
+                    help="The number of times each operation is timed [default: %default]."),
+    )
+    """The options accepted by this command."""
+
+    def handle(self, *args, **options):
+        """
+        Encode and decode revisions of each size with each codec, writing a
+        table of the best times to standard output.
+
+        :param options: Command-line arguments for this command.
+        :type options: dict of str
+        """
+        codecs = [self._load(name) for name in options["codecs"].split(",")]
+        sizes = [int(size) for size in options["sizes"].split(",")]
+        repeat = options["repeat"]
+
+        self.stdout.write("{0:<10s} {1:>10s} {2:>12s} {3:>12s} {4:>12s} {5:>12s}".format(
+            "codec", "size", "delta size", "compress", "encode", "decode"))
+        for size in sizes:
+            base, target = self._generate(size)
+            try:
+                for codec in codecs:
+                    name, measurements = self._measure(codec, base, target, repeat)
+                    self.stdout.write("{0:<10s} {1:>10d} {2:>12d} {3:>11.2f}ms {4:>11.2f}ms {5:>11.2f}ms".format(
+                        name, size, *measurements))
+            finally:
+                os.unlink(base)
+                os.unlink(target)
+
+    @staticmethod
+    def _load(name):
+        namespaces = name.strip().split(".")
+        try:
+            module = importlib.import_module(".".join(namespaces[:-1]))
+            return getattr(module, namespaces[-1])()
+        except (ImportError, AttributeError, RuntimeError) as error:
+            raise CommandError("Cannot load codec {0:s}: {1!s}".format(name, error))
+
+    @staticmethod
+    def _generate(size):
+        """
+        Write a pair of related files of approximately the given size.
+
+        :return: The paths to the base and target files.
+        :rtype: (str, str)
+        """
+        generator = random.Random(size)
+        with NamedTemporaryFile(delete=False) as base, NamedTemporaryFile(delete=False) as target:
+            written = 0
+            while written < size:
+                line = "{0:d}\t{1:08x}\t{2:s}\n".format(written, generator.getrandbits(32),
+                                                        "ACGT"[generator.randrange(4)] * generator.randrange(8, 64))
+                base.write(line)
+                target.write(line if generator.random() >= 0.01 else line.upper()[::-1])
+                written += len(line)
+        return base.name, target.name
+
+    @staticmethod
+    def _measure(codec, base, target, repeat):
+        """
+        Return the name of the codec that produced the delta, together with the
+        size of the delta and the best times, in milliseconds, taken to
+        compress ``target`` and to encode and decode it against ``base``.
+
+        The codec named may differ from the one given when that codec delegates
+        large files to another.
+
+        :rtype: (str, (int, float, float, float))
+        """
+        encoded = NamedTemporaryFile(delete=False)
+        decoded = NamedTemporaryFile(delete=False)
+        encoded.close()
+        decoded.close()
+        try:
+            compress = min(timeit.repeat(lambda: codec.encode(target, encoded.name), repeat=repeat, number=1))
+            encode = min(timeit.repeat(lambda: codec.encode(target, encoded.name, base), repeat=repeat, number=1))
+            decode = min(timeit.repeat(lambda: codec.decode(encoded.name, decoded.name, base), repeat=repeat,
+                                       number=1))
+            return (Codec.for_file(encoded.name).name,
+                    (os.path.getsize(encoded.name), compress * 1000, encode * 1000, decode * 1000))
+        finally:
+            os.unlink(encoded.name)
+            os.unlink(decoded.name)
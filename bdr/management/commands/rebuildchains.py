@@ -0,0 +1,70 @@
+"""
+Specifies a command for recoding the revisions of each file in the repository
+so that they conform to the current keyframe settings.
+"""
+
+from subprocess import CalledProcessError
+
+from django.core.management.base import NoArgsCommand
+from django.utils import log
+
+from ...models import File
+
+__all__ = ["Command"]
+__author__ = "Michael Winter (mail@michael-winter.me.uk)"
+__license__ = """
+    Biological Dataset Repository: data archival and retrieval.
+    Copyright (C) 2015  Michael Winter
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+    """
+
+
+# noinspection PyAbstractClass
+# The handle method is already implemented by the base class.
+class Command(NoArgsCommand):
+    """
+    Recodes the revisions of each file in the repository, adding or removing
+    keyframes according to the ``BDR_KEYFRAME_INTERVAL`` and
+    ``BDR_KEYFRAME_THRESHOLD`` settings. Chains that lack a manifest are given
+    one.
+    """
+
+    help = ("Recodes the stored revisions of every file in the repository so that"
+            " keyframes are placed according to the current settings.")
+    """A short description of the command to be printed in help messages."""
+
+    def handle_noargs(self, **options):
+        """
+        Iterate over files in the repository, rebuilding the delta chain that
+        holds their revisions.
+
+        :param options: Command-line arguments for this command.
+        :type options: dict of str
+        """
+        logger = log.getLogger('bdr.management.commands.rebuildchains')
+        verbosity = int(options.get('verbosity', 1))
+        for datafile in File.objects.select_related('dataset'):
+            revision = datafile.revisions.order_by('number').last()
+            if revision is None:
+                continue
+            try:
+                keyframes = revision.data.storage.rebuild(revision.data.name)
+            except (CalledProcessError, EnvironmentError):
+                logger.exception('An error occurred while rebuilding: file %s in dataset %s',
+                                 datafile, datafile.dataset)
+            else:
+                if verbosity > 1:
+                    self.stdout.write('{0}/{1}: {2:d} keyframe(s)'.format(datafile.dataset, datafile, keyframes))
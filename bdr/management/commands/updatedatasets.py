@@ -3,10 +3,19 @@ Specifies a command for updating datasets in the repository that are
 out-of-date with respect to their remote data source.
 """
 
+from optparse import make_option
+from urlparse import urlsplit
+import Queue
+import sys
+import threading
+import time
+
 from django.core.management.base import NoArgsCommand
+from django.db import connection
 from django.utils import log
 
-from ...models import Dataset
+from ...models import Source
+from ...utils.transports import ConnectionPool, TransportError
 
 __all__ = ["Command"]
 __author__ = "Michael Winter (mail@michael-winter.me.uk)"
@@ -36,26 +45,164 @@ class Command(NoArgsCommand):
     """
     Updates datasets in the repository that are out-of-date with respect to
     their remote data source.
+
+    Sources are updated in two phases. First, every source that is due is
+    asked concurrently for its metadata to determine whether it has changed.
+    Only the changed sources are then downloaded. Either phase queries no more
+    than a fixed number of sources on the same host at once, and waits no
+    longer than the TRANSPORT_TIMEOUT setting for any one server.
+
+    Each source is handled independently. With more than one worker, sources
+    are downloaded concurrently. Sources of the same dataset are updated in
+    turn, as they may supply revisions of the same files.
+
+    Connections to each host are pooled and reused for the duration of the
+    command.
     """
 
     help = ("Queries the source associated with each dataset in the"
             " repository, updating any out-of-date files encountered.")
     """A short description of the command to be printed in help messages."""
+    option_list = NoArgsCommand.option_list + (
+        make_option("--workers", type="int", default=1,
+                    help="The number of sources updated concurrently [default: %default]."),
+        make_option("--check-workers", type="int", default=16,
+                    help="The number of sources checked for changes concurrently [default: %default]."),
+        make_option("--connections-per-host", type="int", default=2,
+                    help="The number of sources on any one host queried concurrently [default: %default]."),
+    )
+    """The options accepted by this command."""
 
     def handle_noargs(self, **options):
         """
-        Iterate over datasets in the repository with remote data sources, and
-        add new revisions for files that have been updated.
+        Iterate over the sources of datasets in the repository, and add new
+        revisions for files that have been updated.
+
+        A summary of the time taken to check and update each source is written
+        to standard output.
 
         :param options: Command-line arguments for this command.
         :type options: dict of str
         """
-        from ...utils.transports import TransportError
-        logger = log.getLogger('bdr.management.commands.updatedatasets')
-        for dataset in Dataset.objects.all():
+        workers = max(options.get("workers", 1), 1)
+        check_workers = max(options.get("check_workers", 16), 1)
+        limit = max(options.get("connections_per_host", 2), 1)
+        sources = list(Source.objects.select_related("dataset"))
+        datasets, hosts = {}, {}
+        for source in sources:
+            datasets.setdefault(source.dataset_id, threading.Lock())
+            hosts.setdefault(urlsplit(source.url).hostname, threading.BoundedSemaphore(limit))
+
+        def _check(src):
+            with hosts[urlsplit(src.url).hostname]:
+                return self._check(src)
+
+        def _update(src):
+            with datasets[src.dataset_id], hosts[urlsplit(src.url).hostname]:
+                return self._update(src)
+
+        started = time.time()
+        with ConnectionPool():
+            checks = self._map(_check, sources, check_workers)
+            changed = [source for source, (due, _) in zip(sources, checks) if due]
+            updates = dict(zip((source.pk for source in changed), self._map(_update, changed, workers)))
+        elapsed = time.time() - started
+
+        results = []
+        for source, (_, checked_in) in zip(sources, checks):
+            status, duration = updates.get(source.pk, ("unchanged", 0.0))
+            results.append((source, status, checked_in + duration))
+        for source, status, duration in sorted(results, key=lambda result: -result[2]):
+            self.stdout.write("{0:>8.2f}s  {1:<9s} {2}: {3}".format(duration, status, source.dataset, source))
+        self.stdout.write("{0:>8.2f}s  total for {1:d} source(s), {2:d} changed".format(elapsed, len(sources),
+                                                                                      len(changed)))
+
+    @staticmethod
+    def _map(function, items, workers):
+        """
+        Apply ``function`` to each of ``items`` using the given number of
+        worker threads.
+
+        :return: The results, in the order of ``items``.
+        :rtype: list
+        """
+        if workers == 1:
+            return [function(item) for item in items]
+
+        pending = Queue.Queue()
+        for index, item in enumerate(items):
+            pending.put((index, item))
+        results, errors = [None] * len(items), []
+
+        def _work():
             try:
-                dataset.update()
-            except TransportError:
-                logger.exception('An error occurred while retrieving remote data: dataset %s', dataset)
-            except IOError:
-                logger.exception('An error occurred while processing data: dataset %s', dataset)
+                while not errors:
+                    try:
+                        index, item = pending.get_nowait()
+                    except Queue.Empty:
+                        break
+                    results[index] = function(item)
+            except Exception:
+                errors.append(sys.exc_info())
+            finally:
+                # Each worker thread holds its own database connection.
+                connection.close()
+
+        threads = [threading.Thread(target=_work) for _ in xrange(min(workers, len(items)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return results
+
+    @staticmethod
+    def _check(source):
+        """
+        Determine whether ``source`` is due and has changed.
+
+        Any connection made to the source is released, so that changed sources
+        do not hold connections until they are downloaded.
+
+        :param source: The source to query.
+        :type source: Source
+        :return: ``True`` if the source should be updated, and the time taken,
+                 in seconds.
+        :rtype: (bool, float)
+        """
+        started = time.time()
+        try:
+            due = source.is_due()
+        finally:
+            # Holding the response until the download phase would keep an
+            # idle connection per changed source, beyond the limit per host,
+            # and servers drop idle connections. A changed source is therefore
+            # requested again when it is downloaded.
+            source.close()
+        return due, time.time() - started
+
+    @staticmethod
+    def _update(source):
+        """
+        Update the dataset to which ``source`` belongs from that source, which
+        is known to have changed.
+
+        :param source: The source to query.
+        :type source: Source
+        :return: The outcome of the update (one of ``"updated"``,
+                 ``"unchanged"``, or ``"failed"``) and the time taken, in
+                 seconds.
+        :rtype: (str, float)
+        """
+        logger = log.getLogger('bdr.management.commands.updatedatasets')
+        started = time.time()
+        try:
+            status = "updated" if source.dataset.update_from(source, checked=True) else "unchanged"
+        except TransportError:
+            logger.exception('An error occurred while retrieving remote data: dataset %s', source.dataset)
+            status = "failed"
+        except IOError:
+            logger.exception('An error occurred while processing data: dataset %s', source.dataset)
+            status = "failed"
+        return status, time.time() - started
@@ -27,18 +27,23 @@ The classes exported by this module include:
 from datetime import datetime, timedelta
 from urlparse import urlsplit
 import re
+import tarfile
+import zipfile
+import zlib
 
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
 from django.db import DatabaseError
 from django.db.transaction import atomic
 from django.db.models import Model, fields, SET_DEFAULT
 from django.db.models.fields import files, related
-from django.db.models.signals import post_delete
+from django.db.models.signals import post_delete, pre_delete
 from django.dispatch import receiver
 from django.utils.log import getLogger
 from django.utils.text import slugify
 
+from .. import app_settings
 from ..utils import utc, RemoteFile
 from ..utils.archives import Archive
 from ..utils.storage import delta_storage, upload_path
@@ -88,6 +93,24 @@ def validate_regex(value):
         raise ValidationError("Invalid pattern: {0:s}".format(error))
 
 
+def validate_source_url(value):
+    """
+    Validate a string as the URL of a data source.
+
+    The scheme must be handled by one of the REMOTE_TRANSPORTS. URLs other
+    than ``file`` URLs must also name a host.
+
+    :param value: The URL.
+    :type value: str
+    :raise ValidationError: if the URL is invalid.
+    """
+    scheme = urlsplit(value).scheme
+    if scheme not in app_settings.REMOTE_TRANSPORTS:
+        raise ValidationError("Unsupported URL scheme: {0:s}".format(scheme or "(none)"))
+    if scheme != "file":
+        URLValidator()(value)
+
+
 class Category(Model):
     """
     Categories organise datasets into a hierarchical structure.
@@ -326,30 +349,58 @@ class Dataset(Model):
         Query the sources for this dataset and add revisions for any modified
         files.
         """
+        for source in self.sources.all():
+            self.update_from(source)
 
-        def _is_due(src):
-            due = False
-            try:
-                with atomic():
-                    if src.has_update_elapsed():
-                        src.checked()
-                        due = src.has_changed()
-            except DatabaseError:
-                _log.exception('An exception occurred while the "%s" dataset with the source at %s', src.dataset, src)
-            except TransportError:
-                _log.exception('An exception occurred while querying the source at %s', src)
-            finally:
-                return due
-
-        for source in filter(_is_due, self.sources.all()):
+    def update_from(self, source, checked=False):
+        """
+        Query a source for this dataset, if it is due to be checked, and add
+        revisions for any modified files.
+
+        Sources are independent, so different sources may be updated
+        concurrently.
+
+        :param source: The source to query.
+        :type source: Source
+        :param checked: (Optional) ``True`` if the source is already known to
+                        have changed (see :py:meth:`Source.is_due`), in which
+                        case it is not checked again.
+        :type checked: bool
+        :return: ``True`` if files were retrieved from the source; otherwise
+                 ``False``.
+        :rtype: bool
+        """
+        try:
+            if not (checked or source.is_due()):
+                return False
+            update = None
             try:
+                if not source.has_new_content():
+                    _log.info('The source at %s republished its latest content', source)
+                    return False
                 file_list, size, modification_date = source.files()
-            except (TransportError, IOError):
-                _log.exception('An exception occurred while retrieving data from %s', source)
-            else:
-                update = self.updates.create(source=source, size=size, modified_at=modification_date)
+
+                update = self.updates.create(source=source, size=size, modified_at=modification_date,
+                                             etag=source.get_etag() or "")
+                # The files are read from the source as they are added, so
+                # errors may be raised at any point in this loop.
                 for source_file in file_list:
                     self.add_file(source_file, update)
+            except (TransportError, IOError, tarfile.TarError, zipfile.BadZipfile, zlib.error):
+                _log.exception('An exception occurred while retrieving data from %s', source)
+                if update is not None:
+                    # The revisions added so far, and their data, are removed
+                    # with the update.
+                    update.delete()
+                return False
+            # The content is only recorded once every file has been added, as
+            # it would otherwise be taken to be republished if an error
+            # interrupted the update.
+            update.digest = source.get_digest()
+            update.save(update_fields=("digest",))
+            return True
+        finally:
+            source.close()
 
     # noinspection PyShadowingBuiltins
     def add_file(self, file, update, format=None):
@@ -359,6 +410,15 @@ class Dataset(Model):
         If the file does not already exist, it will be created. The file name
         is taken from the name property of the file.
 
+        No revision is added if the file is unchanged since its latest
+        revision. A file with the same size and modification time is assumed
+        to be unchanged without reading it; otherwise, a file of the same size
+        is compared by the digest of its content.
+
+        Unless its digest is already known, the file is read exactly once: it
+        is spooled to a temporary file while its digest is computed, and that
+        copy is then encoded in place by the storage.
+
         :param file: The file to add.
         :type file: django.core.files.File
         :param update: The update with which this addition should be
@@ -367,12 +427,28 @@ class Dataset(Model):
         :param format: (Optional) The default format for revisions of this
                        file.
         :type format: Format | None
+        :return: The added revision, or ``None`` if the file is unchanged.
+        :rtype: Revision | None
         """
         file_defaults = {"default_format": Format.default() if format is None else format}
         with atomic():
             instance = self.files.get_or_create(name=file.name, defaults=file_defaults)[0]
-            instance.revisions.create(data=file, size=file.size, modified_at=file.modified_time, update=update,
-                                      format=format)
+            latest = instance.revisions.order_by("number").last()
+            if (latest is not None and latest.size == file.size and
+                    file.modified_time is not None and file.modified_time == latest.modified_at):
+                return None
+
+            spooled = None
+            if getattr(file, "digest", None) is None:
+                file = spooled = RemoteFile.spool(file, file.name, file.modified_time)
+            try:
+                if latest is not None and latest.size == file.size and latest.digest == file.digest:
+                    return None
+                return instance.revisions.create(data=file, size=file.size, modified_at=file.modified_time,
+                                                 update=update, format=format, digest=file.digest)
+            finally:
+                if spooled is not None:
+                    spooled.close()
 
     def get_absolute_url(self):
         """
@@ -465,7 +541,7 @@ class Source(Model):
     :py:class:`Model` class.
     """
 
-    url = fields.URLField(verbose_name="URL")
+    url = fields.CharField(max_length=200, verbose_name="URL", validators=[validate_source_url])
     """A URL specifying the update source for files in this dataset."""
     dataset = related.ForeignKey(Dataset, editable=False, related_name="sources",
                                  related_query_name="source")
@@ -482,6 +558,24 @@ class Source(Model):
     """
     checked_at = fields.DateTimeField(blank=True, null=True, editable=False)
     """The last time this source was checked for updates."""
+    segments = fields.PositiveSmallIntegerField(default=1, verbose_name="Download segments",
+                                                help_text="The number of parts of the resource downloaded"
+                                                          " concurrently, where the server permits.")
+    """
+    The number of parts into which a large resource is split when it is
+    downloaded. Each part is retrieved over a separate connection.
+    """
+    min_segment_size = fields.PositiveIntegerField(default=16 * 1024 * 1024, verbose_name="Minimum segment size",
+                                                   help_text="The smallest part into which a download is split.")
+    """The minimum size, in bytes, of each part of a segmented download."""
+    zsync_url = fields.URLField(max_length=200, blank=True, verbose_name="zsync control file URL",
+                                help_text="A control file published with the resource. If given, only"
+                                          " blocks changed since the previous version are downloaded.")
+    """
+    The URL of a zsync control file that describes the resource, if any. The
+    resource is then rebuilt from the unchanged blocks of the version
+    retrieved by the latest update.
+    """
     transport_provider_factory = Transport.instance
     """
     A callable that returns Transport instances. The factory must accept three
@@ -509,27 +603,57 @@ class Source(Model):
         Fetch the files obtainable from this data source.
 
         The files returned will consist of only those that pass the filters
-        applicable to this data source.
-
-        :return: A filtered list of `RemoteFile` instances obtained from this
-                 data source, the combined update size, and modification date.
-        :rtype: tuple of (list of RemoteFile, long, datetime)
+        applicable to this data source. They are produced in the order in
+        which they are stored, as the archive is read: each file must be read,
+        if at all, before the next is requested, so that archives can be read
+        in a single pass.
+
+        :return: An iterator over the filtered `RemoteFile` instances obtained
+                 from this data source, the combined update size, and
+                 modification date.
+        :rtype: tuple of (collections.Iterator of RemoteFile, long, datetime)
         """
         provider = self._get_transport_provider()
         size, modification_date = provider.get_size(), provider.get_modification_date()
-        archive = self._get_archive(provider.get_content())
-        filters = self._get_filters()
-        file_list = []
-        for file_name in archive:  # type: str
+        archive = provider.get_archive() or self._get_archive(provider.get_content())
+        return self._get_files(archive, self._get_filters(), modification_date), size, modification_date
+
+    def _get_files(self, archive, filters, modification_date):
+        """
+        Iterate over the members of ``archive`` that pass the given filters.
+
+        :rtype: collections.Iterator of RemoteFile
+        """
+        mapped_names = {}
+
+        def _select(file_name):
             try:
-                mapped_name = self._get_mapping(file_name, filters)
+                mapped_names[file_name] = self._get_mapping(file_name, filters)
             except self.FileRejected:
-                pass  # If a file is rejected, skip it.
-            else:
-                member = archive[file_name]
-                new_file = RemoteFile(member.file, mapped_name, member.size, member.mtime or modification_date)
-                file_list.append(new_file)
-        return file_list, size, modification_date
+                return False  # If a file is rejected, skip it.
+            return True
+
+        for member in archive.members(_select):
+            yield RemoteFile(member.file, mapped_names[member.name], member.size, member.mtime or modification_date,
+                             member.digest, member.path)
+
+    def close(self):
+        """
+        Release the connection to this data source, if any, and discard any
+        data retrieved from it.
+        """
+        if self._provider is not None:
+            self._provider.close()
+            self._provider = None
+
+    def get_etag(self):
+        """
+        Return the entity tag reported by the data source for its current
+        version, if any.
+
+        :rtype: str | None
+        """
+        return self._get_transport_provider().get_etag()
 
     def checked(self, timestamp=None):
         """
@@ -546,6 +670,55 @@ class Source(Model):
         self.checked_at = timestamp
         self.save(update_fields=("checked_at",))
 
+    def get_digest(self):
+        """
+        Return the SHA-1 digest of the resource at this data source, retrieving
+        it if necessary.
+
+        :rtype: str
+        """
+        return self._get_transport_provider().get_digest()
+
+    def has_new_content(self):
+        """
+        Return ``True`` unless the resource at this data source is identical
+        to that retrieved by its latest update.
+
+        The resource is retrieved, but not extracted, so that content that is
+        republished without modification is recognised cheaply.
+
+        :rtype: bool
+        """
+        digest = self.get_digest()
+        try:
+            return self.updates.latest().digest != digest
+        except self.updates.model.DoesNotExist:
+            return True
+
+    def is_due(self):
+        """
+        Return ``True`` if this data source is due to be checked and has
+        changed since its latest update.
+
+        The source is marked as checked if its update period has elapsed.
+        Errors are logged, rather than raised, and the source is then treated
+        as unchanged.
+
+        :rtype: bool
+        """
+        due = False
+        try:
+            with atomic():
+                if self.has_update_elapsed():
+                    self.checked()
+                    due = self.has_changed()
+        except DatabaseError:
+            _log.exception('An exception occurred while the "%s" dataset with the source at %s', self.dataset, self)
+        except TransportError:
+            _log.exception('An exception occurred while querying the source at %s', self)
+        finally:
+            return due
+
     def has_update_elapsed(self):
         """
         Return ``True` if this data source is due to be checked.
@@ -567,6 +740,11 @@ class Source(Model):
         """
         Determine whether the resource at this source has changed.
 
+        Where the transport supports it, the source is asked whether the
+        resource has changed since the latest update, identified by its entity
+        tag and modification date. Otherwise, the size and modification date
+        of the resource are compared with those of the latest update.
+
         :return: ``True`` if the resource has changed; otherwise ``False``.
         :rtype:  bool
         """
@@ -577,7 +755,10 @@ class Source(Model):
             changed = True
         else:
             provider = self._get_transport_provider()
-            if provider.get_size() != latest_update.size:
+            modified = provider.is_modified(latest_update.etag or None, latest_update.modified_at)
+            if modified is not None:
+                changed = modified
+            elif provider.get_size() != latest_update.size:
                 changed = True
             else:
                 updated_at = provider.get_modification_date()
@@ -618,6 +799,26 @@ class Source(Model):
         path = urlsplit(self.url).path
         return self.archive_factory(data, path)
 
+    def _get_seed(self):
+        """
+        Return the data retrieved by the latest update from this source, if
+        it was stored without modification.
+
+        That data is held only if the resource was a single file, rather than
+        an archive, in which case a revision has the digest of the update.
+
+        :return: An open file containing the data, or None.
+        :rtype: file | None
+        """
+        try:
+            digest = self.updates.latest().digest
+        except self.updates.model.DoesNotExist:
+            return None
+        revision = Revision.objects.filter(file__dataset=self.dataset_id, digest=digest).exclude(digest="").last()
+        if revision is None:
+            return None
+        return delta_storage.open(revision.data.name)
+
     def _get_filters(self):
         """
         Return a list of filters (possibly empty) associated with this data
@@ -638,6 +839,11 @@ class Source(Model):
         if self._provider is None:
             self._provider = self.transport_provider_factory(url=self.url, user=self.username,
                                                              password=self.password)
+            self._provider.segments = self.segments
+            self._provider.min_segment_size = self.min_segment_size
+            if self.zsync_url:
+                self._provider.zsync_url = self.zsync_url
+                self._provider.seed = self._get_seed
         return self._provider
 
     def __unicode__(self):
@@ -768,6 +974,16 @@ class Update(Model):
     The modification date of the resource as reported by the data source, or
     None if this metadata is unavailable.
     """
+    etag = fields.CharField(max_length=255, blank=True, editable=False)
+    """
+    The entity tag of the resource as reported by the data source, or empty if
+    this metadata is unavailable.
+    """
+    digest = fields.CharField(max_length=40, blank=True, editable=False)
+    """
+    The SHA-1 digest of the resource retrieved from the data source, or empty
+    if the update was initiated with user-supplied data.
+    """
 
     class Meta(object):
         """Metadata options for the ``Update`` model class."""
@@ -797,6 +1013,8 @@ class Revision(Model):
     """A timestamp indicating when this revision was modified at source."""
     update = related.ForeignKey(Update, related_name="revisions", related_query_name="revision", editable=False)
     """The update that caused the addition of this revision."""
+    digest = fields.CharField(max_length=40, blank=True, editable=False)
+    """The SHA-1 digest of the data in this revision, or empty if unknown."""
     _format = related.ForeignKey(Format, verbose_name="Format", related_name='revisions', related_query_name='revision',
                                  default=1, db_column='format_id', on_delete=SET_DEFAULT)
     """The format of this revision."""
@@ -860,3 +1078,14 @@ class Revision(Model):
 @receiver(post_delete, sender=Revision)
 def _remove_orphaned_files(sender, instance, **kwargs):
     instance.data.delete(save=False)
+
+
+# noinspection PyUnusedLocal
+# The sender parameter is unnecessary as the instance is guaranteed to be a
+# File
+@receiver(pre_delete, sender=File)
+def _remove_revision_chain(sender, instance, **kwargs):
+    # Deleting every revision in one call avoids recoding the chain once per
+    # revision. The subsequent deletion of each revision finds its data
+    # already removed.
+    delta_storage.delete_many(instance.revisions.exclude(data="").values_list("data", flat=True))
@@ -0,0 +1,144 @@
+"""
+Tests for the management commands of the bdr application.
+
+This module has no public exports.
+"""
+
+from StringIO import StringIO
+import threading
+import time
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from ..models import Dataset, Source
+from .test_models import create_dataset, create_source
+
+__all__ = []
+__author__ = "Michael Winter (mail@michael-winter.me.uk)"
+__license__ = """
+    Biological Dataset Repository: data archival and retrieval.
+    Copyright (C) 2015  Michael Winter
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+    """
+
+
+class UpdateDatasetsTest(TestCase):
+    delay = 0.05
+
+    def setUp(self):
+        self._update_from = Dataset.update_from
+        self._is_due = Source.is_due
+        self._close = Source.close
+        self.lock = threading.Lock()
+        self.active = {}
+        self.check_delay = self.delay
+        self.peaks = {}
+        self.checked = []
+        self.unchanged = set()
+        self.updated = []
+        self.closed = []
+
+        def is_due(source):
+            self._visit(source, self.check_delay)
+            with self.lock:
+                self.checked.append(source.pk)
+            return source.pk not in self.unchanged
+
+        def update_from(dataset, source, checked=False):
+            self.assertTrue(checked)
+            self._visit(source, self.delay)
+            with self.lock:
+                self.updated.append(source.pk)
+            return True
+
+        def close(source):
+            with self.lock:
+                self.closed.append(source.pk)
+        Source.is_due = is_due
+        Dataset.update_from = update_from
+        Source.close = close
+
+    def tearDown(self):
+        Dataset.update_from = self._update_from
+        Source.is_due = self._is_due
+        Source.close = self._close
+
+    def _visit(self, source, delay):
+        host = source.url.split("/")[2]
+        with self.lock:
+            self.active[host] = self.active.get(host, 0) + 1
+            self.peaks[host] = max(self.peaks.get(host, 0), self.active[host])
+        time.sleep(delay)
+        with self.lock:
+            self.active[host] -= 1
+
+    def test_every_source_is_updated(self):
+        sources = self._create_sources(["a.example.local"] * 3 + ["b.example.local"] * 3)
+        output = StringIO()
+
+        call_command("updatedatasets", workers=4, stdout=output)
+
+        self.assertItemsEqual(self.updated, [source.pk for source in sources])
+        for source in sources:
+            self.assertIn(source.url, output.getvalue())
+
+    def test_only_changed_sources_are_updated(self):
+        sources = self._create_sources(["a.example.local"] * 4)
+        self.unchanged.update(source.pk for source in sources[::2])
+
+        call_command("updatedatasets", stdout=StringIO())
+
+        self.assertItemsEqual(self.checked, [source.pk for source in sources])
+        self.assertItemsEqual(self.updated, [source.pk for source in sources[1::2]])
+
+    def test_every_source_is_closed_after_check(self):
+        sources = self._create_sources(["a.example.local"] * 4)
+        self.unchanged.update(source.pk for source in sources[::2])
+
+        call_command("updatedatasets", stdout=StringIO())
+
+        self.assertItemsEqual(self.closed, [source.pk for source in sources])
+
+    def test_sources_are_checked_concurrently(self):
+        sources = self._create_sources(["{0:d}.example.local".format(number) for number in range(4)])
+        self.unchanged.update(source.pk for source in sources)
+
+        started = time.time()
+        call_command("updatedatasets", check_workers=4, stdout=StringIO())
+
+        self.assertLess(time.time() - started, len(sources) * self.delay)
+
+    def test_connections_per_host_are_limited(self):
+        self._create_sources(["a.example.local"] * 4 + ["b.example.local"] * 4)
+
+        call_command("updatedatasets", workers=6, connections_per_host=2, stdout=StringIO())
+
+        self.assertLessEqual(max(self.peaks.values()), 2)
+
+    def test_workers_update_sources_concurrently(self):
+        sources = self._create_sources(["{0:d}.example.local".format(number) for number in range(4)])
+        self.check_delay = 0
+
+        started = time.time()
+        call_command("updatedatasets", workers=4, stdout=StringIO())
+
+        self.assertLess(time.time() - started, len(sources) * self.delay)
+
+    @staticmethod
+    def _create_sources(hosts):
+        return [create_source(dataset=create_dataset(), url="http://{0:s}/{1:d}".format(host, number))
+                for number, host in enumerate(hosts)]
@@ -5,17 +5,27 @@ This module has no public exports.
 """
 
 from datetime import datetime, timedelta
+from hashlib import sha1
+from unittest import skipIf
+import bz2
+import gzip
 import io
 import random
 import string
+import struct
+import tarfile
+import zipfile
+import zlib
 
 from django.core.exceptions import ValidationError
 from django.core.files.base import ContentFile
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
 
+from .. import app_settings
 from ..models import Dataset, File, Filter, Revision, Source, Update
-from ..utils import utc
-from ..utils.archives import Archive, Member
+from ..utils import utc, RemoteFile
+from ..utils.archives import (Archive, Bzip2Archive, GzipArchive, Member, MockArchive, TarArchive, XzArchive,
+                              ZipArchive, ZstdArchive, lzma, zstandard)
 from ..utils.storage import upload_path
 from ..utils.transports import Transport
 
@@ -185,6 +195,15 @@ class RevisionTest(TestCase):
             with revision.data as stream:
                 self.assertEqual(stream.read(), datum)
 
+    def test_file_deletion_removes_revision_data(self):
+        datafile = create_file()
+        revisions = create_revisions(datafile=datafile, count=5)
+        storage = revisions[0].data.storage
+
+        datafile.delete()
+
+        self.assertFalse(any(storage.exists(revision.data.name) for revision in revisions))
+
     def test_revision_numbers_are_sequential_in_sparse_revision_set(self):
         datafile = create_file()
         count = 5
@@ -199,6 +218,251 @@ class RevisionTest(TestCase):
         self.assertGreater(new_revision.number, revisions[-1].number)
 
 
+class AddFileTest(TestCase):
+    def setUp(self):
+        self.dataset = create_dataset()
+        self.update = create_update(dataset=self.dataset)
+        self.modified_at = datetime(2015, 1, 1, tzinfo=utc)
+
+    def tearDown(self):
+        Revision.objects.all().delete()
+
+    def test_new_file_is_added(self):
+        revision = self._add_file("data")
+
+        self.assertEqual(revision.digest, "a17c9aaa61e80a1bf71d0d850af4e5baa9800bbd")
+        self.assertEqual(revision.file.revisions.count(), 1)
+
+    def test_unchanged_file_is_skipped(self):
+        first = self._add_file("data")
+
+        self.assertIsNone(self._add_file("data"))
+        self.assertEqual(first.file.revisions.count(), 1)
+
+    def test_unchanged_content_is_skipped_despite_modification(self):
+        first = self._add_file("data")
+
+        self.assertIsNone(self._add_file("data", self.modified_at + timedelta(days=1)))
+        self.assertEqual(first.file.revisions.count(), 1)
+
+    def test_changed_content_is_added(self):
+        first = self._add_file("data")
+
+        second = self._add_file("atad", self.modified_at + timedelta(days=1))
+
+        self.assertEqual(second.number, first.number + 1)
+        with second.data as stream:
+            self.assertEqual(stream.read(), "atad")
+
+    def test_gzip_member_is_added_without_further_copies(self):
+        compressed = io.BytesIO()
+        stream = gzip.GzipFile("file.txt.gz", "wb", fileobj=compressed)
+        stream.write("data")
+        stream.close()
+        compressed.seek(0)
+        member = GzipArchive(compressed, "/remote/file.txt.gz")["file.txt"]
+
+        revision = self.dataset.add_file(RemoteFile(member.file, member.name, member.size, self.modified_at,
+                                                    member.digest), self.update)
+
+        self.assertEqual((revision.size, revision.digest), (4, "a17c9aaa61e80a1bf71d0d850af4e5baa9800bbd"))
+        with revision.data as data:
+            self.assertEqual(data.read(), "data")
+
+    def test_tar_members_are_added_in_one_pass(self):
+        archive = SequentialFile()
+        with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+            for name, data in (("a.txt", "first"), ("b.txt", "second"), ("c.txt", "third")):
+                info = tarfile.TarInfo(name)
+                info.size, info.mtime = len(data), 1420070400
+                tar.addfile(info, io.BytesIO(data))
+        archive.seek(0)
+        reader = TarArchive(archive, "/remote/files.tar.gz")
+        self.assertTrue(reader.can_read())
+        archive.seeks = 0
+
+        revisions = [self.dataset.add_file(RemoteFile(member.file, member.name, member.size, member.mtime),
+                                           self.update)
+                     for member in reader.members(lambda name: name != "b.txt")]
+
+        self.assertEqual(archive.seeks, 0)
+        self.assertListEqual([revision.file.name for revision in revisions], ["a.txt", "c.txt"])
+        with revisions[1].data as data:
+            self.assertEqual(data.read(), "third")
+
+    def test_zip_members_are_opened_on_demand(self):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as stream:
+            stream.writestr("a.txt", "first")
+            stream.writestr("b.txt", "second")
+        archive.seek(0)
+        reader = ZipArchive(archive, "/remote/files.zip")
+        members = [reader[name] for name in reader]
+        self.assertTrue(all(member.file._file is None for member in members))
+
+        revision = self.dataset.add_file(RemoteFile(members[1].file, members[1].name, members[1].size,
+                                                    members[1].mtime), self.update)
+
+        self.assertEqual((revision.size, revision.digest), (6, sha1("second").hexdigest()))
+        self.assertTrue(all(member.file._file is None for member in members))
+
+    def _add_file(self, data, modified_at=None):
+        content = RemoteFile(io.BytesIO(data), "file.txt", len(data), modified_at or self.modified_at)
+        return self.dataset.add_file(content, self.update)
+
+
+class ArchiveTest(SimpleTestCase):
+    def test_reader_is_chosen_by_signature(self):
+        tarred = io.BytesIO()
+        with tarfile.open(fileobj=tarred, mode="w:gz") as tar:
+            info = tarfile.TarInfo("file.txt")
+            info.size = 4
+            tar.addfile(info, io.BytesIO("data"))
+        zipped = io.BytesIO()
+        with zipfile.ZipFile(zipped, "w") as stream:
+            stream.writestr("file.txt", "data")
+        compressed = io.BytesIO()
+        with gzip.GzipFile("file.txt.gz", "wb", fileobj=compressed) as stream:
+            stream.write("data")
+
+        for data, reader in ((tarred, TarArchive), (zipped, ZipArchive), (compressed, GzipArchive),
+                             (io.BytesIO("data"), MockArchive)):
+            self.assertIsInstance(Archive.instance(data, "/remote/download"), reader)
+
+    def test_reader_is_chosen_by_extension(self):
+        zipped = io.BytesIO()
+        zipped.write("#!/bin/sh\nexit 0\n")
+        with zipfile.ZipFile(zipped, "a") as stream:
+            stream.writestr("file.txt", "data")
+
+        self.assertIsInstance(Archive.instance(zipped, "/remote/installer.zip"), ZipArchive)
+        self.assertIsInstance(Archive.instance(zipped, "/remote/installer"), MockArchive)
+
+    def test_large_compressed_tar_is_not_read_as_compressed_file(self):
+        # The first block of a large bzip2 stream is not complete within the
+        # header read to choose a reader.
+        data = "".join(chr(random.getrandbits(8)) for _ in xrange(65536))
+        tarred = io.BytesIO()
+        with tarfile.open(fileobj=tarred, mode="w:bz2") as tar:
+            info = tarfile.TarInfo("file.dat")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+        self.assertIsInstance(Archive.instance(tarred, "/remote/files"), TarArchive)
+
+
+class StreamArchiveTest(SimpleTestCase):
+    def test_concatenated_bzip2_streams_are_read_as_one(self):
+        compressed = io.BytesIO(bz2.compress("first\n") + bz2.compress("second\n"))
+
+        archive = Archive.instance(compressed, "/remote/file.txt.bz2")
+        member = archive["file.txt"]
+
+        self.assertIsInstance(archive, Bzip2Archive)
+        self.assertEqual(member.file.read(), "first\nsecond\n")
+        self.assertEqual((member.size, member.digest), (13, sha1("first\nsecond\n").hexdigest()))
+
+    def test_truncated_bzip2_stream_raises_error(self):
+        compressed = bz2.compress("data" * 1024)
+        archive = Bzip2Archive(io.BytesIO(compressed[:-8]), "/remote/file.txt.bz2")
+
+        self.assertTrue(archive.can_read())
+        self.assertRaises(IOError, archive.__getitem__, "file.txt")
+
+    @skipIf(lzma is None, "backports.lzma is not installed")
+    def test_xz_tar_members_are_streamed(self):
+        tarred = io.BytesIO()
+        with tarfile.open(fileobj=tarred, mode="w") as tar:
+            info = tarfile.TarInfo("file.txt")
+            info.size = 4
+            tar.addfile(info, io.BytesIO("data"))
+        compressed = io.BytesIO(lzma.compress(tarred.getvalue()))
+
+        archive = Archive.instance(compressed, "/remote/files.tar.xz")
+
+        self.assertIsInstance(archive, TarArchive)
+        self.assertEqual([member.file.read() for member in archive.members()], ["data"])
+        self.assertIsInstance(Archive.instance(io.BytesIO(lzma.compress("data")), "/remote/file.txt.xz"),
+                              XzArchive)
+
+    @skipIf(zstandard is None, "zstandard is not installed")
+    def test_concatenated_zstd_frames_are_read_as_one(self):
+        compressor = zstandard.ZstdCompressor()
+        compressed = io.BytesIO(compressor.compress("first\n") + compressor.compress("second\n"))
+
+        archive = Archive.instance(compressed, "/remote/file.txt.zst")
+        member = archive["file.txt"]
+
+        self.assertIsInstance(archive, ZstdArchive)
+        self.assertEqual(member.file.read(), "first\nsecond\n")
+        self.assertEqual((member.size, member.digest), (13, sha1("first\nsecond\n").hexdigest()))
+
+    @skipIf(zstandard is None, "zstandard is not installed")
+    def test_zstd_tar_members_are_streamed(self):
+        tarred = io.BytesIO()
+        with tarfile.open(fileobj=tarred, mode="w") as tar:
+            info = tarfile.TarInfo("file.txt")
+            info.size = 4
+            tar.addfile(info, io.BytesIO("data"))
+        compressed = io.BytesIO(zstandard.ZstdCompressor().compress(tarred.getvalue()))
+
+        archive = Archive.instance(compressed, "/remote/files.tar.zst")
+
+        self.assertIsInstance(archive, TarArchive)
+        self.assertEqual([member.file.read() for member in archive.members()], ["data"])
+
+
+class GzipArchiveTest(SimpleTestCase):
+    def setUp(self):
+        self.threads = app_settings.GZIP_THREADS
+
+    def tearDown(self):
+        app_settings.GZIP_THREADS = self.threads
+
+    def test_concatenated_members_are_read_as_one(self):
+        compressed = io.BytesIO()
+        for data in ("first\n", "second\n"):
+            stream = gzip.GzipFile("file.txt.gz", "wb", fileobj=compressed, mtime=1420070400)
+            stream.write(data)
+            stream.close()
+        compressed.write(b"\0" * 8)
+        compressed.seek(0)
+
+        member = GzipArchive(compressed, "/remote/file.txt.gz")["file.txt"]
+
+        self.assertEqual(member.file.read(), "first\nsecond\n")
+        self.assertEqual((member.size, member.digest), (13, sha1("first\nsecond\n").hexdigest()))
+        self.assertEqual(member.mtime, datetime(2015, 1, 1, tzinfo=utc))
+
+    def test_bgzf_blocks_are_decompressed_concurrently(self):
+        app_settings.GZIP_THREADS = 4
+        blocks = ["line {0:d}\n".format(number) * 100 for number in xrange(100)]
+        compressed = io.BytesIO(b"".join(_make_bgzf_block(block) for block in blocks + [""]))
+
+        member = GzipArchive(compressed, "/remote/file.txt.gz")["file.txt"]
+
+        self.assertEqual(member.file.read(), "".join(blocks))
+        self.assertIsNone(member.mtime)
+
+    def test_truncated_file_raises_error(self):
+        compressed = io.BytesIO()
+        stream = gzip.GzipFile("file.txt.gz", "wb", fileobj=compressed)
+        stream.write("data" * 1024)
+        stream.close()
+        archive = GzipArchive(io.BytesIO(compressed.getvalue()[:-6]), "/remote/file.txt.gz")
+
+        self.assertTrue(archive.can_read())
+        self.assertRaises(IOError, archive.__getitem__, "file.txt")
+
+
+def _make_bgzf_block(data):
+    """Return a BGZF block containing ``data``."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    return (b"\x1f\x8b\x08\x04" + struct.pack("<IBBHccHH", 0, 0, 255, 6, b"B", b"C", 2, len(deflated) + 25) +
+            deflated + struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data)))
+
+
 class FilterTest(TestCase):
     def test_valid_regex_validates(self):
         instance = create_filter(pattern="()")
@@ -264,6 +528,16 @@ class FilterTest(TestCase):
 
 
 class SourceTest(TestCase):
+    def test_file_urls_are_valid(self):
+        source = create_source(url="file:///srv/mirrors/drugbank")
+
+        source.full_clean()
+
+    def test_unsupported_urls_are_invalid(self):
+        source = create_source(url="gopher://example.local/drugbank")
+
+        self.assertRaises(ValidationError, source.full_clean)
+
     def test_update_check_fails_if_zero_frequency(self):
         source = create_source()
 
@@ -349,6 +623,74 @@ class SourceTest(TestCase):
 
         self.assertTrue(source.has_changed())
 
+    def test_unchanged_if_source_reports_unchanged(self):
+        update = create_update(size=1024)
+        update.etag = '"v1"'
+        update.save()
+        source = update.source
+        validators = []
+
+        def _is_modified(etag=None, modified_at=None):
+            validators.append(etag)
+            return False
+
+        def _transport_factory(url, user, password):
+            transport = FakeTransport(url, user, password, size=2048)
+            transport.is_modified = _is_modified
+            return transport
+        source.transport_provider_factory = _transport_factory
+
+        self.assertFalse(source.has_changed())
+        self.assertListEqual(validators, ['"v1"'])
+
+    def test_republished_content_is_not_extracted(self):
+        update = create_update()
+        update.digest = sha1("content").hexdigest()
+        update.save()
+        source = update.source
+
+        def _transport_factory(url, user, password):
+            return FakeTransport(url, user, password, content="content")
+        source.transport_provider_factory = _transport_factory
+
+        def _archive_factory(archive_file, path):
+            self.fail("Republished content was extracted.")
+        source.archive_factory = _archive_factory
+
+        self.assertFalse(update.dataset.update_from(source, checked=True))
+        self.assertEqual(source.updates.count(), 1)
+
+    def test_failed_member_read_discards_update(self):
+        source = create_source()
+
+        def _transport_factory(url, user, password):
+            return FakeTransport(url, user, password, content="archive")
+        source.transport_provider_factory = _transport_factory
+
+        class _TruncatedArchive(FakeArchive):
+            def members(self, select=None):
+                select("a.txt")
+                yield Member("a.txt", 5, datetime(2015, 1, 1, tzinfo=utc), io.BytesIO("first"))
+                raise IOError("The archive is truncated.")
+        source.archive_factory = _TruncatedArchive
+
+        self.assertFalse(source.dataset.update_from(source, checked=True))
+        self.assertEqual(source.updates.count(), 0)
+        self.assertEqual(Revision.objects.filter(file__dataset=source.dataset).count(), 0)
+
+    def test_modified_content_is_new(self):
+        update = create_update()
+        update.digest = sha1("content").hexdigest()
+        update.save()
+        source = update.source
+
+        def _transport_factory(url, user, password):
+            return FakeTransport(url, user, password, content="modified content")
+        source.transport_provider_factory = _transport_factory
+
+        self.assertTrue(source.has_new_content())
+        source.close()
+
     def test_no_filters_returns_files(self):
         update = create_update()
         source = update.source
@@ -382,7 +724,7 @@ class SourceTest(TestCase):
         source.archive_factory = _archive_factory
 
         files, _, _ = source.files()
-        self.assertListEqual(files, expected_files)
+        self.assertListEqual(list(files), expected_files)
 
     def test_matching_files_returns_mapped_list(self):
         update = create_update()
@@ -403,6 +745,16 @@ class SourceTest(TestCase):
         self.assertListEqual([file.name for file in files], expected_files)
 
 
+class SequentialFile(io.BytesIO):
+    """An in-memory file that counts the number of times it is seeked."""
+
+    seeks = 0
+
+    def seek(self, *args, **kwargs):
+        self.seeks += 1
+        return super(SequentialFile, self).seek(*args, **kwargs)
+
+
 class FakeArchive(Archive):
     """
     A fake subclass of the abstract Archive class that does nothing.
@@ -444,7 +796,7 @@ class FakeTransport(Transport):
     A fake subclass of the abstract Transport class that does nothing.
     """
 
-    def __init__(self, url, user, password, size=-1, m_date=None):
+    def __init__(self, url, user, password, size=-1, m_date=None, content=b""):
         """
         Create an instance of a data transport mechanism.
 
@@ -458,6 +810,7 @@ class FakeTransport(Transport):
         :type  password: str
         """
         super(FakeTransport, self).__init__(url, user, password)
+        self.content = content
         self.size = size
         self.m_date = m_date
 
@@ -480,7 +833,7 @@ class FakeTransport(Transport):
         return self.m_date
 
     def _do_get_content(self):
-        return io.BytesIO()
+        self._write(self.content)
 
 
 def _get_random_text(length=25):
@@ -0,0 +1,558 @@
+"""
+Tests for the bdr.utils.storage module.
+
+This module has no public exports.
+"""
+
+from unittest import skipIf
+import errno
+import io
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase
+
+from .. import app_settings
+from ..utils import RemoteFile, deltas
+from ..utils.storage import DeltaFileSystemStorage, Lock
+
+__all__ = []
+__author__ = "Michael Winter (mail@michael-winter.me.uk)"
+__license__ = """
+    Biological Dataset Repository: data archival and retrieval.
+    Copyright (C) 2015  Michael Winter
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+    """
+
+
+class CountingStorage(DeltaFileSystemStorage):
+    """
+    A delta storage that counts the number of files decoded and, optionally,
+    slows decoding down.
+    """
+
+    decode_count = 0
+    decode_delay = 0
+
+    @classmethod
+    def _decode(cls, source, base=None, unlink_base=False):
+        cls.decode_count += 1
+        time.sleep(cls.decode_delay)
+        return super(CountingStorage, cls)._decode(source, base, unlink_base)
+
+
+class StorageTestCase(SimpleTestCase):
+    """
+    A base class for tests that use a delta storage instance within a temporary
+    directory.
+    """
+
+    settings = {}
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self._settings = {}
+        for key, value in self.settings.items():
+            self._settings[key] = getattr(app_settings, key)
+            setattr(app_settings, key, value)
+        self.storage = CountingStorage(location=self.location)
+
+    def tearDown(self):
+        for key, value in self._settings.items():
+            setattr(app_settings, key, value)
+        shutil.rmtree(self.location)
+
+    def create_chain(self, data, root="chain", start=1):
+        """
+        Save each item of ``data`` as a successive revision and return the
+        stored names.
+
+        :rtype: list of str
+        """
+        return [self.storage.save(os.path.join("000001", "{0:s}.{1:06x}".format(root, number)),
+                                  ContentFile(datum))
+                for number, datum in enumerate(data, start)]
+
+    def read(self, name):
+        with self.storage.open(name) as stream:
+            return stream.read()
+
+
+class KeyframeTest(StorageTestCase):
+    settings = {"KEYFRAME_INTERVAL": 3, "KEYFRAME_THRESHOLD": 0}
+
+    def test_revisions_round_trip(self):
+        data = [_get_text(number) for number in range(8)]
+
+        names = self.create_chain(data)
+
+        self.assertListEqual([self.read(name) for name in names], data)
+
+    def test_decoding_is_bounded_by_interval(self):
+        names = self.create_chain([_get_text(number) for number in range(8)])
+
+        for name in names:
+            CountingStorage.decode_count = 0
+            self.read(name)
+            self.assertLessEqual(CountingStorage.decode_count, self.settings["KEYFRAME_INTERVAL"])
+
+    def test_deleting_keyframe_preserves_chain(self):
+        data = [_get_text(number) for number in range(8)]
+        names = self.create_chain(data)
+        keyframes = self.storage._get_manifest(names[0]).keyframes
+
+        for keyframe in sorted(keyframes):
+            index = [os.path.basename(name) for name in names].index(keyframe)
+            self.storage.delete(names[index])
+            del names[index], data[index]
+
+        self.assertListEqual([self.read(name) for name in names], data)
+
+    def test_deleting_final_member_removes_index(self):
+        names = self.create_chain([_get_text(number) for number in range(4)])
+
+        for name in names:
+            self.storage.delete(name)
+
+        self.assertFalse(os.path.exists(os.path.join(self.location, "000001")))
+
+    def test_threshold_adds_keyframes(self):
+        app_settings.KEYFRAME_INTERVAL, app_settings.KEYFRAME_THRESHOLD = 0, 1
+        names = self.create_chain([_get_text(number) for number in range(4)])
+        expected = {os.path.basename(name) for name in names[:-1]}
+
+        self.assertSetEqual(self.storage._get_manifest(names[0]).keyframes, expected)
+
+    def test_rebuild_adds_keyframes(self):
+        app_settings.KEYFRAME_INTERVAL = 0
+        data = [_get_text(number) for number in range(8)]
+        names = self.create_chain(data)
+        self.assertSetEqual(self.storage._get_manifest(names[0]).keyframes, set())
+
+        app_settings.KEYFRAME_INTERVAL = 3
+        keyframes = self.storage.rebuild(names[0])
+
+        self.assertEqual(keyframes, 3)
+        self.assertListEqual([self.read(name) for name in names], data)
+
+
+class ManifestTest(StorageTestCase):
+    settings = {"KEYFRAME_INTERVAL": 3, "REVISION_CACHE_SIZE": 0}
+
+    def test_manifest_describes_chain(self):
+        names = self.create_chain([_get_text(number) for number in range(5)])
+
+        manifest = self.storage._get_manifest(names[0])
+
+        self.assertListEqual(manifest.names, [os.path.basename(name) for name in reversed(names)])
+        for member in manifest.members:
+            path = self.storage.path(os.path.join("000001", member["name"]))
+            self.assertEqual(member["size"], os.path.getsize(path))
+            self.assertEqual(member["codec"], deltas.Codec.for_file(path).name)
+        self.assertListEqual([member["keyframe"] for member in manifest.members], [True, False, True, False, False])
+
+    def test_chains_are_read_without_listing_directory(self):
+        data = [_get_text(number) for number in range(3)]
+        names = self.create_chain(data)
+        self.storage.listdir = None
+
+        self.create_chain([_get_text(3)], start=4)
+        self.storage.delete(names[1])
+
+        self.assertListEqual([self.read(name) for name in (names[0], names[2])], [data[0], data[2]])
+
+    def test_chain_without_manifest_is_migrated(self):
+        data = [_get_text(number) for number in range(5)]
+        names = self.create_chain(data)
+        manifest = self.storage._get_manifest(names[0])
+        keyframes = manifest.keyframes
+        os.unlink(manifest.path)
+        os.unlink(os.path.join(self.location, "000001", ".manifests"))
+        with open(os.path.splitext(manifest.path)[0] + ".keyframes", "w") as index:
+            index.writelines("{0:s}\n".format(keyframe) for keyframe in keyframes)
+
+        self.storage.delete(names[4])
+
+        self.assertTrue(os.path.exists(manifest.path))
+        self.assertSetEqual(self.storage._get_manifest(names[0]).keyframes, keyframes)
+        self.assertListEqual([self.read(name) for name in names[:4]], data[:4])
+
+
+class DeduplicationTest(StorageTestCase):
+    settings = {"KEYFRAME_INTERVAL": 0, "REVISION_CACHE_SIZE": 0}
+
+    def test_repeated_revision_shares_predecessor(self):
+        data = [_get_text(0), _get_text(1), _get_text(1)]
+
+        names = self.create_chain(data)
+
+        self.assertTrue(os.path.samefile(self.storage.path(names[1]), self.storage.path(names[2])))
+        self.assertListEqual([self.read(name) for name in names], data)
+
+    def test_identical_files_share_storage_across_chains(self):
+        first = self.create_chain([_get_text(0)], root="first")
+        second = self.create_chain([_get_text(0)], root="second")
+
+        self.assertTrue(os.path.samefile(self.storage.path(first[0]), self.storage.path(second[0])))
+
+    def test_deleting_shared_revision_preserves_others(self):
+        data = [_get_text(0), _get_text(1), _get_text(1), _get_text(2)]
+        names = self.create_chain(data)
+
+        self.storage.delete(names[2])
+
+        self.assertListEqual([self.read(name) for name in names[:2] + names[3:]], data[:2] + data[3:])
+
+    def test_unreferenced_content_is_released(self):
+        first = self.create_chain([_get_text(0)], root="first")
+        second = self.create_chain([_get_text(0), _get_text(1)], root="second")
+        blobs = os.path.join(self.location, "blobs")
+
+        self.storage.delete(first[0])
+        self.assertEqual(sum(len(files) for _, _, files in os.walk(blobs)), 1)
+
+        self.storage.delete_many(second)
+        self.assertEqual(sum(len(files) for _, _, files in os.walk(blobs)), 0)
+
+
+class SpoolTest(StorageTestCase):
+    settings = {"KEYFRAME_INTERVAL": 0, "REVISION_CACHE_SIZE": 0}
+
+    def test_spooled_content_is_encoded_in_place(self):
+        data = [_get_text(0), _get_text(1)]
+        spooled = [RemoteFile.spool(io.BytesIO(datum)) for datum in data]
+        try:
+            names = [self.storage.save(os.path.join("000001", "chain.{0:06x}".format(number)), content)
+                     for number, content in enumerate(spooled, 1)]
+
+            self.assertListEqual([self.read(name) for name in names], data)
+            self.assertListEqual([content.size for content in spooled], [len(datum) for datum in data])
+            for content in spooled:
+                self.assertTrue(os.path.exists(content.file.name))
+        finally:
+            for content in spooled:
+                content.close()
+
+
+class BulkDeletionTest(StorageTestCase):
+    settings = {"KEYFRAME_INTERVAL": 4, "REVISION_CACHE_SIZE": 0}
+
+    def test_deleting_range_preserves_remainder(self):
+        data = [_get_text(number) for number in range(10)]
+        names = self.create_chain(data)
+
+        self.storage.delete_many(names[3:7])
+
+        self.assertListEqual([self.read(name) for name in names[:3] + names[7:]], data[:3] + data[7:])
+        self.assertFalse(any(self.storage.exists(name) for name in names[3:7]))
+
+    def test_deleting_scattered_members_preserves_remainder(self):
+        data = [_get_text(number) for number in range(10)]
+        names = self.create_chain(data)
+        targets = {0, 2, 3, 6, 9}
+
+        self.storage.delete_many([names[index] for index in targets])
+
+        remainder = [index for index in range(10) if index not in targets]
+        self.assertListEqual([self.read(names[index]) for index in remainder], [data[index] for index in remainder])
+
+    def test_deleting_range_decodes_chain_once(self):
+        names = self.create_chain([_get_text(number) for number in range(10)])
+
+        CountingStorage.decode_count = 0
+        self.storage.delete_many(names[1:9])
+
+        self.assertLessEqual(CountingStorage.decode_count, len(names))
+
+    def test_deleting_chain_requires_no_decoding(self):
+        names = self.create_chain([_get_text(number) for number in range(5)])
+
+        CountingStorage.decode_count = 0
+        self.storage.delete_many(names)
+
+        self.assertEqual(CountingStorage.decode_count, 0)
+        self.assertFalse(os.path.exists(os.path.join(self.location, "000001")))
+
+    def test_failed_recoding_removes_decoded_files(self):
+        names = self.create_chain([_get_text(number) for number in range(6)])
+        decoded = []
+
+        class FailingStorage(CountingStorage):
+            @classmethod
+            def _decode(cls, source, base=None, unlink_base=False):
+                decoded.append(super(FailingStorage, cls)._decode(source, base, unlink_base))
+                return decoded[-1]
+
+            @staticmethod
+            def _encode(source, destination, base=None, unlink_source=False):
+                raise IOError("Encoding failed.")
+
+        self.assertRaises(IOError, FailingStorage(location=self.location).delete_many, names[1:3])
+        self.assertTrue(decoded)
+        self.assertFalse(any(os.path.exists(path) for path in decoded))
+
+
+class RevisionCacheTest(StorageTestCase):
+    settings = {"REVISION_CACHE_DIR": None, "REVISION_CACHE_SIZE": 20 * 1024}
+
+    def test_repeated_reads_hit_cache(self):
+        data = [_get_text(number) for number in range(3)]
+        names = self.create_chain(data)
+        self.read(names[0])
+
+        CountingStorage.decode_count = 0
+        content = self.read(names[0])
+
+        self.assertEqual(content, data[0])
+        self.assertEqual(CountingStorage.decode_count, 0)
+        self.assertEqual((self.storage.cache.hits, self.storage.cache.misses), (1, 1))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        names = self.create_chain([(_get_text(number) * 4)[:6144] for number in range(4)])
+        for name in names[:3]:
+            self.read(name)
+        self.read(names[0])
+
+        self.read(names[3])
+
+        cached = [self.storage.cache.get(name) for name in names]
+        self.assertListEqual([stream is not None for stream in cached], [True, False, True, True])
+        for stream in cached:
+            if stream is not None:
+                stream.close()
+
+    def test_oversized_files_are_not_cached(self):
+        names = self.create_chain([_get_text(0) * 16])
+
+        self.read(names[0])
+
+        self.assertIsNone(self.storage.cache.get(names[0]))
+
+    def test_deletion_invalidates_entry(self):
+        data = [_get_text(number) for number in range(3)]
+        names = self.create_chain(data)
+        self.read(names[2])
+
+        self.storage.delete(names[2])
+        self.create_chain([data[0]], start=3)
+
+        self.assertEqual(self.read(names[2]), data[0])
+
+    def test_files_on_other_file_systems_are_staged(self):
+        path = os.path.join(self.location, "decoded")
+        with io.open(path, "wb") as stream:
+            stream.write(_get_text(0))
+        entry = os.path.join(self.storage.cache.location, "000001", "chain.000001")
+        rename, copyfileobj, visible = os.rename, shutil.copyfileobj, []
+
+        def _rename(source, destination):
+            if source == path:
+                raise OSError(errno.EXDEV, "Invalid cross-device link")
+            rename(source, destination)
+
+        def _copyfileobj(source, destination, *args):
+            visible.append(os.path.exists(entry))
+            copyfileobj(source, destination, *args)
+        os.rename, shutil.copyfileobj = _rename, _copyfileobj
+        try:
+            cached = self.storage.cache.put("000001/chain.000001", path)
+        finally:
+            os.rename, shutil.copyfileobj = rename, copyfileobj
+
+        with cached:
+            self.assertEqual(cached.read(), _get_text(0))
+        self.assertListEqual(visible, [False])
+        self.assertFalse(os.path.exists(path))
+        self.assertListEqual(os.listdir(os.path.dirname(entry)), ["chain.000001"])
+
+    def test_cache_is_scanned_once(self):
+        walk, scans = os.walk, []
+
+        def _walk(top, *args, **kwargs):
+            scans.append(top)
+            return walk(top, *args, **kwargs)
+        os.walk = _walk
+        try:
+            names = self.create_chain([_get_text(number) for number in range(4)])
+            for name in names:
+                self.read(name)
+        finally:
+            os.walk = walk
+
+        self.assertEqual(scans.count(self.storage.cache.location), 1)
+
+
+class StreamingTest(StorageTestCase):
+    settings = {"KEYFRAME_INTERVAL": 3, "REVISION_CACHE_SIZE": 0}
+
+    def test_revisions_round_trip(self):
+        data = [_get_text(number) for number in range(5)]
+        names = self.create_chain(data)
+
+        for name, datum in zip(names, data):
+            with self.storage.open_stream(name) as stream:
+                self.assertEqual(stream.read(), datum)
+
+    def test_stream_is_unaffected_by_deletion(self):
+        data = [_get_text(number) for number in range(3)]
+        names = self.create_chain(data)
+
+        with self.storage.open_stream(names[0]) as stream:
+            self.storage.delete(names[1])
+            content = stream.read()
+
+        self.assertEqual(content, data[0])
+
+    def test_corrupt_member_raises_error(self):
+        names = self.create_chain([_get_text(number) for number in range(3)])
+        with open(self.storage.path(names[1]), "r+b") as member:
+            member.seek(8)
+            member.write("\xff" * 64)
+
+        with self.storage.open_stream(names[0]) as stream:
+            with self.assertRaises(IOError):
+                stream.read()
+
+
+class ConcurrencyTest(StorageTestCase):
+    settings = {"KEYFRAME_INTERVAL": 0, "REVISION_CACHE_SIZE": 0}
+
+    def tearDown(self):
+        CountingStorage.decode_delay = 0
+        super(ConcurrencyTest, self).tearDown()
+
+    def test_readers_share_chain(self):
+        data = [_get_text(number) for number in range(3)]
+        names = self.create_chain(data)
+        CountingStorage.decode_delay = 0.1
+        readers = 4
+        results = {}
+
+        def read(index):
+            results[index] = self.read(names[-1])
+
+        threads = [threading.Thread(target=read, args=(index,)) for index in range(readers)]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+
+        self.assertListEqual([results[index] for index in range(readers)], [data[-1]] * readers)
+        self.assertLess(elapsed, 0.75 * readers * CountingStorage.decode_delay)
+
+    def test_shared_locks_do_not_block(self):
+        path = os.path.join(self.location, "chain.lock")
+
+        with Lock(path, shared=True):
+            acquired, thread = self._lock_in_thread(path, shared=True)
+            self.assertTrue(acquired.wait(1))
+        thread.join()
+
+    def test_exclusive_lock_blocks_readers(self):
+        path = os.path.join(self.location, "chain.lock")
+
+        with Lock(path):
+            acquired, thread = self._lock_in_thread(path, shared=True)
+            self.assertFalse(acquired.wait(0.2))
+        thread.join()
+
+        self.assertTrue(acquired.is_set())
+
+    @staticmethod
+    def _lock_in_thread(path, shared):
+        acquired = threading.Event()
+
+        def lock():
+            with Lock(path, shared=shared):
+                acquired.set()
+
+        thread = threading.Thread(target=lock)
+        thread.start()
+        return acquired, thread
+
+
+@skipIf(deltas.bsdiff4 is None, "bsdiff4 is not installed")
+class CodecTest(StorageTestCase):
+    settings = {"DELTA_CODEC": "bdr.utils.deltas.BsdiffCodec", "KEYFRAME_INTERVAL": 0, "REVISION_CACHE_SIZE": 0}
+
+    def test_revisions_round_trip(self):
+        data = [_get_text(number) for number in range(4)]
+
+        names = self.create_chain(data)
+
+        self.assertListEqual([self.read(name) for name in names], data)
+
+    def test_chains_are_decoded_in_memory(self):
+        data = [_get_text(number) for number in range(4)]
+        names = self.create_chain(data)
+
+        CountingStorage.decode_count = 0
+        content = self.read(names[0])
+
+        self.assertEqual(content, data[0])
+        self.assertEqual(CountingStorage.decode_count, 0)
+
+    def test_buffers_round_trip(self):
+        codec = deltas.BsdiffCodec()
+        base, target = _get_text(0), _get_text(1)
+
+        self.assertEqual(codec.decode_buffer(codec.encode_buffer(target, base), base), target)
+        self.assertEqual(codec.decode_buffer(codec.encode_buffer(target)), target)
+
+    def test_mixed_codecs_round_trip(self):
+        data = [_get_text(number) for number in range(6)]
+
+        names = self.create_chain(data[:3])
+        app_settings.DELTA_CODEC = "bdr.utils.deltas.XDeltaCodec"
+        names.extend(self.create_chain(data[3:], start=4))
+
+        self.assertListEqual([self.read(name) for name in names], data)
+
+    def test_large_files_use_xdelta(self):
+        app_settings.BUFFERED_CODEC_LIMIT, limit = 1024, app_settings.BUFFERED_CODEC_LIMIT
+        try:
+            names = self.create_chain([_get_text(number) for number in range(2)])
+        finally:
+            app_settings.BUFFERED_CODEC_LIMIT = limit
+
+        self.assertIsInstance(deltas.Codec.for_file(self.storage.path(names[0])), deltas.XDeltaCodec)
+
+    def test_large_files_round_trip(self):
+        codec = deltas.BsdiffCodec()
+        paths = [os.path.join(self.location, name) for name in ("base", "target", "encoded", "decoded")]
+        for path, number in zip(paths, range(2)):
+            with io.open(path, "wb") as stream:
+                stream.write(_get_text(number))
+        app_settings.BUFFERED_CODEC_LIMIT, limit = 1024, app_settings.BUFFERED_CODEC_LIMIT
+        try:
+            codec.encode(paths[1], paths[2], paths[0])
+            codec.decode(paths[2], paths[3], paths[0])
+        finally:
+            app_settings.BUFFERED_CODEC_LIMIT = limit
+
+        with io.open(paths[3], "rb") as stream:
+            self.assertEqual(stream.read(), _get_text(1))
+
+
+def _get_text(seed, length=4096):
+    return "".join("{0:d}:{1:d}\n".format(seed, line) if line % 50 == 0 else "{0:d}\n".format(line)
+                   for line in range(length // 8))
@@ -0,0 +1,406 @@
+"""
+Tests for the bdr.utils.transports module.
+
+This module has no public exports.
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from datetime import datetime
+from hashlib import sha1
+import os
+import shutil
+import struct
+import tempfile
+import threading
+
+from django.test import SimpleTestCase
+
+from .. import app_settings
+from ..utils import RemoteFile, TemporaryLink, utc
+from ..utils.transports import (AuthenticationError, ConnectionPool, FtpTransport, HttpTransport, LocalTransport,
+                                NotFoundError, TransportError)
+from ..utils.zsync import md4, rsum
+
+__all__ = []
+__author__ = "Michael Winter (mail@michael-winter.me.uk)"
+__license__ = """
+    Biological Dataset Repository: data archival and retrieval.
+    Copyright (C) 2015  Michael Winter
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+    """
+
+
+class ResourceHandler(BaseHTTPRequestHandler):
+    """
+    Serves a single resource, honouring conditional and range requests, and
+    records each request made.
+
+    If the server has a ``fail_after`` attribute, the connection is closed
+    after that many bytes of the resource have been sent. If it has a
+    ``control`` attribute, that is served as the zsync control file of the
+    resource. If its ``reject_ranges`` attribute is set, range requests fail.
+    """
+
+    body = "".join("line {0:d}\n".format(number) for number in xrange(1024))
+    etag = '"v1"'
+    last_modified = "Thu, 01 Jan 2015 00:00:00 GMT"
+    protocol_version = "HTTP/1.1"
+
+    # noinspection PyPep8Naming
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path, dict(self.headers)))
+        self.server.clients.add(self.client_address)
+        if self.path == "/resource.zsync" and self.server.control is not None:
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(self.server.control)))
+            self.end_headers()
+            self.wfile.write(self.server.control)
+            return
+        if self.path != "/resource":
+            self.send_error(404)
+            return
+        if self.headers.get("Range") and self.server.reject_ranges:
+            self.send_error(416)
+            return
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.send_header("ETag", self.etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        offset, end = 0, len(self.body)
+        if self.headers.get("Range") and self.headers.get("If-Range") == self.etag:
+            first, last = self.headers["Range"][len("bytes="):].split("-")
+            offset, end = int(first), int(last) + 1 if last else end
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {0:d}-{1:d}/{2:d}".format(offset, end - 1, len(self.body)))
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - offset))
+        self.send_header("ETag", self.etag)
+        self.send_header("Last-Modified", self.last_modified)
+        self.end_headers()
+        if self.server.fail_after is not None:
+            self.wfile.write(self.body[offset:min(end, self.server.fail_after)])
+            self.close_connection = True
+        else:
+            self.wfile.write(self.body[offset:end])
+
+    def log_message(self, *args):
+        pass
+
+
+class ResourceServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients abandoning interrupted downloads reset their connections.
+        pass
+
+
+class HttpTransportTest(SimpleTestCase):
+    def setUp(self):
+        self.server = ResourceServer(("127.0.0.1", 0), ResourceHandler)
+        self.server.requests = []
+        self.server.clients = set()
+        self.server.fail_after = None
+        self.server.control = None
+        self.server.reject_ranges = False
+        self.spool, app_settings.SPOOL_DIR = app_settings.SPOOL_DIR, tempfile.mkdtemp()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://127.0.0.1:{0:d}/resource".format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(app_settings.SPOOL_DIR)
+        app_settings.SPOOL_DIR = self.spool
+
+    def test_metadata_and_content_share_request(self):
+        transport = HttpTransport(self.url, "", "")
+
+        self.assertEqual(transport.get_size(), len(ResourceHandler.body))
+        self.assertEqual(transport.get_modification_date(), datetime(2015, 1, 1, tzinfo=utc))
+        self.assertEqual(transport.get_etag(), ResourceHandler.etag)
+        self.assertEqual(transport.get_content().read(), ResourceHandler.body)
+        self.assertEqual(transport.get_digest(), sha1(ResourceHandler.body).hexdigest())
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_matching_etag_is_unchanged(self):
+        transport = HttpTransport(self.url, "", "")
+
+        self.assertFalse(transport.is_modified(ResourceHandler.etag))
+        self.assertEqual(self.server.requests[0][2].get("if-none-match"), ResourceHandler.etag)
+
+    def test_modified_resource_is_fetched_with_check(self):
+        transport = HttpTransport(self.url, "", "")
+
+        self.assertTrue(transport.is_modified('"v0"', datetime(2014, 1, 1, tzinfo=utc)))
+        self.assertEqual(transport.get_content().read(), ResourceHandler.body)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertIn("if-modified-since", self.server.requests[0][2])
+
+    def test_missing_resource_raises_error(self):
+        transport = HttpTransport(self.url + "/missing", "", "")
+
+        with self.assertRaises(NotFoundError):
+            transport.get_size()
+
+    def test_pooled_transports_share_connection(self):
+        with ConnectionPool():
+            for _ in range(3):
+                transport = HttpTransport(self.url, "", "")
+                transport.get_content()
+                transport.close()
+
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len(self.server.clients), 1)
+
+    def test_failed_download_is_resumed(self):
+        self.server.fail_after = 3000
+        with self.assertRaises(TransportError):
+            HttpTransport(self.url, "", "").get_content()
+
+        self.server.fail_after = None
+        transport = HttpTransport(self.url, "", "")
+        content = transport.get_content().read()
+
+        self.assertEqual(content, ResourceHandler.body)
+        self.assertEqual(transport.get_digest(), sha1(ResourceHandler.body).hexdigest())
+        self.assertEqual(self.server.requests[-1][2].get("range"), "bytes=3000-")
+        self.assertListEqual(os.listdir(app_settings.SPOOL_DIR), [])
+
+    def test_partial_download_of_changed_resource_is_discarded(self):
+        self.server.fail_after = 3000
+        with self.assertRaises(TransportError):
+            HttpTransport(self.url, "", "").get_content()
+
+        self.server.fail_after = None
+        ResourceHandler.last_modified, last_modified = "Fri, 02 Jan 2015 00:00:00 GMT", ResourceHandler.last_modified
+        try:
+            content = HttpTransport(self.url, "", "").get_content().read()
+        finally:
+            ResourceHandler.last_modified = last_modified
+
+        self.assertEqual(content, ResourceHandler.body)
+        self.assertNotIn("range", self.server.requests[-1][2])
+
+    def test_download_is_segmented(self):
+        transport = HttpTransport(self.url, "", "")
+        transport.segments, transport.min_segment_size = 4, 1024
+        content = transport.get_content().read()
+
+        self.assertEqual(content, ResourceHandler.body)
+        self.assertEqual(transport.get_digest(), sha1(ResourceHandler.body).hexdigest())
+        ranges = sorted(headers["range"] for _, _, headers in self.server.requests if "range" in headers)
+        self.assertEqual(len(ranges), 4)
+        self.assertIn("bytes=0-{0:d}".format(-(-len(content) // 4) - 1), ranges)
+
+    def test_segments_are_no_smaller_than_minimum(self):
+        transport = HttpTransport(self.url, "", "")
+        transport.segments, transport.min_segment_size = 4, len(ResourceHandler.body) // 2
+        content = transport.get_content().read()
+
+        self.assertEqual(content, ResourceHandler.body)
+        self.assertEqual(len([headers for _, _, headers in self.server.requests if "range" in headers]), 2)
+
+    def test_changed_blocks_are_fetched(self):
+        body = ResourceHandler.body
+        seed = tempfile.TemporaryFile()
+        seed.write(b"header\n" + body[:4000] + body[4000:4100].upper() + body[4100:])
+        self.server.control = _make_control(body, 64)
+        transport = HttpTransport(self.url, "", "")
+        transport.zsync_url, transport.seed = self.url + ".zsync", lambda: seed
+        content = transport.get_content().read()
+
+        self.assertEqual(content, body)
+        self.assertEqual(transport.get_digest(), sha1(body).hexdigest())
+        ranges = [headers["range"] for _, _, headers in self.server.requests if "range" in headers]
+        self.assertEqual(len(ranges), 1)
+        first, last = (int(value) for value in ranges[0][len("bytes="):].split("-"))
+        self.assertLessEqual(last - first + 1, 256)
+
+    def test_mismatched_rebuild_is_downloaded_in_full(self):
+        seed = tempfile.TemporaryFile()
+        seed.write(ResourceHandler.body)
+        self.server.control = _make_control(ResourceHandler.body, 64).replace(
+            sha1(ResourceHandler.body).hexdigest(), sha1(b"").hexdigest())
+        transport = HttpTransport(self.url, "", "")
+        transport.zsync_url, transport.seed = self.url + ".zsync", lambda: seed
+
+        self.assertEqual(transport.get_content().read(), ResourceHandler.body)
+        self.assertEqual(transport.get_digest(), sha1(ResourceHandler.body).hexdigest())
+
+    def test_rejected_block_request_is_downloaded_in_full(self):
+        body = ResourceHandler.body
+        seed = tempfile.TemporaryFile()
+        seed.write(body[:4000] + body[4000:4100].upper() + body[4100:])
+        self.server.control = _make_control(body, 64)
+        self.server.reject_ranges = True
+        transport = HttpTransport(self.url, "", "")
+        transport.zsync_url, transport.seed = self.url + ".zsync", lambda: seed
+
+        self.assertEqual(transport.get_content().read(), body)
+        self.assertEqual(transport.get_digest(), sha1(body).hexdigest())
+
+    def test_missing_control_file_is_ignored(self):
+        transport = HttpTransport(self.url, "", "")
+        transport.zsync_url, transport.seed = self.url + ".zsync", lambda: tempfile.TemporaryFile()
+
+        self.assertEqual(transport.get_content().read(), ResourceHandler.body)
+
+
+def _make_control(data, block_size):
+    """Return a zsync control file describing ``data``."""
+    blocks = [data[offset:offset + block_size].ljust(block_size, b"\0")
+              for offset in xrange(0, len(data), block_size)]
+    header = "zsync: 0.6.2\nBlocksize: {0:d}\nLength: {1:d}\nHash-Lengths: 1,4,16\nSHA-1: {2:s}\n\n".format(
+        block_size, len(data), sha1(data).hexdigest())
+    return header + b"".join(struct.pack(">I", rsum(block)) + md4(block) for block in blocks)
+
+
+class FakeFtpConnection(object):
+    """A control connection that answers FEAT and directory listings."""
+
+    def __init__(self, features, listing):
+        self.commands = []
+        self.features = features
+        self.listing = listing
+
+    def sendcmd(self, command):
+        self.commands.append(command)
+        return "211-Features:\r\n{0:s}\r\n211 End".format("\r\n".join(" " + feature for feature in self.features))
+
+    def retrlines(self, command, callback):
+        self.commands.append(command)
+        for line in self.listing:
+            callback(line)
+
+
+class FtpTransportTest(SimpleTestCase):
+    def _get_transport(self, features, listing):
+        transport = FtpTransport("ftp://ftp.example.org/pub/data/", "", "")
+        transport._features = None
+        transport._FtpTransport__connection = FakeFtpConnection(features, listing)
+        return transport
+
+    def test_directory_is_listed_with_mlsd(self):
+        transport = self._get_transport(["MLST type*;size*;modify*;"], [
+            "type=cdir;modify=20150101000000; .",
+            "type=file;size=6;modify=20150101000000; a.txt",
+            "type=dir;modify=20150101000000; sub",
+            "Type=File;Size=7;Modify=20150102000000.5; b c.txt",
+        ])
+
+        self.assertListEqual(transport.get_archive().keys(), ["a.txt", "b c.txt"])
+        self.assertEqual(transport.get_size(), 13)
+        self.assertEqual(transport.get_modification_date(), datetime(2015, 1, 2, tzinfo=utc))
+        self.assertListEqual(transport._FtpTransport__connection.commands, ["FEAT", "MLSD"])
+        self.assertRaises(TransportError, transport.get_content)
+
+    def test_directory_is_listed_with_list(self):
+        year = datetime.now(utc).year
+        transport = self._get_transport([], [
+            "total 3",
+            "-rw-r--r--   1 ftp      ftp             6 Jan  1  2015 a.txt",
+            "drwxr-xr-x   2 ftp      ftp          4096 Jan  1  2015 sub",
+            "-rw-r--r--   1 ftp      ftp             7 Jan  2 00:00 b.txt",
+        ])
+
+        self.assertListEqual(transport.get_archive().keys(), ["a.txt", "b.txt"])
+        self.assertEqual(transport.get_size(), 13)
+        self.assertEqual(transport.get_modification_date(), datetime(year, 1, 2, tzinfo=utc))
+
+    def test_directory_digest_reflects_listing(self):
+        listing = ["type=file;size=6;modify=20150101000000; a.txt"]
+        digest = self._get_transport(["MLST"], listing).get_digest()
+
+        self.assertEqual(self._get_transport(["MLST"], listing).get_digest(), digest)
+        self.assertNotEqual(self._get_transport(["MLST"], ["type=file;size=6;modify=20150103000000; a.txt"])
+                            .get_digest(), digest)
+
+
+class LocalTransportTest(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, "mirror", "sub"))
+        for name, data in (("a.txt", "first\n"), ("sub/b.txt", "second\n")):
+            with open(os.path.join(self.root, "mirror", name), "wb") as stream:
+                stream.write(data)
+        os.utime(os.path.join(self.root, "mirror", "a.txt"), (1420070400, 1420070400))
+        os.utime(os.path.join(self.root, "mirror", "sub", "b.txt"), (1420156800, 1420156800))
+        self.settings = app_settings.LOCAL_ROOTS, app_settings.SPOOL_DIR
+        app_settings.LOCAL_ROOTS, app_settings.SPOOL_DIR = [self.root], os.path.join(self.root, "spool")
+
+    def tearDown(self):
+        app_settings.LOCAL_ROOTS, app_settings.SPOOL_DIR = self.settings
+        shutil.rmtree(self.root)
+
+    def test_file_is_read_in_place(self):
+        path = os.path.join(self.root, "mirror", "a.txt")
+        transport = LocalTransport("file://" + path, "", "")
+
+        self.assertEqual(transport.get_size(), 6)
+        self.assertEqual(transport.get_modification_date(), datetime(2015, 1, 1, tzinfo=utc))
+        self.assertEqual(transport.get_content().name, path)
+        self.assertEqual(transport.get_digest(), sha1("first\n").hexdigest())
+        self.assertListEqual(transport.get_archive().keys(), ["a.txt"])
+
+    def test_directory_is_read_as_archive(self):
+        transport = LocalTransport("file://" + os.path.join(self.root, "mirror"), "", "")
+
+        self.assertEqual(transport.get_size(), 13)
+        self.assertEqual(transport.get_modification_date(), datetime(2015, 1, 2, tzinfo=utc))
+        archive = transport.get_archive()
+        self.assertListEqual(archive.keys(), ["a.txt", "sub/b.txt"])
+        self.assertEqual(archive["sub/b.txt"].file.read(), "second\n")
+        self.assertRaises(TransportError, transport.get_content)
+
+    def test_directory_digest_reflects_listing(self):
+        url = "file://" + os.path.join(self.root, "mirror")
+        digest = LocalTransport(url, "", "").get_digest()
+        os.utime(os.path.join(self.root, "mirror", "a.txt"), None)
+
+        self.assertNotEqual(LocalTransport(url, "", "").get_digest(), digest)
+
+    def test_paths_outside_roots_are_refused(self):
+        app_settings.LOCAL_ROOTS = [os.path.join(self.root, "mirror", "sub")]
+        transport = LocalTransport("file://" + os.path.join(self.root, "mirror", "a.txt"), "", "")
+
+        self.assertRaises(AuthenticationError, transport.get_size)
+
+    def test_missing_file_raises_error(self):
+        transport = LocalTransport("file://" + os.path.join(self.root, "missing"), "", "")
+
+        self.assertRaises(NotFoundError, transport.get_size)
+
+    def test_members_are_spooled_without_copying(self):
+        member = LocalTransport("file://" + os.path.join(self.root, "mirror"), "", "").get_archive()["a.txt"]
+
+        spooled = RemoteFile.spool(RemoteFile(member.file, member.name, member.size, member.mtime, path=member.path))
+        try:
+            self.assertEqual(spooled.digest, sha1("first\n").hexdigest())
+            self.assertEqual(spooled.read(), "first\n")
+            self.assertIsInstance(spooled.file, TemporaryLink)
+            self.assertEqual(os.path.dirname(spooled.file.name), app_settings.SPOOL_DIR)
+        finally:
+            spooled.close()
+        self.assertFalse(os.path.exists(spooled.file.name))
@@ -0,0 +1,57 @@
+"""
+Tests for the bdr.utils.zsync module.
+
+This module has no public exports.
+"""
+
+import tempfile
+
+from django.test import SimpleTestCase
+
+from ..utils.zsync import ControlFile, _md4, get_runs, match_blocks, md4, rsum
+
+__all__ = []
+__author__ = "Michael Winter (mail@michael-winter.me.uk)"
+__license__ = """
+    Biological Dataset Repository: data archival and retrieval.
+    Copyright (C) 2015  Michael Winter
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+    """
+
+
+class ZsyncTest(SimpleTestCase):
+    def test_md4_matches_reference_digests(self):
+        for data, expected in (("", "31d6cfe0d16ae931b73c59d7e0c089c0"),
+                               ("abc", "a448017aaf21d8525fc10ae87aa6729d"),
+                               ("1234567890" * 8, "e33b4ddc9c38f2199c3e7b164fcc0536")):
+            self.assertEqual(_md4(data).encode("hex"), expected)
+            self.assertEqual(md4(data).encode("hex"), expected)
+
+    def test_shifted_blocks_are_found(self):
+        data = "".join("{0:04d}".format(number) for number in xrange(64))
+        blocks = [data[offset:offset + 16] for offset in xrange(0, len(data), 16)]
+        control = ControlFile(16, len(data), "", [(rsum(block), md4(block)) for block in blocks], 4, 16)
+        seed = tempfile.TemporaryFile()
+        seed.write("inserted" + data[:100] + "changed!" + data[108:])
+
+        offsets = match_blocks(control, seed)
+        self.assertEqual(offsets[:6], [8, 24, 40, 56, 72, 88])
+        self.assertEqual(offsets[6], None)
+        self.assertEqual(offsets[7:], [8 + 16 * index for index in xrange(7, 16)])
+        self.assertEqual(get_runs(control, offsets), [(0, 95, 8), (96, 111, None), (112, 255, 120)])
+
+    def test_compressed_resources_are_rejected(self):
+        self.assertRaises(ValueError, ControlFile.parse, "zsync: 0.6.2\nZ-Map2: 4\nBlocksize: 16\n\n")
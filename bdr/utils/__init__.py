@@ -3,9 +3,22 @@ This package contains various utilities used by the repository.
 """
 
 from datetime import datetime, timedelta, tzinfo
+from hashlib import sha1 as hash_algorithm
+from tempfile import NamedTemporaryFile, mkstemp
+import errno
+import io
+import os
+import tempfile
 
 from django.core.files import File
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .. import app_settings
+
 __all__ = ["utc", "File"]
 __author__ = "Michael Winter (mail@michael-winter.me.uk)"
 __license__ = """
@@ -27,19 +40,132 @@ __license__ = """
     51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
     """
 
+_CHUNK_SIZE = 64 * 1024
+_FICLONE = 0x40049409
+"""The Linux ioctl request that clones the extents of one file into another."""
+
 
 class RemoteFile(File):
     """
     A file-like object that extends `File` to add tracking modification time.
+
+    The SHA-1 digest of the content may also be recorded. Files created by
+    :py:meth:`spool` are held in a named temporary file with a known digest,
+    and are read in place by the delta storage rather than copied again.
+
+    If the content is exactly that of a file on the local file system, the
+    path to that file may also be given, allowing the content to be spooled
+    without copying it.
     """
 
     # noinspection PyShadowingBuiltins
-    def __init__(self, file, name=None, size=-1, modified_time=None):
+    def __init__(self, file, name=None, size=-1, modified_time=None, digest=None, path=None):
         super(RemoteFile, self).__init__(file, name)
         self.modified_time = modified_time
+        self.digest = digest
+        self.path = path
         if size != -1:
             self.size = size
 
+    # noinspection PyShadowingBuiltins
+    @classmethod
+    def spool(cls, file, name=None, modified_time=None):
+        """
+        Copy the content of a file-like object, which need not be seekable,
+        into a named temporary file, computing its size and digest in the same
+        pass.
+
+        If ``file`` has a ``path`` attribute naming a local file, that file is
+        instead cloned (where the file system supports reflinks) or hard-linked
+        into the spool directory, and only read to compute its digest. Either
+        link is unaffected if the original is later replaced by renaming
+        another file over it, as rsync does, though a hard link does reflect
+        changes made to the original in place.
+
+        The temporary file is removed when the returned file is closed.
+
+        :param file: The file-like object to read.
+        :param name: (Optional) The name of the file.
+        :type name: str | None
+        :param modified_time: (Optional) The modification time of the file.
+        :type modified_time: datetime | None
+        :rtype: RemoteFile
+        """
+        digest, size = hash_algorithm(), 0
+        path = getattr(file, "path", None)
+        linked = cls._link(path) if path else None
+        if linked is not None:
+            for chunk in iter(lambda: linked.read(_CHUNK_SIZE), b""):
+                digest.update(chunk)
+                size += len(chunk)
+            linked.seek(0)
+            return cls(linked, name, size, modified_time, digest.hexdigest())
+
+        spooled = NamedTemporaryFile()
+        chunks = file.chunks(_CHUNK_SIZE) if hasattr(file, "chunks") else iter(lambda: file.read(_CHUNK_SIZE), b"")
+        try:
+            for chunk in chunks:
+                spooled.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+            spooled.flush()
+            spooled.seek(0)
+        except:
+            spooled.close()
+            raise
+        return cls(spooled, name, size, modified_time, digest.hexdigest())
+
+    @staticmethod
+    def _link(path):
+        """
+        Return a file in the spool directory that shares the content of the
+        file at ``path``, or None if neither a reflink nor a hard link can be
+        made.
+
+        :rtype: TemporaryLink | None
+        """
+        descriptor, target = mkstemp(dir=get_spool_dir())
+        try:
+            cloned = False
+            if fcntl is not None:
+                try:
+                    with io.open(path, "rb") as source:
+                        fcntl.ioctl(descriptor, _FICLONE, source.fileno())
+                    cloned = True
+                except (IOError, OSError):
+                    pass
+            if not cloned:
+                os.unlink(target)
+                try:
+                    os.link(path, target)
+                except OSError:
+                    return None
+        finally:
+            os.close(descriptor)
+        return TemporaryLink(target)
+
+
+class TemporaryLink(object):
+    """
+    A read-only file at a temporary path in the spool directory, which is
+    removed when the file is closed.
+    """
+
+    mode = "rb"
+
+    def __init__(self, path):
+        self.name = path
+        self._file = io.open(path, "rb")
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def close(self):
+        """Close the file and remove it from the spool directory."""
+        if not self._file.closed:
+            self._file.close()
+            os.unlink(self.name)
+
 
 class UTC(tzinfo):
     """Represents the Co-ordinated Universal Time zone."""
@@ -59,6 +185,22 @@ class UTC(tzinfo):
 utc = UTC()
 
 
+def get_spool_dir():
+    """
+    Return the directory named by the SPOOL_DIR setting, creating it if
+    necessary.
+
+    :rtype: str
+    """
+    directory = app_settings.SPOOL_DIR or os.path.join(tempfile.gettempdir(), "bdr-spool")
+    try:
+        os.makedirs(directory)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+    return directory
+
+
 def to_epoch(dt):
     """Convert a datetime to the number of second from epoch (1 January 1970)."""
     return (dt - _epoch).total_seconds()
@@ -1,25 +1,51 @@
 """
 A set of tools for accessing archive formats. The archive types supported
-out-of-the-box are those read by the gzip, zipfile and tarfile modules.
+out-of-the-box are gzip, bzip2, Zip and tar files, which may be compressed by
+any of the supported codecs. Files compressed with xz or Zstandard are also
+read if the backports.lzma or zstandard package, respectively, is installed.
+
+Files on the local file system, and listings of remote directories, can also
+be presented as archives by the LocalArchive and ListingArchive classes. These
+are not archive readers: they are returned by transports rather than selected
+according to the content of a file.
 
 Additional archive formats can be supported by subclassing Archive and adding
 the fully-qualified class name of the new type to the ARCHIVE_READERS list
-setting.
+setting. A reader is chosen by matching the start of a file with the
+signatures of each type, so new types should declare their signatures and
+extensions where they can.
 """
 
 from datetime import datetime
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 from UserDict import DictMixin
-import gzip
+import bz2
 import importlib
+import io
 import os
 import re
-import shutil
+import struct
 import tarfile
 import tempfile
 import zipfile
+import zlib
 
 from .. import app_settings
-from . import utc
+from . import RemoteFile, utc
+
+try:
+    from backports import lzma
+except ImportError:
+    lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_CHUNK_SIZE = 64 * 1024
+_HEADER_SIZE = 4096
+_readers = {}
 
 __all__ = ["Archive", "Member"]
 __author__ = "Michael Winter (mail@michael-winter.me.uk)"
@@ -51,28 +77,79 @@ class Archive(DictMixin, object):
     member of the archive, which can in turn be used to index the archive in
     order to retrieve that member.
     """
+
+    signatures = None
+    """
+    The byte strings with which files read by this type begin, or None if the
+    type cannot be recognised from the start of a file.
+    """
+    extensions = ()
+    """The file name extensions, in lower case, of files read by this type."""
+
     @classmethod
     def instance(cls, file_, path=None):
         """
         Return an archive capable of reading the given file.
 
+        The reader is chosen from the types named by the ARCHIVE_READERS
+        setting, which are imported once. The start of the file is read once
+        and matched against the signatures of each type; a type whose
+        signatures do not match is only tried if the name of the file has one
+        of its extensions. Types without signatures are tried last, in the
+        order in which they are named.
+
         :param file_: A file-like object containing the archive.
         :type  file_: file
         :param path: The path to the archive.
         :rtype: Archive
         """
         file_.seek(0)
-        for reader in app_settings.ARCHIVE_READERS:
-            namespaces = reader.split('.')
-            module = importlib.import_module('.'.join(namespaces[:-1]))
-
-            if hasattr(module, namespaces[-1]):
-                obj = getattr(module, namespaces[-1])(file_, path)
-                if obj.can_read():
-                    return obj
+        header = file_.read(_HEADER_SIZE)
+        name = (path or getattr(file_, "name", None) or "").lower()
+        readers = cls._get_readers()
+        matched = [reader for reader in readers if reader.signatures is not None and reader.can_read_header(header)]
+        hinted = [reader for reader in readers if reader.signatures is not None and reader not in matched and
+                  name.endswith(reader.extensions)]
+        for reader in matched + hinted + [reader for reader in readers if reader.signatures is None]:
+            file_.seek(0)
+            obj = reader(file_, path)
+            if obj.can_read():
+                return obj
 
         raise RuntimeError("BDR_ARCHIVE_READERS setting does not include catch-all reader.")
 
+    @classmethod
+    def can_read_header(cls, header):
+        """
+        Return True if a file with the given header may be read by this type;
+        otherwise False.
+
+        :param header: The leading bytes of the file.
+        :type header: bytes
+        :rtype: bool
+        """
+        return any(header.startswith(signature) for signature in cls.signatures or ())
+
+    @staticmethod
+    def _get_readers():
+        """
+        Return the types named by the ARCHIVE_READERS setting, importing them
+        the first time the setting is read.
+
+        :rtype: list of type
+        """
+        names = tuple(app_settings.ARCHIVE_READERS)
+        if names not in _readers:
+            readers = []
+            for reader in names:
+                namespaces = reader.split('.')
+                module = importlib.import_module('.'.join(namespaces[:-1]))
+
+                if hasattr(module, namespaces[-1]):
+                    readers.append(getattr(module, namespaces[-1]))
+            _readers[names] = readers
+        return _readers[names]
+
     def __init__(self, file_, path=None):
         """
         Create an archive, reading the specified file.
@@ -125,6 +202,24 @@ class Archive(DictMixin, object):
         """
         raise NotImplementedError
 
+    def members(self, select=None):
+        """
+        Iterate over the members of this archive in the order in which they
+        are stored.
+
+        Archives that are read in a single pass produce each member as it is
+        reached, so a member must be read before the next is requested.
+
+        :param select: (Optional) A function that, given the name of a member,
+                       returns True if that member should be produced. Members
+                       that are not selected are never read.
+        :type select: (str) -> bool
+        :rtype: collections.Iterator of Member
+        """
+        for key in self.keys():
+            if select is None or select(key):
+                yield self[key]
+
     @property
     def file(self):
         """
@@ -194,10 +289,33 @@ class Member(object):
         """
         return self._size
 
+    @property
+    def digest(self):
+        """
+        The SHA-1 digest of the decompressed data, if it was computed while
+        the member was read.
+
+        :rtype: str | None
+        """
+        return None
+
+    @property
+    def path(self):
+        """
+        The path to a local file holding exactly the data of this member, if
+        any.
+
+        :rtype: str | None
+        """
+        return None
+
 
 class CompressArchive(Archive):
     """An adaptor for reading Compress archives."""
 
+    signatures = (b"\x1f\x9d",)
+    extensions = (".z",)
+
     def __init__(self, file_, path=None):
         super(CompressArchive, self).__init__(file_, path)
         self._name = os.path.basename(self._path or file_.name)
@@ -258,14 +376,26 @@ class CompressArchive(Archive):
 
 
 class GzipArchive(Archive):
-    """An adaptor for reading Gzip format archives."""
+    """
+    An adaptor for reading Gzip format archives.
+
+    The archive is decompressed with zlib in large chunks. A file of several
+    concatenated gzip members is read as the concatenation of their data. BGZF
+    files, as used for sequence alignments and variant calls, consist of
+    small members that each record their compressed size; these are split
+    without being decompressed, and decompressed concurrently by the number of
+    threads given by the GZIP_THREADS setting.
+    """
+
+    signatures = (b"\x1f\x8b",)
+    extensions = (".gz",)
 
     def __init__(self, file_, path=None):
         """
         :param file_: A file-like object containing an archive.
         """
         super(GzipArchive, self).__init__(file_, path)
-        self._zip = None
+        self._readable = None
         self._name = re.sub(r'\.gz\w*$', '', os.path.basename(self._path or file_.name))
 
     def __getitem__(self, key):
@@ -273,22 +403,31 @@ class GzipArchive(Archive):
             raise IOError('Not a gzipped archive.')
         if key != self._name:
             raise KeyError('%s not found.' % key)
-        return GzipMember(self._name, 0, None, self._zip)
+        self._file.seek(0)
+        mtime = struct.unpack("<I", self._file.read(10)[4:8])[0]
+        self._file.seek(0)
+        data = RemoteFile.spool(_GzipStream(self._file, app_settings.GZIP_THREADS))
+        return SpooledMember(self._name, data.size, datetime.fromtimestamp(mtime, utc) if mtime else None, data)
 
     def can_read(self):
         """
         Return True if this instance can be used to read the archive; otherwise
         False.
+
+        Only the start of the archive is decompressed.
         """
-        if self._zip is None:
-            self._zip = gzip.GzipFile(fileobj=self._file, mode='rb')
+        if self._readable is None:
+            self._file.seek(0)
             try:
-                self._zip.read(1)
-            except IOError:
-                return False
+                header = self._file.read(_CHUNK_SIZE)
+                self._readable = header.startswith(b"\x1f\x8b")
+                if self._readable:
+                    zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(header)
+            except zlib.error:
+                self._readable = False
             finally:
-                self._zip.rewind()
-        return True
+                self._file.seek(0)
+        return self._readable
 
     def keys(self):
         """Return a copy of the list of member names."""
@@ -296,43 +435,530 @@ class GzipArchive(Archive):
             raise IOError('Not a gzipped archive.')
         return [self._name]
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self._zip.close()
-        super(GzipArchive, self).__exit__(exc_type, exc_val, exc_tb)
 
+class SpooledMember(Member):
+    """
+    A file member in a compressed file.
 
-class GzipMember(Member):
-    """A file member in a gzip archive."""
-
-    def __init__(self, *args, **kwargs):
-        super(GzipMember, self).__init__(*args, **kwargs)
-        self._data = self._unpack(self._member)
+    The member is decompressed once into a temporary file, the size and digest
+    of which are computed as it is written.
+    """
 
     @property
     def file(self):
         """A file-like object containing the data for this member."""
-        return self._data
+        return self._member.file
 
     @property
-    def mtime(self):
+    def digest(self):
+        """The SHA-1 digest of the decompressed data."""
+        return self._member.digest
+
+
+class _GzipStream(object):
+    """
+    The data decompressed from a gzip file, produced in chunks by
+    :py:meth:`chunks` as the file is read.
+    """
+
+    def __init__(self, file_, threads=1):
         """
-        A datetime instance representing the modification time of this member.
+        :param file_: The gzip file, positioned at its start.
+        :type file_: file
+        :param threads: The number of threads that decompress the blocks of a
+                        BGZF file.
+        :type threads: int
+        """
+        self._file = file_
+        self._threads = threads
+
+    def chunks(self, chunk_size=_CHUNK_SIZE):
+        """
+        Iterate over the decompressed data.
+
+        :param chunk_size: The size of each read from the gzip file.
+        :type chunk_size: int
+        :rtype: collections.Iterator of bytes
+        :raises IOError: if the file is corrupt or truncated.
+        """
+        try:
+            if self._threads > 1 and self._is_bgzf():
+                chunks = self._inflate_blocks()
+            else:
+                chunks = self._inflate(chunk_size)
+            for chunk in chunks:
+                yield chunk
+        except zlib.error as error:
+            raise IOError(error)
+
+    def _inflate(self, chunk_size):
+        decompressor = None
+        for chunk in iter(lambda: self._file.read(chunk_size), b""):
+            while chunk:
+                if decompressor is None:
+                    # Members may be followed by padding of zeros.
+                    chunk = chunk.lstrip(b"\0")
+                    if not chunk:
+                        break
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                data = decompressor.decompress(chunk)
+                if data:
+                    yield data
+                # Input remaining after the end of a member starts another.
+                chunk = decompressor.unused_data
+                if chunk:
+                    decompressor = None
+        # A complete member leaves any further input unused.
+        if decompressor is not None and not (decompressor.decompress(b"\0") == b"" and decompressor.unused_data):
+            raise IOError("The gzip file is truncated.")
+
+    def _inflate_blocks(self):
+        pool = ThreadPool(self._threads)
+        try:
+            blocks = self._read_blocks()
+            # Blocks are read in batches so that the file is not read ahead of
+            # the decompressed data.
+            for batch in iter(lambda: list(islice(blocks, self._threads * 16)), []):
+                for data in pool.map(_inflate_block, batch):
+                    if data:
+                        yield data
+        finally:
+            pool.close()
+            pool.join()
+
+    def _is_bgzf(self):
+        header = self._file.read(12)
+        try:
+            return (header.startswith(b"\x1f\x8b\x08\x04") and len(header) == 12 and
+                    _get_block_size(self._file.read(struct.unpack("<H", header[10:])[0])) is not None)
+        finally:
+            self._file.seek(0)
+
+    def _read_blocks(self):
+        for header in iter(lambda: self._file.read(12), b""):
+            if len(header) < 12 or not header.startswith(b"\x1f\x8b\x08\x04"):
+                raise IOError("Not a BGZF block.")
+            extra = self._file.read(struct.unpack("<H", header[10:])[0])
+            size = _get_block_size(extra)
+            if size is None:
+                raise IOError("Not a BGZF block.")
+            block = header + extra + self._file.read(size - len(header) - len(extra))
+            if len(block) != size:
+                raise IOError("The gzip file is truncated.")
+            yield block
+
+
+class StreamArchive(Archive):
+    """
+    An adaptor for reading a file compressed by a streaming codec, such as
+    bzip2, as an archive of a single member.
+
+    The member is decompressed in chunks as it is spooled, and a file of
+    several concatenated streams is read as the concatenation of their data.
+    Subclasses name the decompressor of their codec.
+    """
+
+    suffix = None
+    """A pattern matching the extension removed from the name of the member."""
+    errors = ()
+    """The exceptions raised by the decompressor for corrupt data."""
+
+    def __init__(self, file_, path=None):
+        """
+        :param file_: A file-like object containing an archive.
+        """
+        super(StreamArchive, self).__init__(file_, path)
+        self._readable = None
+        self._name = re.sub(self.suffix, '', os.path.basename(self._path or file_.name))
+
+    @classmethod
+    def create_decompressor(cls):
+        """
+        Return a new decompressor for one stream, or None if the codec is not
+        available.
+
+        :return: An object with a ``decompress`` method that accepts
+                 successive chunks of a stream and returns the data that they
+                 complete.
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def open_stream(cls, file_):
+        """
+        Return a read-only stream of the data decompressed from ``file_``.
+
+        :param file_: The compressed file, positioned at its start.
+        :type file_: file
+        :rtype: file
+        """
+        return _DecompressedStream(file_, cls.create_decompressor, cls.errors)
+
+    def __getitem__(self, key):
+        if not self.can_read():
+            raise IOError('Not a compressed file.')
+        if key != self._name:
+            raise KeyError('%s not found.' % key)
+        self._file.seek(0)
+        data = RemoteFile.spool(self.open_stream(self._file))
+        return SpooledMember(self._name, data.size, None, data)
+
+    def can_read(self):
+        """
+        Return True if this instance can be used to read the archive; otherwise
+        False.
+
+        Only the start of the archive is decompressed. False is returned if the
+        codec is not available.
+        """
+        if self._readable is None:
+            self._file.seek(0)
+            header = self._file.read(_CHUNK_SIZE)
+            self._file.seek(0)
+            decompressor = self.create_decompressor()
+            self._readable = decompressor is not None and self.can_read_header(header)
+            if self._readable:
+                try:
+                    decompressor.decompress(header)
+                except self.errors:
+                    self._readable = False
+        return self._readable
+
+    def keys(self):
+        """Return a copy of the list of member names."""
+        if not self.can_read():
+            raise IOError('Not a compressed file.')
+        return [self._name]
+
+
+class Bzip2Archive(StreamArchive):
+    """An adaptor for reading bzip2 compressed files."""
+
+    signatures = (b"BZh",)
+    extensions = (".bz2",)
+    suffix = r'\.bz2$'
+    errors = (IOError, EOFError)
+
+    @classmethod
+    def create_decompressor(cls):
+        return bz2.BZ2Decompressor()
+
+
+class XzArchive(StreamArchive):
+    """
+    An adaptor for reading xz compressed files.
+
+    This type requires the backports.lzma package.
+    """
+
+    signatures = (b"\xfd7zXZ\x00",)
+    extensions = (".xz",)
+    suffix = r'\.xz$'
+    errors = (lzma.LZMAError, EOFError) if lzma is not None else ()
+
+    @classmethod
+    def create_decompressor(cls):
+        return lzma.LZMADecompressor() if lzma is not None else None
+
+
+class ZstdArchive(StreamArchive):
+    """
+    An adaptor for reading Zstandard compressed files.
+
+    This type requires the zstandard package.
+    """
+
+    signatures = (b"\x28\xb5\x2f\xfd",)
+    extensions = (".zst",)
+    suffix = r'\.zst$'
+    errors = (zstandard.ZstdError,) if zstandard is not None else ()
+
+    @classmethod
+    def create_decompressor(cls):
+        return zstandard.ZstdDecompressor().decompressobj() if zstandard is not None else None
+
+    @classmethod
+    def open_stream(cls, file_):
+        return _ZstdStream(file_, cls.create_decompressor, cls.errors)
+
+
+class _DecompressedStream(object):
+    """
+    The data decompressed from a file by a streaming codec, produced in chunks
+    by :py:meth:`chunks` or read as a file.
+    """
+
+    mode = "rb"
+
+    def __init__(self, file_, factory, errors):
+        """
+        :param file_: The compressed file, positioned at its start.
+        :type file_: file
+        :param factory: A function that returns a new decompressor.
+        :type factory: () -> object
+        :param errors: The exceptions raised by the decompressor for corrupt
+                       data.
+        :type errors: tuple of type
+        """
+        self._file = file_
+        self._factory = factory
+        self._errors = errors
+        self._buffer = b""
+        self._chunks = None
+
+    def chunks(self, chunk_size=_CHUNK_SIZE):
         """
-        return datetime.fromtimestamp(self._member.mtime, utc)
+        Iterate over the decompressed data.
+
+        :param chunk_size: The size of each read from the compressed file.
+        :type chunk_size: int
+        :rtype: collections.Iterator of bytes
+        :raises IOError: if the file is corrupt or truncated.
+        """
+        try:
+            for chunk in self._inflate(chunk_size):
+                yield chunk
+        except self._errors as error:
+            raise IOError(error)
+
+    def read(self, size=-1):
+        """
+        Read up to ``size`` bytes of decompressed data, or all remaining data
+        if ``size`` is negative.
+
+        :rtype: bytes
+        """
+        if self._chunks is None:
+            self._chunks = self.chunks()
+        parts, length = [self._buffer], len(self._buffer)
+        while size < 0 or length < size:
+            chunk = next(self._chunks, b"")
+            if not chunk:
+                break
+            parts.append(chunk)
+            length += len(chunk)
+        data = b"".join(parts)
+        if size < 0:
+            size = len(data)
+        self._buffer = data[size:]
+        return data[:size]
+
+    def _inflate(self, chunk_size):
+        decompressor = None
+        for chunk in iter(lambda: self._file.read(chunk_size), b""):
+            while chunk:
+                if decompressor is None:
+                    decompressor = self._factory()
+                try:
+                    data = decompressor.decompress(chunk)
+                except EOFError:
+                    # The previous stream ended with the previous chunk.
+                    decompressor = None
+                    continue
+                if data:
+                    yield data
+                # Input remaining after the end of a stream starts another.
+                chunk = getattr(decompressor, "unused_data", b"")
+                if chunk:
+                    decompressor = None
+        if decompressor is not None and not _is_finished(decompressor):
+            raise IOError("The compressed file is truncated.")
+
+
+class _ZstdStream(_DecompressedStream):
+    """
+    The data decompressed from a Zstandard file.
+
+    The decompressobj of the zstandard package can be used for only one frame
+    and does not report where that frame ends, so the file is read by a
+    stream reader that continues across frames instead. Unlike the other
+    codecs, a truncated file is not detected.
+    """
+
+    def _inflate(self, chunk_size):
+        reader = zstandard.ZstdDecompressor().stream_reader(self._file, read_size=chunk_size, read_across_frames=True)
+        return iter(lambda: reader.read(chunk_size), b"")
+
+
+def _is_finished(decompressor):
+    """Return True if ``decompressor`` has reached the end of its stream."""
+    if hasattr(decompressor, "eof"):
+        return decompressor.eof
+    try:
+        decompressor.decompress(b"")
+    except EOFError:
+        return True
+    return False
+
+
+def _get_block_size(extra):
+    """
+    Return the size of a BGZF block given the extra field of its header, or
+    None if the field does not record it.
+    """
+    offset = 0
+    while offset + 4 <= len(extra):
+        identifier, length = extra[offset:offset + 2], struct.unpack("<H", extra[offset + 2:offset + 4])[0]
+        if identifier == b"BC" and length == 2:
+            return struct.unpack("<H", extra[offset + 4:offset + 6])[0] + 1
+        offset += 4 + length
+    return None
+
+
+def _inflate_block(block):
+    return zlib.decompress(block, 16 + zlib.MAX_WBITS)
+
+
+class LocalArchive(Archive):
+    """
+    An adaptor that presents a file, or the regular files beneath a directory,
+    on the local file system as an archive.
+
+    Member names are relative to the directory and use ``/`` as a separator.
+    Symbolic links are not followed. Each member is opened only when it is
+    read, and reports the path of its file so that it can be spooled without
+    copying.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The absolute path to a file or directory.
+        :type path: str
+        """
+        super(LocalArchive, self).__init__(None, path)
+        self._names = None
+
+    def __getitem__(self, key):
+        if key not in self.keys():
+            raise KeyError('%s not found.' % key)
+        path = self.get_path(key)
+        stats = os.stat(path)
+        return LocalMember(key, stats.st_size, datetime.fromtimestamp(stats.st_mtime, utc),
+                           _DeferredFile(path, lambda: io.open(path, "rb")))
+
+    def can_read(self):
+        """
+        Return True if this instance can be used to read the archive; otherwise
+        False.
+        """
+        return os.path.exists(self._path)
+
+    def get_path(self, key):
+        """
+        Return the path to the named member.
+
+        :param key: The name of a member.
+        :type key: str
+        :rtype: str
+        """
+        if not os.path.isdir(self._path):
+            return self._path
+        return os.path.join(self._path, *key.split("/"))
+
+    def keys(self):
+        """Return a copy of the list of member names."""
+        if self._names is None:
+            if not os.path.isdir(self._path):
+                self._names = [os.path.basename(self._path)]
+            else:
+                self._names = []
+                for directory, _, files in os.walk(self._path):
+                    relative = os.path.relpath(directory, self._path).split(os.sep)
+                    for name in files:
+                        path = os.path.join(directory, name)
+                        if os.path.isfile(path) and not os.path.islink(path):
+                            self._names.append("/".join([part for part in relative if part != "."] + [name]))
+                self._names.sort()
+        return list(self._names)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class LocalMember(Member):
+    """A file on the local file system."""
 
     @property
-    def size(self):
-        """The decompressed size of this member in bytes."""
-        return self._member.size
+    def path(self):
+        """The path to the file."""
+        return self._member.name
 
-    @staticmethod
-    def _unpack(file_):
-        data = tempfile.TemporaryFile()
-        for block in file_:
-            data.write(block)
-        data.seek(0)
+
+class ListingArchive(Archive):
+    """
+    An adaptor that presents a listing of files, such as the entries of a
+    remote directory, as an archive.
+
+    Each member is retrieved only when it is read, so members that are never
+    read are never transferred.
+    """
+
+    def __init__(self, listing, opener, path=None):
+        """
+        :param listing: The name, size and modification time of each file.
+        :type listing: list of (str, int, datetime | None)
+        :param opener: A function that, given the name of a file, retrieves
+                       it and returns a file-like object containing its data.
+        :type opener: (str) -> file
+        :param path: (Optional) The path of the listed directory.
+        :type path: str | None
+        """
+        super(ListingArchive, self).__init__(None, path)
+        self._entries = dict((name, (size, mtime)) for name, size, mtime in listing)
+        self._opener = opener
+
+    def __getitem__(self, key):
+        if key not in self._entries:
+            raise KeyError('%s not found.' % key)
+        size, mtime = self._entries[key]
+        return Member(key, size, mtime, _DeferredFile(key, lambda: self._opener(key)))
+
+    def can_read(self):
+        """
+        Return True if this instance can be used to read the archive; otherwise
+        False.
+
+        This implementation always returns True.
+        """
+        return True
+
+    def keys(self):
+        """Return a copy of the list of member names."""
+        return sorted(self._entries)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class _DeferredFile(object):
+    """
+    A read-only file that is opened when first read, and closed again once it
+    has been read to the end.
+    """
+
+    mode = "rb"
+
+    def __init__(self, name, opener):
+        self.name = name
+        self._file = None
+        self._opener = opener
+
+    def __getattr__(self, name):
+        if self._file is None:
+            self._file = self._opener()
+        return getattr(self._file, name)
+
+    def read(self, size=-1):
+        data = self.__getattr__("read")(size)
+        if not data or size < 0:
+            self.close()
         return data
 
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
 
 class MockArchive(Archive):
     """
@@ -373,86 +999,214 @@ class MockArchive(Archive):
 
 
 class TarArchive(Archive):
-    """An adaptor for reading tar format archives."""
+    """
+    An adaptor for reading tar format archives, which may be compressed.
+
+    The members of an archive are read by :py:meth:`members` in a single,
+    sequential pass that never seeks backwards. Access to members by name
+    requires an index of the whole archive, so the archive is first read to
+    its end and then reread from each member that is requested.
+    """
+
+    signatures = (b"ustar",)
+    """The magic string of POSIX tar headers, found at offset 257."""
+    extensions = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz", ".tbz2", ".tar.xz", ".txz", ".tar.zst")
+
+    @classmethod
+    def can_read_header(cls, header):
+        """
+        Return True if a file with the given header may be read by this type;
+        otherwise False.
+
+        The header of a compressed archive is decompressed to find the header
+        of its first member. If too little is decompressed to find it, as is
+        usual for bzip2, the archive may be read by this type.
+
+        :param header: The leading bytes of the file.
+        :type header: bytes
+        :rtype: bool
+        """
+        if header.startswith(GzipArchive.signatures):
+            try:
+                header = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(header)
+            except zlib.error:
+                return False
+            return len(header) < 262 or header[257:262] in cls.signatures
+        for codec in (Bzip2Archive, XzArchive, ZstdArchive):
+            if codec.can_read_header(header):
+                decompressor = codec.create_decompressor()
+                if decompressor is None:
+                    return False
+                try:
+                    header = decompressor.decompress(header)
+                except codec.errors:
+                    return False
+                return len(header) < 262 or header[257:262] in cls.signatures
+        return header[257:262] in cls.signatures
 
     def __init__(self, file_, path=None):
         super(TarArchive, self).__init__(file_, path)
+        self._readable = None
         self._tar = None
+        self._codec = None
+        self._index = None
         self._names = None
 
     def __getitem__(self, key):
-        if not self.can_read():
-            raise IOError('Not a tar archive.')
-        info = self._tar.getmember(key)
+        info = self._get_index().getmember(key)
         return Member(info.name, info.size, datetime.fromtimestamp(info.mtime, tz=utc), self._tar.extractfile(info))
 
     def can_read(self):
         """
         Return True if this instance can be used to read the archive; otherwise
         False.
+
+        Only the header of the first member is read.
         """
-        if self._tar is None:
+        if self._readable is None:
             try:
-                self._tar = tarfile.open(fileobj=self._file)
-            except tarfile.ReadError:
-                return False
-        return True
+                tarfile.open(fileobj=self._open_stream(), mode="r|*").close()
+            except (tarfile.TarError, IOError):
+                self._readable = False
+            else:
+                self._readable = True
+            finally:
+                self._file.seek(0)
+        return self._readable
 
     def keys(self):
         """Return a copy of the list of member names."""
-        if not self.can_read():
-            raise IOError('Not a tar archive.')
         if self._names is None:
-            self._names = [member.name for member in self._tar.getmembers() if member.isfile()]
+            self._names = [member.name for member in self._get_index().getmembers() if member.isfile()]
         return self._names
 
+    def members(self, select=None):
+        """
+        Iterate over the regular files in this archive in a single, sequential
+        pass.
+
+        The archive is decompressed as it is read, and the data of members that
+        are not selected, or not read, is skipped. Each member must be read
+        before the next is requested.
+
+        :param select: (Optional) A function that, given the name of a member,
+                       returns True if that member should be produced.
+        :type select: (str) -> bool
+        :rtype: collections.Iterator of Member
+        :raises IOError: if the archive cannot be read.
+        """
+        if not self.can_read():
+            raise IOError('Not a tar archive.')
+        tar = tarfile.open(fileobj=self._open_stream(), mode="r|*", bufsize=_CHUNK_SIZE)
+        try:
+            for info in tar:
+                if info.isfile() and (select is None or select(info.name)):
+                    yield Member(info.name, info.size, datetime.fromtimestamp(info.mtime, tz=utc),
+                                 tar.extractfile(info))
+        except tarfile.TarError as error:
+            raise IOError(error)
+        finally:
+            tar.close()
+
+    def _get_index(self):
+        """
+        Return the archive opened for access to its members by name.
+
+        :rtype: tarfile.TarFile
+        """
+        if not self.can_read():
+            raise IOError('Not a tar archive.')
+        if self._tar is None:
+            self._file.seek(0)
+            stream = self._open_stream()
+            if stream is not self._file:
+                # The decompressed archive is spooled so that it can be read
+                # from each member.
+                self._index = tempfile.TemporaryFile()
+                for chunk in stream.chunks():
+                    self._index.write(chunk)
+                self._index.seek(0)
+                stream = self._index
+            self._tar = tarfile.open(fileobj=stream)
+        return self._tar
+
+    def _open_stream(self):
+        """
+        Return the archive file or, if it is compressed by a codec that the
+        tarfile module does not support, a stream of the data decompressed
+        from it. Either is read from the current position of the file.
+
+        :rtype: file
+        """
+        if self._codec is None:
+            position = self._file.tell()
+            header = self._file.read(_HEADER_SIZE)
+            self._file.seek(position)
+            self._codec = next((codec for codec in (XzArchive, ZstdArchive)
+                                if codec.can_read_header(header) and codec.create_decompressor() is not None), False)
+        return self._codec.open_stream(self._file) if self._codec else self._file
+
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._tar.close()
+        if self._tar is not None:
+            self._tar.close()
+        if self._index is not None:
+            self._index.close()
         super(TarArchive, self).__exit__(exc_type, exc_val, exc_tb)
 
 
 class ZipArchive(Archive):
-    """An adaptor for reading Zip format archives."""
+    """
+    An adaptor for reading Zip format archives.
+
+    Members are decompressed from the archive as they are read: each is opened
+    when first read and closed once read to the end, so nothing is copied
+    until a consumer spools the member itself. Members share the archive file,
+    so only one should be read at a time.
+    """
+
+    signatures = (b"PK\x03\x04", b"PK\x05\x06")
+    extensions = (".zip",)
 
     def __init__(self, file_, path=None):
         super(ZipArchive, self).__init__(file_, path)
+        self._readable = None
         self._zip = None
         self._names = None
-        self._members = {}
 
     def __getitem__(self, key):
-        if key not in self.keys():
+        if not key or key.endswith('/'):
             raise KeyError('%s not found.' % key)
-        if key not in self._members:
-            info = self._zip.getinfo(key)
-            data = tempfile.TemporaryFile()
-            shutil.copyfileobj(self._zip.open(info), data)
-            data.seek(0)
-            self._members[key] = Member(info.filename, info.file_size, datetime(*info.date_time, tzinfo=utc), data)
-        return self._members[key]
+        try:
+            info = self._open().getinfo(key)
+        except KeyError:
+            raise KeyError('%s not found.' % key)
+        return Member(info.filename, info.file_size, datetime(*info.date_time, tzinfo=utc),
+                      _DeferredFile(info.filename, lambda: self._zip.open(info)))
 
     def can_read(self):
         """
         Return True if this instance can be used to read the archive; otherwise
         False.
         """
-        readable = zipfile.is_zipfile(self._file)
-        self._file.seek(0)
-        return readable
+        if self._readable is None:
+            self._readable = zipfile.is_zipfile(self._file)
+            self._file.seek(0)
+        return self._readable
 
     def keys(self):
         """Return a copy of the list of member names."""
-        if not self.can_read():
-            raise IOError('Not a Zip archive.')
-        self._open()
         if self._names is None:
-            self._names = [name for name in self._zip.namelist() if not name.endswith('/')]
-        return self._names
+            self._names = [name for name in self._open().namelist() if not name.endswith('/')]
+        return list(self._names)
 
     def _open(self):
+        if not self.can_read():
+            raise IOError('Not a Zip archive.')
         if self._zip is None:
             self._zip = zipfile.ZipFile(self._file)
+        return self._zip
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._zip.close()
+        if self._zip is not None:
+            self._zip.close()
         super(ZipArchive, self).__exit__(exc_type, exc_val, exc_tb)
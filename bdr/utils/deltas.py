@@ -0,0 +1,338 @@
+"""
+A set of delta-compression schemes (codecs) used to encode the revisions held
+by the delta storage.
+
+Encoded files always begin with a signature identifying the codec that produced
+them, so a file can be decoded regardless of the codec currently selected by
+the DELTA_CODEC setting. Each codec can also encode a file without a base,
+producing a self-contained, compressed file.
+
+The xdelta3 codec, which runs the binary named by the XDELTA_BIN setting, is
+used by default. Additional codecs can be supported by subclassing Codec and
+setting DELTA_CODEC to the fully-qualified class name of the new type.
+"""
+
+import bz2
+import importlib
+import io
+import os.path
+import subprocess
+
+from .. import app_settings
+
+try:
+    import bsdiff4
+except ImportError:
+    bsdiff4 = None
+
+__all__ = ["Codec", "BsdiffCodec", "XDeltaCodec"]
+__author__ = "Michael Winter (mail@michael-winter.me.uk)"
+__license__ = """
+    Biological Dataset Repository: data archival and retrieval.
+    Copyright (C) 2015  Michael Winter
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+    """
+
+_CHUNK_SIZE = 64 * 1024
+
+
+class Codec(object):
+    """
+    An abstraction for encoding files as deltas against a base file and for
+    decoding them again.
+
+    All arguments that name files are paths to those files.
+    """
+
+    name = None
+    """A short name identifying this codec."""
+    signatures = ()
+    """The byte strings with which files encoded by this codec begin."""
+    streamable = False
+    """
+    ``True`` if this codec can decode files in a child process using
+    :py:meth:`spawn_decoder`.
+    """
+    buffered = False
+    """
+    ``True`` if this codec can encode and decode data held in memory using
+    :py:meth:`encode_buffer` and :py:meth:`decode_buffer`.
+    """
+
+    @classmethod
+    def instance(cls):
+        """
+        Return an instance of the codec selected by the DELTA_CODEC setting.
+
+        :return: The codec used for encoding new files.
+        :rtype: Codec
+        """
+        return cls._get_selected()()
+
+    @classmethod
+    def for_file(cls, path):
+        """
+        Return an instance of the codec that encoded the given file.
+
+        :param path: The path to an encoded file.
+        :type path: str
+        :return: A codec capable of decoding the file.
+        :rtype: Codec
+        :raises IOError: if the encoding is not recognised.
+        """
+        with io.open(path, "rb") as stream:
+            header = stream.read(16)
+
+        for codec in cls._get_candidates():
+            if codec.can_decode(header):
+                return codec()
+        raise IOError("Unrecognised encoding: {0:s}".format(path))
+
+    @classmethod
+    def named(cls, name):
+        """
+        Return an instance of the codec with the given name.
+
+        :param name: The name of the codec.
+        :type name: str
+        :rtype: Codec
+        :raises ValueError: if no such codec is known.
+        """
+        for codec in cls._get_candidates():
+            if codec.name == name:
+                return codec()
+        raise ValueError("Unknown codec: {0:s}".format(name))
+
+    @classmethod
+    def can_decode(cls, header):
+        """
+        Return ``True`` if a file with the given header was encoded by this
+        codec; otherwise ``False``.
+
+        :param header: The leading bytes of an encoded file.
+        :type header: bytes
+        :rtype: bool
+        """
+        return any(header.startswith(signature) for signature in cls.signatures)
+
+    @classmethod
+    def _get_candidates(cls):
+        candidates = [cls._get_selected()]
+        candidates.extend(codec for codec in (XDeltaCodec, BsdiffCodec) if codec not in candidates)
+        return candidates
+
+    @staticmethod
+    def _get_selected():
+        namespaces = app_settings.DELTA_CODEC.split('.')
+        module = importlib.import_module('.'.join(namespaces[:-1]))
+        return getattr(module, namespaces[-1])
+
+    def encode(self, source, destination, base=None):
+        """
+        Encode ``source`` as a delta against ``base``, writing the result to
+        ``destination``. If ``base`` is omitted, ``source`` is compressed
+        instead.
+
+        :param source: The path to the file to encode.
+        :type source: str
+        :param destination: The path to which the encoded file is written.
+        :type destination: str
+        :param base: (Optional) The path to the base file.
+        :type base: str | None
+        """
+        raise NotImplementedError
+
+    def decode(self, source, destination, base=None):
+        """
+        Decode ``source`` using ``base``, writing the result to
+        ``destination``.
+
+        :param source: The path to the encoded file.
+        :type source: str
+        :param destination: The path to which the decoded file is written.
+        :type destination: str
+        :param base: (Optional) The path to the base file used to encode
+                     ``source``.
+        :type base: str | None
+        """
+        raise NotImplementedError
+
+    def encode_buffer(self, data, base=None):
+        """
+        Encode ``data`` as a delta against ``base``. If ``base`` is omitted,
+        ``data`` is compressed instead.
+
+        :param data: The data to encode.
+        :type data: bytes
+        :param base: (Optional) The base data.
+        :type base: bytes | None
+        :return: The encoded data.
+        :rtype: bytes
+        :raises NotImplementedError: if this codec is not buffered.
+        """
+        raise NotImplementedError
+
+    def decode_buffer(self, data, base=None):
+        """
+        Decode ``data`` using ``base``.
+
+        :param data: The encoded data.
+        :type data: bytes
+        :param base: (Optional) The base data used to encode ``data``.
+        :type base: bytes | None
+        :return: The decoded data.
+        :rtype: bytes
+        :raises NotImplementedError: if this codec is not buffered.
+        """
+        raise NotImplementedError
+
+    def spawn_decoder(self, source, destination=None, base=None):
+        """
+        Start decoding ``source`` in a child process.
+
+        Neither the base nor the destination need be seekable, so both may name
+        FIFOs, allowing the decoders for successive members of a chain to be
+        connected.
+
+        :param source: An open file containing the encoded data.
+        :type source: file
+        :param destination: (Optional) The path to which the decoded file is
+                            written. If omitted, it is written to the
+                            ``stdout`` pipe of the process.
+        :type destination: str | None
+        :param base: (Optional) The path to the base file used to encode
+                     ``source``.
+        :type base: str | None
+        :return: The child process.
+        :rtype: subprocess.Popen
+        :raises NotImplementedError: if this codec is not streamable.
+        """
+        raise NotImplementedError
+
+
+class XDeltaCodec(Codec):
+    """
+    Encodes files in the VCDIFF format (RFC 3284) by running the xdelta3 binary
+    named by the XDELTA_BIN setting.
+    """
+
+    name = "xdelta3"
+    signatures = ("\xd6\xc3\xc4",)
+    streamable = True
+
+    def encode(self, source, destination, base=None):
+        self._run("-feS", source, destination, base)
+
+    def decode(self, source, destination, base=None):
+        self._run("-fdS", source, destination, base)
+
+    def spawn_decoder(self, source, destination=None, base=None):
+        """
+        Start decoding ``source`` in a child process.
+
+        When reading from a non-seekable base, xdelta3 holds a window of that
+        file in memory. The size of this window is set by the
+        XDELTA_SOURCE_WINDOW setting and must be large enough to span the
+        copies made from the base.
+
+        :param source: An open file containing the encoded data.
+        :type source: file
+        :param destination: (Optional) The path to which the decoded file is
+                            written. If omitted, it is written to the
+                            ``stdout`` pipe of the process.
+        :type destination: str | None
+        :param base: (Optional) The path to the base file used to encode
+                     ``source``.
+        :type base: str | None
+        :return: The child process.
+        :rtype: subprocess.Popen
+        """
+        args = [app_settings.XDELTA_BIN, "-dcS", "djw", "-B", str(app_settings.XDELTA_SOURCE_WINDOW)]
+        if base:
+            args.extend(("-s", base))
+        if destination:
+            args[1] = "-dfS"
+            args.extend(("/dev/stdin", destination))
+        return subprocess.Popen(args, stdin=source, stdout=None if destination else subprocess.PIPE)
+
+    @staticmethod
+    def _run(flags, source, destination, base):
+        args = [app_settings.XDELTA_BIN, flags, "djw", source, destination]
+        if base:
+            args[3:3] = ("-s", base)
+        subprocess.check_call(args)
+
+
+class BsdiffCodec(Codec):
+    """
+    Encodes files in-process, using the bsdiff4 library for deltas and bzip2
+    for self-contained files.
+
+    Both bsdiff and its inverse hold their inputs in memory. Files larger than
+    the BUFFERED_CODEC_LIMIT setting are therefore delegated to xdelta3, in
+    both directions. As every file that this codec encodes is within that
+    limit, its files can also be decoded in memory.
+    """
+
+    name = "bsdiff"
+    signatures = ("BSDIFF40", "BZh")
+    buffered = True
+
+    def __init__(self):
+        if bsdiff4 is None:
+            raise RuntimeError("The bsdiff codec requires the bsdiff4 package.")
+
+    def encode(self, source, destination, base=None):
+        limit = app_settings.BUFFERED_CODEC_LIMIT
+        if limit and max(os.path.getsize(path) for path in (source, base) if path) > limit:
+            XDeltaCodec().encode(source, destination, base)
+            return
+
+        with io.open(source, "rb") as src, io.open(destination, "wb") as dst:
+            if base is None:
+                compressor = bz2.BZ2Compressor()
+                for chunk in iter(lambda: src.read(_CHUNK_SIZE), b""):
+                    dst.write(compressor.compress(chunk))
+                dst.write(compressor.flush())
+            else:
+                dst.write(bsdiff4.diff(self._read(base), src.read()))
+
+    def decode(self, source, destination, base=None):
+        with io.open(source, "rb") as src:
+            header = src.read(16)
+        if not self.can_decode(header):
+            # Files above BUFFERED_CODEC_LIMIT were encoded by xdelta3.
+            Codec.for_file(source).decode(source, destination, base)
+            return
+
+        with io.open(source, "rb") as src, io.open(destination, "wb") as dst:
+            if header.startswith(self.signatures[0]):
+                dst.write(bsdiff4.patch(self._read(base), src.read()))
+            else:
+                decompressor = bz2.BZ2Decompressor()
+                for chunk in iter(lambda: src.read(_CHUNK_SIZE), b""):
+                    dst.write(decompressor.decompress(chunk))
+
+    def encode_buffer(self, data, base=None):
+        return bz2.compress(data) if base is None else bsdiff4.diff(base, data)
+
+    def decode_buffer(self, data, base=None):
+        return bsdiff4.patch(base, data) if data.startswith(self.signatures[0]) else bz2.decompress(data)
+
+    @staticmethod
+    def _read(path):
+        with io.open(path, "rb") as stream:
+            return stream.read()
@@ -2,20 +2,30 @@
 Storage handling for models based on delta-compression.
 """
 
+from collections import OrderedDict
 from hashlib import sha1 as hash_algorithm
 from tempfile import NamedTemporaryFile
 import errno
 import fnmatch
 import io
+import json
 import os.path
 import shutil
-import subprocess
+import tempfile
+import threading
+import time
 
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
 from locket import lock_file
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 from .. import app_settings
+from .deltas import Codec
 
 __all__ = ["delta_storage", "upload_path"]
 __author__ = "Michael Winter (mail@michael-winter.me.uk)"
@@ -38,6 +48,8 @@ __license__ = """
     51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
     """
 
+_MANIFEST_MARKER = ".manifests"
+
 
 # noinspection PyUnusedLocal
 def upload_path(instance, filename):
@@ -82,8 +94,46 @@ class DeltaFileSystemStorage(FileSystemStorage):
     >>> root, ext = os.path.splitext(name)
     >>> root == "test.example"
     True
+
+    To bound the cost of reading old revisions, chain members may also be
+    stored self-contained (as keyframes) according to the
+    ``BDR_KEYFRAME_INTERVAL`` and ``BDR_KEYFRAME_THRESHOLD`` settings. Decoding
+    a member then begins at the nearest keyframe that follows it rather than at
+    the end of the chain.
+
+    The members of each chain are listed by a :py:class:`ChainManifest` that
+    shares the root of the chain, so that no operation need list the
+    containing directory. Chains written before manifests were introduced are
+    found by listing the directory instead, and gain a manifest the next time
+    they are modified.
+
+    Identical files are stored once. Each file is identified by the digest of
+    its content and, where the platform supports hard links, the encoded form
+    of each new file is also linked into a content-addressed store within the
+    ``blobs`` subdirectory. A later file with the same content, in any chain,
+    is then saved as another link to it rather than encoded anew, and a file
+    identical to the one it follows is saved as a link to that file. The
+    number of links to a stored file serves as its reference count: it is
+    removed once no chain member refers to it.
+
+    Content that is already held in a named file with a known digest, as
+    produced by :py:meth:`bdr.utils.RemoteFile.spool`, is encoded in place;
+    any other content is first copied to a temporary file.
+
+    Reading a file holds a shared lock on its chain, so any number of
+    revisions of the same file can be decoded concurrently. Saving and
+    deleting files holds an exclusive lock.
+
+    Decoded revisions may be retained in a :py:class:`RevisionCache` so that
+    subsequent reads of the same revision need not replay the chain. The cache
+    is enabled by the ``BDR_REVISION_CACHE_SIZE`` setting.
     """
 
+    def __init__(self, location=None, base_url=None):
+        super(DeltaFileSystemStorage, self).__init__(location, base_url)
+        self.cache = RevisionCache(app_settings.REVISION_CACHE_DIR or os.path.join(self.location, "cache"),
+                                   app_settings.REVISION_CACHE_SIZE)
+
     def _open(self, name, mode="rb"):
         """
         Return a :py:class:``~django.core.files.File` instance that wraps the
@@ -99,32 +149,82 @@ class DeltaFileSystemStorage(FileSystemStorage):
         """
         path, filename = os.path.split(name)
 
-        with Lock(self.path(path + filename)):
+        with Lock(self.path(path + filename), shared=True):
             if not self.exists(name):
                 raise FileNotFoundError(name)
 
-            base = None
-            for current in self._get_related_files(name):
-                full_path = self.path(os.path.join(path, current))
-                # Decode the current file based on the prior chain member, if
-                # any, and remove the intermediary file
-                decoded_path = self._decode(full_path, base, unlink_base=True)
+            cached = self.cache.get(name)
+            if cached is not None:
+                return cached
+
+            manifest = self._get_manifest(name)
+            decoded_path = self._decode_member(path, manifest, manifest.names.index(filename))
+            cached = self.cache.put(name, decoded_path)
+            if cached is not None:
+                return cached
+            # Reopen the decoded file and make it self-deleting again
+            return FileDeletionWrapper(io.open(decoded_path, "rb"))
+
+    def open_stream(self, name):
+        """
+        Return a read-only stream over the file with the given name.
 
-                if current == filename:
-                    # Reopen the decoded file and make it self-deleting again
-                    return FileDeletionWrapper(io.open(decoded_path, "rb"))
+        Unlike :py:meth:`open`, no intermediate files are written: the members
+        of the chain are decoded concurrently by child processes connected by
+        pipes, and the output of the final stage can be read as soon as it is
+        produced. Only the member files themselves are opened while the chain
+        is locked and, as members are only ever replaced rather than rewritten,
+        the stream is unaffected by later changes to the chain.
 
-                # Use the decoded file for the next one in the chain
-                base = decoded_path
+        If a cached copy of the file exists, it is returned instead. If any
+        member of the chain was encoded by a codec that cannot be streamed, or
+        the platform lacks named pipes, the file is opened as by
+        :py:meth:`open`.
+
+        :param name: The name of the file to open.
+        :type name: str | unicode
+        :return: The open stream.
+        :rtype: file | DecodingStream
+        :raises FileNotFoundError: if ``name`` does not exist.
+        """
+        path, filename = os.path.split(name)
+
+        with Lock(self.path(path + filename), shared=True):
+            if not self.exists(name):
+                raise FileNotFoundError(name)
 
-        raise FileNotFoundError(name)  # This should not be possible here.
+            cached = self.cache.get(name)
+            if cached is not None:
+                return cached
+
+            manifest = self._get_manifest(name)
+            files = manifest.names
+            index = files.index(filename)
+            start = self._find_keyframe(files, manifest.keyframes, index)
+            members = files[start:index + 1]
+            codecs = [Codec.named(manifest.get(member)["codec"]) for member in members]
+            if hasattr(os, "mkfifo") and all(codec.streamable for codec in codecs):
+                sources = [io.open(self.path(os.path.join(path, member)), "rb") for member in members]
+            else:
+                sources = None
+
+        if sources is None:
+            return self.open(name)
+        return DecodingStream(codecs, sources)
 
     def _save(self, name, content):
         path, filename = os.path.split(name)
         full_path = self.path(name)
 
-        with NamedTemporaryFile(delete=False) as copy:
-            shutil.copyfileobj(content, copy)
+        source, digest = self._get_spooled(content)
+        copied = source is None
+        if copied:
+            digest = hash_algorithm()
+            with NamedTemporaryFile(delete=False) as copy:
+                for chunk in content.chunks():
+                    copy.write(chunk)
+                    digest.update(chunk)
+            source, digest = copy.name, digest.hexdigest()
 
         try:
             with Lock(self.path(path + filename)):
@@ -135,27 +235,60 @@ class DeltaFileSystemStorage(FileSystemStorage):
                     except OSError as error:
                         if error.errno != errno.EEXIST:
                             raise
+                    else:
+                        self._mark_directory(directory)
                 if not os.path.isdir(directory):
                     raise IOError("{0:s} exists and is not a directory.".format(directory))
 
-                files = self._get_related_files(name)
-                if files:
-                    head = os.path.join(directory, files[0])
-                    # Decode head into a temporary file
-                    temp = self._decode(head)
-
-                    self._encode(temp, head, base=copy.name, unlink_source=True)
-
-                # Encode the added file
-                self._encode(copy.name, full_path)
+                self.cache.invalidate(name)
+
+                manifest = self._get_manifest(name, migrate=True)
+                head = manifest.members[0] if manifest.members else None
+                if head is not None and head.get("digest") == digest and hasattr(os, "link"):
+                    # The current head is identical, so it is shared with the
+                    # added file and retained as a keyframe
+                    os.link(self.path(os.path.join(path, head["name"])), full_path)
+                else:
+                    if head is not None:
+                        run_length, run_size = self._measure_run(manifest)
+                        # Otherwise, the current head is retained as a keyframe
+                        if (not self._is_keyframe_due(run_length + 1, run_size) and
+                                self._recode_head(name, manifest, source, run_length, run_size)):
+                            self._release_blobs([head.get("digest")])
+
+                    # Encode the added file, unless identical content is stored
+                    if not self._link_blob(digest, full_path):
+                        self._encode(source, full_path)
+                        self._store_blob(digest, full_path)
+                manifest.update(filename, full_path, True, digest)
+                manifest.save()
         finally:
             # Remove the on-disk copy of content
-            os.unlink(copy.name)
+            if copied:
+                os.unlink(source)
 
         if settings.FILE_UPLOAD_PERMISSIONS is not None:
             os.chmod(full_path, settings.FILE_UPLOAD_PERMISSIONS)
         return name
 
+    @staticmethod
+    def _get_spooled(content):
+        """
+        Return the path to, and digest of, a file that already holds the given
+        content on disk, such as one created by
+        :py:meth:`~bdr.utils.RemoteFile.spool`.
+
+        :return: The path and digest, or (None, None) if the content must be
+                 copied.
+        :rtype: (str, str) | (None, None)
+        """
+        digest = getattr(content, "digest", None)
+        path = getattr(getattr(content, "file", None), "name", None)
+        if digest and isinstance(path, basestring) and os.path.isfile(path):
+            content.file.flush()
+            return path, digest
+        return None, None
+
     def delete(self, name):
         """
         Deletes the specified file from the storage system.
@@ -166,53 +299,51 @@ class DeltaFileSystemStorage(FileSystemStorage):
         :param name: The name of the file to delete.
         :type name: str | unicode
         """
-        path, filename = os.path.split(name)
-        full_path = self.path(name)
+        self.delete_many([name])
 
-        with Lock(self.path(path + filename)):
-            if self.exists(name):
-                files = self._get_related_files(name)
-                index = files.index(filename)
-                # If the target file is not the last member of the chain, the
-                # file that follows it will need to be recoded using the file
-                # that precedes the target in the chain.
-                if index != len(files) - 1:
-                    # Decode chain members up to the target file discarding
-                    # temporary files along the way.
-                    base = None
-                    for current in files[:index]:
-                        current_path = self.path(os.path.join(path, current))
-                        base = self._decode(current_path, base, unlink_base=True)
-                    prior = base
+    def delete_many(self, names):
+        """
+        Deletes the specified files from the storage system.
 
-                    try:
-                        # Decode the target file using its predecessor (if
-                        # applicable).
-                        target = self._decode(full_path, base=prior)
+        The files are grouped by chain and each chain is decoded at most once,
+        recoding only those remaining files that were encoded against a
+        deleted file. Deleting every file in a chain, or only the earliest
+        files, requires no decoding at all.
 
-                        after = self.path(os.path.join(path, files[index + 1]))
-                        # Decode the trailing file deleting the decoded version
-                        # of the target
-                        copy = self._decode(after, base=target, unlink_base=True)
+        If a containing directory becomes empty as a result, it is also
+        removed.
 
-                        # Recode the trailing file deleting its intermediary
-                        self._encode(copy, after, base=prior, unlink_source=True)
+        :param names: The names of the files to delete.
+        :type names: collections.Iterable of (str | unicode)
+        """
+        chains = {}
+        for name in names:
+            path, filename = os.path.split(name)
+            root = os.path.splitext(filename)[0]
+            chains.setdefault((path, root), set()).add(filename)
+
+        for (path, _), targets in chains.items():
+            name = os.path.join(path, min(targets))
+            with Lock(self.path(path + min(targets))):
+                for filename in targets:
+                    self.cache.invalidate(os.path.join(path, filename))
+
+                manifest = self._get_manifest(name, migrate=True)
+                targets = targets.intersection(manifest.names)
+                if targets:
+                    try:
+                        self._truncate(path, manifest, targets)
                     finally:
-                        if prior:
-                            os.unlink(prior)
+                        manifest.save()
+                    for filename in targets:
+                        super(DeltaFileSystemStorage, self).delete(os.path.join(path, filename))
+                    digests = [manifest.get(filename).get("digest") for filename in targets]
+                    manifest.remove(targets)
+                    manifest.save()
+                    self._release_blobs(digests)
 
-                super(DeltaFileSystemStorage, self).delete(name)
-
-            path = os.path.dirname(full_path)
-            try:
-                os.rmdir(path)
-            except OSError as error:
-                # Failing to delete a directory that still contains files is not
-                # considered an error. This approach avoids a race condition where
-                # a file may be created between finding the directory empty and
-                # deleting it.
-                if error.errno != errno.ENOTEMPTY:
-                    raise
+                if not manifest.members:
+                    self._remove_directory(path)
 
     def url(self, name):
         """
@@ -232,12 +363,9 @@ class DeltaFileSystemStorage(FileSystemStorage):
         output = NamedTemporaryFile(delete=False)
         output.close()
 
-        args = [app_settings.XDELTA_BIN, "-fdS", "djw", source, output.name]
-        if base:
-            args[3:3] = ("-s", base)
         try:
-            subprocess.check_call(args)
-        except subprocess.CalledProcessError:
+            Codec.for_file(source).decode(source, output.name, base)
+        except:
             os.unlink(output.name)
             raise
         finally:
@@ -248,20 +376,564 @@ class DeltaFileSystemStorage(FileSystemStorage):
 
     @staticmethod
     def _encode(source, destination, base=None, unlink_source=False):
-        args = [app_settings.XDELTA_BIN, "-feS", "djw", source, destination]
-        if base:
-            args[3:3] = ("-s", base)
         try:
-            subprocess.check_call(args)
+            Codec.instance().encode(source, destination, base)
         finally:
             if unlink_source:
                 os.unlink(source)
 
-    def _get_related_files(self, name):
+    def rebuild(self, name):
+        """
+        Recode the chain containing the specified file so that it conforms to
+        the current keyframe settings.
+
+        Each member of the chain is decoded once, from the last file to the
+        first, and recoded either as a delta or as a keyframe.
+
+        :param name: The name of any file in the chain.
+        :type name: str | unicode
+        :return: The number of keyframes in the rebuilt chain, including the
+                 last file.
+        :rtype: int
+        :raises FileNotFoundError: if ``name`` does not exist.
+        """
+        path, filename = os.path.split(name)
+
+        with Lock(self.path(path + filename)):
+            if not self.exists(name):
+                raise FileNotFoundError(name)
+
+            manifest = self._get_manifest(name, migrate=True)
+            files = manifest.names
+            keyframes = manifest.keyframes
+            count, run_length, run_size = 1, 0, 0
+            prior = self._decode(self.path(os.path.join(path, files[0])))
+            try:
+                for current in files[1:]:
+                    current_path = self.path(os.path.join(path, current))
+                    decoded = self._decode(current_path, None if current in keyframes else prior)
+                    staged = self._stage(current_path)
+                    try:
+                        is_keyframe = self._is_keyframe_due(run_length + 1, run_size)
+                        if not is_keyframe:
+                            self._encode(decoded, staged, base=prior)
+                            size = os.path.getsize(staged)
+                            is_keyframe = self._is_keyframe_due(run_length + 1, run_size + size)
+                        if is_keyframe:
+                            self._encode(decoded, staged)
+                            count, run_length, run_size = count + 1, 0, 0
+                        else:
+                            run_length, run_size = run_length + 1, run_size + size
+
+                        # Members are only flagged as keyframes while they
+                        # are stored self-contained.
+                        manifest.update(current, staged, is_keyframe)
+                        if not is_keyframe and current in keyframes:
+                            manifest.save()
+                        os.rename(staged, current_path)
+                    except:
+                        os.unlink(decoded)
+                        if os.path.exists(staged):
+                            os.unlink(staged)
+                        raise
+                    os.unlink(prior)
+                    prior = decoded
+            finally:
+                os.unlink(prior)
+                manifest.save()
+            self._release_blobs(member.get("digest") for member in manifest.members)
+        return count
+
+    def _decode_member(self, path, manifest, index):
+        """
+        Decode a chain member into a temporary file.
+
+        Decoding begins at the nearest keyframe that follows the member. If
+        every member to be decoded was encoded by a buffered codec, the
+        intermediate revisions are held in memory; otherwise, each is written
+        to a temporary file.
+
+        :param path: The relative path to the directory containing the chain.
+        :type path: str | unicode
+        :param manifest: The manifest of the chain.
+        :type manifest: ChainManifest
+        :param index: The position of the member in the chain, last file first.
+        :type index: int
+        :return: The path to the decoded file.
+        :rtype: str
+        """
+        files = manifest.names
+        start = self._find_keyframe(files, manifest.keyframes, index)
+        members = files[start:index + 1]
+        codecs = [Codec.named(manifest.get(member)["codec"]) for member in members]
+        if all(codec.buffered for codec in codecs):
+            return self._decode_buffered(path, members, codecs)
+
+        base = None
+        for current in members:
+            full_path = self.path(os.path.join(path, current))
+            # Decode the current file based on the prior chain member, if
+            # any, and remove the intermediary file
+            base = self._decode(full_path, None if current == files[start] else base, unlink_base=True)
+        return base
+
+    def _decode_buffered(self, path, members, codecs):
+        """
+        Decode a run of chain members in memory, writing only the last to a
+        temporary file.
+
+        :param path: The relative path to the directory containing the chain.
+        :type path: str | unicode
+        :param members: The names of the members, starting with a keyframe.
+        :type members: list of str
+        :param codecs: The buffered codecs that encoded each member.
+        :type codecs: list of bdr.utils.deltas.Codec
+        :return: The path to the decoded file.
+        :rtype: str
+        """
+        data = None
+        for member, codec in zip(members, codecs):
+            with io.open(self.path(os.path.join(path, member)), "rb") as stream:
+                data = codec.decode_buffer(stream.read(), data)
+
+        output = NamedTemporaryFile(delete=False)
+        try:
+            with output:
+                output.write(data)
+        except:
+            os.unlink(output.name)
+            raise
+        return output.name
+
+    def _truncate(self, path, manifest, targets):
+        """
+        Recode the members of a chain that were encoded against members that
+        are about to be deleted.
+
+        Each such member is recoded as a delta against the nearest remaining
+        member that follows it. If no member follows it, or if a keyframe lies
+        between them, it becomes a keyframe instead.
+
+        :param path: The relative path to the directory containing the chain.
+        :type path: str | unicode
+        :param manifest: The manifest of the chain. This is updated with the
+                         recoded members, but not saved.
+        :type manifest: ChainManifest
+        :param targets: The names of the members to be deleted.
+        :type targets: set of str
+        """
+        files, keyframes = manifest.names, manifest.keyframes
+        affected = [index for index in range(1, len(files))
+                    if files[index] not in targets and files[index - 1] in targets and files[index] not in keyframes]
+        if not affected:
+            return
+
+        first = min(files.index(target) for target in targets)
+        previous, survivor, gap_has_keyframe = None, None, False
+        try:
+            for index in range(self._find_keyframe(files, keyframes, max(first - 1, 0)), affected[-1] + 1):
+                current = files[index]
+                current_path = self.path(os.path.join(path, current))
+                is_keyframe = index == 0 or current in keyframes
+                decoded = self._decode(current_path, None if is_keyframe else previous)
+                try:
+                    if current in targets:
+                        gap_has_keyframe = gap_has_keyframe or is_keyframe
+                    else:
+                        if index in affected:
+                            base = None if gap_has_keyframe else survivor
+                            staged = self._stage(current_path)
+                            try:
+                                self._encode(decoded, staged, base=base)
+                            except:
+                                os.unlink(staged)
+                                raise
+                            manifest.update(current, staged, base is None)
+                            os.rename(staged, current_path)
+                        gap_has_keyframe = False
+                finally:
+                    # Retain only the decoded copies of the previous member and
+                    # of the nearest remaining member. The decoded copy of this
+                    # member is tracked even if recoding failed, so that it is
+                    # removed.
+                    discarded = {previous, survivor}
+                    previous = decoded
+                    if current not in targets:
+                        survivor = decoded
+                    for temp in discarded - {previous, survivor, None}:
+                        os.unlink(temp)
+        finally:
+            for temp in {previous, survivor} - {None}:
+                os.unlink(temp)
+
+    @staticmethod
+    def _find_keyframe(files, keyframes, index):
+        """
+        Return the position of the nearest keyframe that follows (or is) the
+        chain member at ``index``.
+
+        :rtype: int
+        """
+        while index > 0 and files[index] not in keyframes:
+            index -= 1
+        return index
+
+    def _recode_head(self, name, manifest, base, run_length, run_size):
+        """
+        Recode the last file in a chain as a delta against a new file.
+
+        The head is left self-contained if the resulting delta would exceed the
+        keyframe threshold.
+
+        :param name: The name of any file in the chain.
+        :type name: str | unicode
+        :param manifest: The manifest of the chain. The entry for the head is
+                         updated if it is recoded.
+        :type manifest: ChainManifest
+        :param base: The path to the (unencoded) file that will follow it.
+        :type base: str
+        :param run_length: The number of deltas that precede the head.
+        :type run_length: int
+        :param run_size: The combined size of those deltas.
+        :type run_size: int
+        :return: ``True`` if the head was recoded; ``False`` otherwise.
+        :rtype: bool
+        """
+        head = manifest.names[0]
+        head_path = self.path(os.path.join(os.path.dirname(name), head))
+        # Decode head into a temporary file
+        temp = self._decode(head_path)
+        staged = self._stage(head_path)
+        try:
+            self._encode(temp, staged, base=base, unlink_source=True)
+        except:
+            os.unlink(staged)
+            raise
+
+        if self._is_keyframe_due(run_length + 1, run_size + os.path.getsize(staged)):
+            os.unlink(staged)
+            return False
+
+        manifest.update(head, staged, False)
+        os.rename(staged, head_path)
+        return True
+
+    @staticmethod
+    def _measure_run(manifest):
+        """
+        Return the number and combined size of the deltas that precede the last
+        file in a chain.
+
+        :param manifest: The manifest of the chain.
+        :type manifest: ChainManifest
+        :rtype: (int, int)
+        """
+        run_length, run_size = 0, 0
+        for member in manifest.members[1:]:
+            if member["keyframe"]:
+                break
+            run_length += 1
+            run_size += member["size"]
+        return run_length, run_size
+
+    @staticmethod
+    def _is_keyframe_due(run_length, run_size):
+        """
+        Return ``True`` if a run of deltas of the given length and combined
+        size should be broken by a keyframe.
+
+        :param run_length: The number of deltas in the run.
+        :type run_length: int
+        :param run_size: The combined size, in bytes, of the deltas in the run.
+        :type run_size: int
+        :rtype: bool
+        """
+        interval, threshold = app_settings.KEYFRAME_INTERVAL, app_settings.KEYFRAME_THRESHOLD
+        return bool(interval and run_length >= interval or threshold and run_size > threshold)
+
+    @staticmethod
+    def _stage(path):
+        """
+        Create an empty temporary file alongside ``path`` such that it can
+        later replace that file atomically.
+
+        :rtype: str
+        """
+        directory, filename = os.path.split(path)
+        staged = NamedTemporaryFile(dir=directory, prefix=".", suffix=filename, delete=False)
+        staged.close()
+        return staged.name
+
+    def _get_blob_path(self, digest):
+        return os.path.join(self.location, "blobs", digest[:2], digest)
+
+    def _link_blob(self, digest, path):
+        """
+        Link the stored file with the given content digest to ``path``.
+
+        :return: ``True`` if the file was linked; ``False`` if no such file is
+                 stored.
+        :rtype: bool
+        """
+        if not hasattr(os, "link"):
+            return False
+        try:
+            os.link(self._get_blob_path(digest), path)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def _store_blob(self, digest, path):
+        """
+        Link the self-contained file at ``path`` into the content-addressed
+        store under the given content digest.
+        """
+        if not hasattr(os, "link"):
+            return
+        blob_path = self._get_blob_path(digest)
+        try:
+            os.makedirs(os.path.dirname(blob_path))
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        try:
+            os.link(path, blob_path)
+        except OSError as error:
+            # Another chain stored the same content first.
+            if error.errno != errno.EEXIST:
+                raise
+
+    def _release_blobs(self, digests):
+        """
+        Remove the stored files with the given content digests that are no
+        longer linked to any chain member.
+
+        :param digests: The content digests of deleted or recoded members.
+                        Members without a digest are given as ``None``.
+        :type digests: collections.Iterable of (str | None)
+        """
+        for digest in set(digests) - {None}:
+            blob_path = self._get_blob_path(digest)
+            try:
+                if os.stat(blob_path).st_nlink == 1:
+                    os.unlink(blob_path)
+                    os.rmdir(os.path.dirname(blob_path))
+            except OSError as error:
+                if error.errno not in (errno.ENOENT, errno.ENOTEMPTY):
+                    raise
+
+    def _get_manifest(self, name, migrate=False):
+        """
+        Return the manifest of the chain containing the specified file.
+
+        If the chain has no manifest, the members are found by listing the
+        containing directory, unless that directory was created with
+        manifests in place.
+
+        :param name: The name of any file in the chain.
+        :type name: str | unicode
+        :param migrate: ``True`` if a manifest found by listing the directory
+                        should be saved, replacing any keyframe index. The
+                        chain must be locked exclusively.
+        :type migrate: bool
+        :rtype: ChainManifest
+        """
+        manifest_path = ".".join((os.path.splitext(self.path(name))[0], "manifest"))
+        manifest = ChainManifest.load(manifest_path)
+        if manifest is not None:
+            return manifest
+
+        manifest = ChainManifest(manifest_path)
+        if os.path.exists(os.path.join(os.path.dirname(manifest_path), _MANIFEST_MARKER)):
+            return manifest
+
         path, filename = os.path.split(name)
-        root = os.path.splitext(filename)[0]
-        related_files = fnmatch.filter(self.listdir(path)[1], ".".join((root, "??????")))
-        return sorted(related_files, reverse=True)
+        try:
+            filenames = self.listdir(path)[1]
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            filenames = []
+        files = sorted(fnmatch.filter(filenames, ".".join((os.path.splitext(filename)[0], "??????"))), reverse=True)
+        index_path = ".".join((os.path.splitext(self.path(name))[0], "keyframes"))
+        keyframes = set()
+        try:
+            with io.open(index_path, "r") as index:
+                keyframes = {line.strip() for line in index if line.strip()}
+        except IOError as error:
+            if error.errno != errno.ENOENT:
+                raise
+        for number, current in enumerate(files):
+            manifest.update(current, self.path(os.path.join(path, current)), number == 0 or current in keyframes)
+
+        if migrate:
+            manifest.save()
+            try:
+                os.unlink(index_path)
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+        return manifest
+
+    @staticmethod
+    def _mark_directory(directory):
+        """
+        Mark a directory as one in which every chain has a manifest.
+        """
+        io.open(os.path.join(directory, _MANIFEST_MARKER), "w").close()
+
+    def _remove_directory(self, path):
+        """
+        Remove the directory with the given relative path if it is empty (but
+        for its marker).
+        """
+        directory = self.path(path)
+        marker = os.path.join(directory, _MANIFEST_MARKER)
+        marked = os.path.exists(marker)
+        if marked:
+            os.unlink(marker)
+        try:
+            os.rmdir(directory)
+        except OSError as error:
+            # Failing to delete a directory that still contains files is not
+            # considered an error. This approach avoids a race condition where
+            # a file may be created between finding the directory empty and
+            # deleting it.
+            if error.errno not in (errno.ENOTEMPTY, errno.ENOENT):
+                raise
+            if marked and error.errno == errno.ENOTEMPTY:
+                self._mark_directory(directory)
+
+
+class ChainManifest(object):
+    """
+    A record of the members of a delta chain.
+
+    For each member, last file first, the manifest holds its name, the size of
+    its encoded form, the name of the codec that encoded it, whether it is
+    stored self-contained (as a keyframe) and the digest of its decoded
+    content, if known. The last file is always stored self-contained.
+
+    The manifest is held as a JSON document alongside the chain and must only
+    be saved while the chain is locked exclusively.
+    """
+
+    def __init__(self, path, members=None):
+        """
+        :param path: The absolute path to the manifest file.
+        :type path: str
+        :param members: (Optional) The entries for each member.
+        :type members: list of dict
+        """
+        self.path = path
+        self.members = members or []
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read the manifest held at the given path.
+
+        :param path: The absolute path to the manifest file.
+        :type path: str
+        :return: The manifest, or ``None`` if the file does not exist.
+        :rtype: ChainManifest | None
+        """
+        try:
+            with io.open(path, "r") as stream:
+                return cls(path, json.load(stream)["members"])
+        except IOError as error:
+            if error.errno != errno.ENOENT:
+                raise
+        return None
+
+    @property
+    def names(self):
+        """
+        The names of the members, last file first.
+
+        :rtype: list of str
+        """
+        return [member["name"] for member in self.members]
+
+    @property
+    def keyframes(self):
+        """
+        The names of the members, other than the last file, that are stored
+        self-contained.
+
+        :rtype: set of str
+        """
+        return {member["name"] for member in self.members[1:] if member["keyframe"]}
+
+    def get(self, name):
+        """
+        Return the entry for the named member.
+
+        :param name: The name of the member.
+        :type name: str
+        :rtype: dict
+        :raises KeyError: if ``name`` is not a member.
+        """
+        for member in self.members:
+            if member["name"] == name:
+                return member
+        raise KeyError(name)
+
+    def update(self, name, path, keyframe, digest=None):
+        """
+        Add or replace the entry for the named member.
+
+        :param name: The name of the member.
+        :type name: str
+        :param path: The absolute path to the encoded member. This need not be
+                     the location of the member within the chain.
+        :type path: str
+        :param keyframe: ``True`` if the member is stored self-contained.
+        :type keyframe: bool
+        :param digest: (Optional) The digest of the decoded member. If omitted,
+                       any digest already recorded for the member is kept.
+        :type digest: str | None
+        """
+        entry = {"name": name, "size": os.path.getsize(path), "codec": Codec.for_file(path).name,
+                 "keyframe": keyframe, "digest": digest}
+        for index, member in enumerate(self.members):
+            if member["name"] == name:
+                if digest is None:
+                    entry["digest"] = member.get("digest")
+                self.members[index] = entry
+                return
+            if member["name"] < name:
+                self.members.insert(index, entry)
+                return
+        self.members.append(entry)
+
+    def remove(self, names):
+        """
+        Remove the entries for the named members.
+
+        :param names: The names of the members.
+        :type names: set of str
+        """
+        self.members = [member for member in self.members if member["name"] not in names]
+
+    def save(self):
+        """
+        Write the manifest atomically, or remove it if there are no members.
+        """
+        if not self.members:
+            try:
+                os.unlink(self.path)
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+            return
+
+        staged = DeltaFileSystemStorage._stage(self.path)
+        with io.open(staged, "wb") as stream:
+            json.dump({"members": self.members}, stream)
+        os.rename(staged, self.path)
 
 
 class Lock(object):
@@ -275,26 +947,372 @@ class Lock(object):
             do_protected_action()
 
     The lock is released automatically when the block is left.
+
+    A lock may be shared, in which case any number of shared holders may hold
+    it at once while an exclusive holder excludes all others::
+
+        with Lock("/path/to/file", shared=True):
+            do_read_only_action()
+
+    Shared locks require ``flock`` support. Where it is unavailable, every lock
+    is exclusive.
     """
 
-    def __init__(self, path, **kwargs):
+    def __init__(self, path, shared=False, **kwargs):
+        """
+        :param path: The path to the resource being locked. The lock file
+                     shares its root.
+        :type path: str
+        :param shared: ``True`` if the lock may be held by other shared holders
+                       simultaneously.
+        :type shared: bool
+        :param kwargs: Additional arguments for ``locket.lock_file``, used
+                       where ``flock`` is unavailable.
+        """
         base = os.path.splitext(path)[0]
         self._path = ".".join((base, "lock"))
-        self._lock = lock_file(self._path, **kwargs)
+        self._shared = shared
+        self._descriptor = None
+        self._lock = lock_file(self._path, **kwargs) if fcntl is None else None
 
     def __enter__(self):
-        self._lock.acquire()
+        if self._lock is not None:
+            self._lock.acquire()
+            return self
+
+        operation = fcntl.LOCK_SH if self._shared else fcntl.LOCK_EX
+        while self._descriptor is None:
+            descriptor = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(descriptor, operation)
+                # An exclusive holder removes the lock file before releasing
+                # it, so the lock is only valid if the file is still in place.
+                if os.fstat(descriptor).st_ino == os.stat(self._path).st_ino:
+                    self._descriptor = descriptor
+            except EnvironmentError as error:
+                if error.errno != errno.ENOENT:
+                    os.close(descriptor)
+                    raise
+            if self._descriptor is None:
+                os.close(descriptor)
         return self
 
     # noinspection PyUnusedLocal
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._lock.release()
-        try:
+        if self._lock is not None:
+            self._lock.release()
+            try:
+                os.remove(self._path)
+            except OSError as err:
+                # Ignore deletion failure on Windows
+                if err.errno not in (errno.EACCES, errno.ENOENT):
+                    raise
+            return
+
+        # Only an exclusive holder can be sure that no other process holds
+        # the lock, so shared holders leave the lock file in place.
+        if not self._shared:
             os.remove(self._path)
-        except OSError as err:
-            # Ignore deletion failure on Windows
-            if err.errno not in (errno.EACCES, errno.ENOENT):
+        descriptor, self._descriptor = self._descriptor, None
+        fcntl.flock(descriptor, fcntl.LOCK_UN)
+        os.close(descriptor)
+
+
+class RevisionCache(object):
+    """
+    A size-bounded, on-disk cache of decoded files.
+
+    Entries are evicted in least-recently used order whenever the combined
+    size of the cache would exceed its capacity. As the cache is held on disk,
+    it is shared by every process using the same location.
+
+    The order and sizes of the entries are tracked in memory. The index is
+    built from the modification times of the files in the cache when it is
+    first needed, and then maintained as entries are used, added and removed,
+    so entries added later by other processes are only counted once they are
+    used.
+
+    A cache with zero capacity is disabled: nothing is stored and every lookup
+    misses without being counted.
+    """
+
+    def __init__(self, location, capacity):
+        """
+        :param location: The absolute path to the directory holding the cache.
+        :type location: str
+        :param capacity: The maximum combined size, in bytes, of the entries.
+        :type capacity: int
+        """
+        self.location = location
+        self.capacity = capacity
+        self.hits = 0
+        """The number of lookups that found an entry."""
+        self.misses = 0
+        """The number of lookups that did not find an entry."""
+        self._entries = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """
+        Return the cached file with the given name, if any.
+
+        :param name: The name of the file.
+        :type name: str | unicode
+        :return: The open file, or ``None`` if it is not cached.
+        :rtype: file | None
+        """
+        if not self.capacity:
+            return None
+
+        entry = self._get_entry(name)
+        try:
+            cached = io.open(entry, "rb")
+        except IOError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            self.misses += 1
+            # The entry may have been evicted by another process.
+            self._forget(entry)
+            return None
+
+        self.hits += 1
+        try:
+            os.utime(entry, None)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+        self._touch(entry, os.fstat(cached.fileno()).st_size)
+        return cached
+
+    def put(self, name, path):
+        """
+        Move the file at ``path`` into the cache and return it reopened.
+
+        Less recently used entries are evicted to make room for the new entry.
+        If the file is larger than the capacity of the cache, it is left in
+        place.
+
+        The entry only appears once it is complete, so a concurrent reader
+        never sees a partial file.
+
+        :param name: The name under which the file is cached.
+        :type name: str | unicode
+        :param path: The absolute path to the file to cache.
+        :type path: str
+        :return: The open, cached file, or ``None`` if it was not cached.
+        :rtype: file | None
+        """
+        size = os.path.getsize(path)
+        if not self.capacity or size > self.capacity:
+            return None
+
+        entry = self._get_entry(name)
+        directory = os.path.dirname(entry)
+        try:
+            os.makedirs(directory)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
                 raise
+        try:
+            os.rename(path, entry)
+        except OSError as error:
+            if error.errno != errno.EXDEV:
+                raise
+            # The file is on another file system, so it is copied beside the
+            # entry and then renamed onto it.
+            staged = NamedTemporaryFile(dir=directory, prefix=".", suffix=os.path.basename(entry), delete=False)
+            try:
+                with staged, io.open(path, "rb") as source:
+                    shutil.copyfileobj(source, staged)
+                os.rename(staged.name, entry)
+            except:
+                os.unlink(staged.name)
+                raise
+            os.unlink(path)
+        os.utime(entry, None)
+        cached = io.open(entry, "rb")
+        self._touch(entry, size)
+        self._evict()
+        return cached
+
+    def invalidate(self, name):
+        """
+        Remove the entry with the given name, if any.
+
+        :param name: The name of the file.
+        :type name: str | unicode
+        """
+        entry = self._get_entry(name)
+        try:
+            os.unlink(entry)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+        self._forget(entry)
+
+    def _evict(self):
+        with self._lock:
+            while self._size > self.capacity and self._entries:
+                entry, size = self._entries.popitem(last=False)
+                self._size -= size
+                try:
+                    os.unlink(entry)
+                except OSError as error:
+                    if error.errno != errno.ENOENT:
+                        raise
+
+    def _forget(self, entry):
+        with self._lock:
+            self._size -= self._get_entries().pop(entry, 0)
+
+    def _touch(self, entry, size):
+        """Record ``entry`` as the most recently used."""
+        with self._lock:
+            entries = self._get_entries()
+            self._size += size - entries.pop(entry, 0)
+            entries[entry] = size
+
+    def _get_entries(self):
+        """
+        Return the index of entries, from the least to the most recently
+        used, building it if necessary. The caller must hold the lock.
+
+        :rtype: collections.OrderedDict of (str, int)
+        """
+        if self._entries is None:
+            found = []
+            for directory, _, filenames in os.walk(self.location):
+                # Files being staged by other processes are not yet entries.
+                for filename in fnmatch.filter(filenames, "[!.]*"):
+                    entry = os.path.join(directory, filename)
+                    try:
+                        stats = os.stat(entry)
+                    except OSError as error:
+                        if error.errno != errno.ENOENT:
+                            raise
+                    else:
+                        found.append((stats.st_mtime, entry, stats.st_size))
+            self._entries = OrderedDict((entry, size) for _, entry, size in sorted(found))
+            self._size = sum(self._entries.itervalues())
+        return self._entries
+
+    def _get_entry(self, name):
+        return os.path.join(self.location, os.path.normpath(name))
+
+
+class DecodingStream(object):
+    """
+    A read-only stream over the output of a pipeline of decoder processes.
+
+    Each stage decodes one member of a chain, reading its base from a named
+    pipe written by the previous stage. If any stage fails, the remaining
+    stages are terminated and reading the stream raises :py:exc:`IOError`.
+    """
+
+    _POLL_INTERVAL = 0.01
+
+    def __init__(self, codecs, sources):
+        """
+        Start decoding.
+
+        :param codecs: The codecs with which to decode each member of the chain,
+                       starting with a keyframe.
+        :type codecs: list of bdr.utils.deltas.Codec
+        :param sources: The open member files, in the same order. These are
+                        closed once the decoders have started.
+        :type sources: list of file
+        """
+        self._closed = False
+        self._directory = tempfile.mkdtemp()
+        self._processes = []
+        self._failed = False
+        self._monitor = None
+        try:
+            base = None
+            for number, (codec, source) in enumerate(zip(codecs, sources)):
+                destination = None
+                if number < len(sources) - 1:
+                    destination = os.path.join(self._directory, str(number))
+                    os.mkfifo(destination)
+                self._processes.append(codec.spawn_decoder(source, destination, base))
+                base = destination
+        except:
+            self.close()
+            raise
+        finally:
+            for source in sources:
+                source.close()
+
+        self._monitor = threading.Thread(target=self._supervise)
+        self._monitor.daemon = True
+        self._monitor.start()
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def read(self, size=-1):
+        """
+        Read at most ``size`` bytes, returning fewer only at the end of the
+        stream.
+
+        :raises IOError: if decoding failed.
+        """
+        data = self._processes[-1].stdout.read(size)
+        if not data or size < 0:
+            self._monitor.join()
+            if self._failed:
+                raise IOError("Decoding failed.")
+        return data
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._processes:
+            self._processes[-1].stdout.close()
+        self._kill()
+        if self._monitor is not None:
+            self._monitor.join()
+        else:
+            for process in self._processes:
+                process.wait()
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def _supervise(self):
+        # A failed stage can leave its neighbours blocked opening their pipes,
+        # so the stages are polled rather than waited upon in turn and all
+        # are terminated at the first failure. Only this thread reaps the
+        # child processes.
+        running = list(self._processes)
+        while running:
+            for process in running[:]:
+                if process.poll() is not None:
+                    running.remove(process)
+                    if process.returncode and not self._failed:
+                        self._failed = True
+                        self._kill()
+            if running:
+                time.sleep(self._POLL_INTERVAL)
+
+    def _kill(self):
+        for process in self._processes:
+            if process.returncode is None:
+                try:
+                    process.kill()
+                except OSError as error:
+                    if error.errno != errno.ESRCH:
+                        raise
 
 
 class FileDeletionWrapper(object):
@@ -6,29 +6,44 @@ prior to fetching the resource itself.
 
 All exceptions raised by these types inherit from the TransportError class.
 
-Support for the FTP and HTTP protocols are included by default. This can be
-extended to any communications protocol, however, by subclassing Transport and
-adding the fully-qualified class name for the new type to the REMOTE_TRANSPORTS
-settings list.
+Support for the FTP and HTTP protocols, and for files on the local file system,
+is included by default. This can be extended to any communications protocol,
+however, by subclassing Transport and adding the fully-qualified class name for
+the new type to the REMOTE_TRANSPORTS settings list.
+
+Connections can be reused by transports created while a ConnectionPool is
+active.
 """
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from hashlib import sha1 as hash_algorithm
+from multiprocessing.pool import ThreadPool
+import errno
 import ftplib
 import importlib
+import io
+import json
 import os.path
 import re
-import shutil
 import socket
-import tempfile
+import threading
+import urllib
 import urlparse
 
-from django.utils.http import parse_http_date_safe
+from django.utils.http import http_date, parse_http_date_safe
+from django.utils.log import getLogger
 import requests
 
 from .. import app_settings
-from . import utc
+from . import get_spool_dir, to_epoch, utc
+from .archives import Archive, ListingArchive, LocalArchive, MockArchive
+from .storage import Lock
+from .zsync import ControlFile, get_runs, match_blocks
+
+_CHUNK_SIZE = 64 * 1024
+_log = getLogger(__name__)
 
-__all__ = ["Transport", "TransportError"]
+__all__ = ["ConnectionPool", "Transport", "TransportError"]
 __author__ = "Michael Winter (mail@michael-winter.me.uk)"
 __license__ = """
     Biological Dataset Repository: data archival and retrieval.
@@ -77,11 +92,174 @@ class UnrecognisedSchemaError(TransportError):
     """
 
 
+def _get_listing_digest(listing):
+    """
+    Return a digest of the name, size and modification time of each file in
+    a listing.
+
+    :type listing: list of (str, int, object)
+    """
+    digest = hash_algorithm()
+    for name, size, modified_at in listing:
+        digest.update("{0:s}\0{1:d}\0{2!r}\n".format(name, size, modified_at))
+    return digest
+
+
+class ConnectionPool(object):
+    """
+    A set of connections shared by the transports created while it is active.
+
+    HTTP requests to the same host share a session, so that connections are
+    kept alive between requests. FTP control connections are returned to the
+    pool, rather than closed, when a transport is closed, and the features
+    supported by each FTP server are remembered.
+
+    A pool is active for the duration of a ``with`` block and is shared by all
+    threads::
+
+        with ConnectionPool():
+            do_transfers()
+
+    Any connections held by the pool are closed when the block is left.
+    """
+
+    _active = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._features = {}
+        self._sessions = {}
+        self._previous = None
+
+    @classmethod
+    def current(cls):
+        """
+        Return the active pool, if any.
+
+        :rtype: ConnectionPool | None
+        """
+        return cls._active
+
+    def __enter__(self):
+        self._previous, ConnectionPool._active = ConnectionPool._active, self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        ConnectionPool._active = self._previous
+        self.close()
+
+    def get_session(self, url):
+        """
+        Return the session used for requests to the host named in ``url``.
+
+        :param url: The URL of a resource.
+        :type  url: str
+        :rtype: requests.Session
+        """
+        key = urlparse.urlsplit(url)[:2]
+        with self._lock:
+            if key not in self._sessions:
+                self._sessions[key] = requests.Session()
+            return self._sessions[key]
+
+    def acquire(self, key):
+        """
+        Remove and return an idle connection stored under ``key``, if any.
+
+        :param key: The key identifying the server and credentials.
+        :type  key: tuple
+        :return: The connection, or None if there are no idle connections.
+        """
+        with self._lock:
+            idle = self._connections.get(key)
+            return idle.pop() if idle else None
+
+    def release(self, key, connection):
+        """
+        Store an idle connection for reuse under ``key``.
+
+        :param key: The key identifying the server and credentials.
+        :type  key: tuple
+        :param connection: The connection.
+        """
+        with self._lock:
+            self._connections.setdefault(key, []).append(connection)
+
+    def get_features(self, key):
+        """
+        Return the features recorded for the server identified by ``key``.
+
+        :rtype: list of str | None
+        """
+        with self._lock:
+            return self._features.get(key)
+
+    def set_features(self, key, features):
+        """
+        Record the features supported by the server identified by ``key``.
+
+        :type features: list of str
+        """
+        with self._lock:
+            self._features[key] = features
+
+    def close(self):
+        """
+        Close every connection held by this pool.
+        """
+        with self._lock:
+            sessions, self._sessions = self._sessions.values(), {}
+            connections, self._connections = self._connections.values(), {}
+        for session in sessions:
+            session.close()
+        for connection in (connection for idle in connections for connection in idle):
+            try:
+                connection.quit()
+            except ftplib.all_errors + (socket.error,):
+                connection.close()
+
+
 class Transport(object):
     """
     An abstraction for retrieving resources, and their metadata, from remote
     sources.
+
+    Resources are downloaded into a spool file within the directory named by
+    the SPOOL_DIR setting. If a download fails, the partial file is kept along
+    with the size, modification date and entity tag of the resource. A later
+    download by a resumable transport continues from the end of the partial
+    file, provided that the resource is unchanged.
+
+    The digest and size of the resource are computed as it is written, so
+    that the content need not be read again to identify it.
     """
+
+    resumable = False
+    """
+    True if this transport continues a download from the current position of
+    the content file; otherwise, the content file is always empty when the
+    download starts.
+    """
+    segments = 1
+    """
+    The maximum number of parts into which a download may be split. Each part
+    is retrieved concurrently, if the transport supports it.
+    """
+    min_segment_size = 16 * 1024 * 1024
+    """The minimum size, in bytes, of each part of a segmented download."""
+    zsync_url = None
+    """
+    The URL of a zsync control file that describes the resource, if one is
+    published. Transports that support it download only the blocks of the
+    resource that are not found in :py:attr:`seed`.
+    """
+    seed = None
+    """
+    A callable that returns an open file containing a previous version of the
+    resource, or None if there is no such version.
+    """
+
     @classmethod
     def instance(cls, url, user='', password=''):
         """
@@ -123,6 +301,8 @@ class Transport(object):
         :type  password: str
         """
         self._content = None
+        self._digest = hash_algorithm()
+        self._length = 0
         self._password = password
         self._url = url
         self._user = user
@@ -136,11 +316,84 @@ class Transport(object):
         :rtype:  file
         """
         if self._content is None:
-            self._content = tempfile.TemporaryFile()
-            self._do_get_content()
+            path = self._get_spool_path()
+            with Lock(path):
+                content = io.open(path, "a+b")
+                try:
+                    self._content = content
+                    if self.resumable and self._can_resume(path):
+                        self._rehash()
+                    else:
+                        self._restart()
+                    self._set_spool_metadata(path)
+                    self._do_get_content()
+                except:
+                    self._content = None
+                    content.close()
+                    raise
+                # The content remains readable until it is closed.
+                for spooled in (path, path + ".json"):
+                    os.unlink(spooled)
+            size = self.get_size()
+            if size >= 0 and size != self._length:
+                _log.warning("%s: %d bytes were retrieved, but %d were reported", self._url, self._length, size)
             self._content.seek(0)
         return self._content
 
+    def get_digest(self):
+        """
+        Return the SHA-1 digest of the resource, retrieving it if necessary.
+
+        The digest is computed as the resource is downloaded, so it identifies
+        the content actually received regardless of the size and modification
+        date reported by the remote source.
+
+        :return: The hexadecimal digest.
+        :rtype:  str
+        :raises TransportError: If an error occurs while communicating with the
+                                server.
+        """
+        self.get_content()
+        return self._digest.hexdigest()
+
+    def get_archive(self):
+        """
+        Return an archive of this resource, if it is not read from the content
+        returned by :py:meth:`get_content`.
+
+        Most transports return None, in which case the archive is read from the
+        content instead.
+
+        :return: The archive, or None.
+        :rtype:  Archive | None
+        :raises TransportError: If an error occurs while communicating with the
+                                server.
+        """
+        return None
+
+    def close(self):
+        """
+        Release any connection held by this transport and discard the
+        retrieved resource, if any.
+        """
+        if self._content is not None:
+            self._content.close()
+            self._content = None
+
+    def get_etag(self):
+        """
+        Return the entity tag that identifies the current version of this
+        resource, as reported by the remote source.
+
+        Transports that do not support entity tags return None.
+
+        :return: The entity tag, or None if unknown.
+        :rtype:  str | None
+        :raises TransportError: If an error occurs while communicating with the
+                                server.
+        """
+        return None
+
     def get_modification_date(self):
         """
         Return the date and time of the last modification to this resource as
@@ -164,22 +417,252 @@ class Transport(object):
         """
         raise NotImplementedError
 
+    def is_modified(self, etag=None, modified_at=None):
+        """
+        Ask the remote source whether this resource has changed since the
+        version identified by the given validators was retrieved.
+
+        Transports that cannot make such a request return None, in which case
+        the caller should compare the size and modification date instead.
+
+        :param etag: (Optional) The entity tag of the retrieved version.
+        :type  etag: str | None
+        :param modified_at: (Optional) The modification date of the retrieved
+                            version.
+        :type  modified_at: datetime | None
+        :return: True if the resource has changed, False if it is unchanged, or
+                 None if this cannot be determined.
+        :rtype:  bool | None
+        :raises TransportError: If an error occurs while communicating with the
+                                server.
+        """
+        return None
+
+    def _can_resume(self, path):
+        """
+        Return True if the partial download held at ``path`` is of the
+        current version of this resource.
+
+        The size and modification date of the resource must be known.
+        """
+        try:
+            with io.open(path + ".json", "rb") as stream:
+                metadata = json.load(stream)
+        except (IOError, ValueError):
+            return False
+        size = self.get_size()
+        return (0 < os.path.getsize(path) < size and self.get_modification_date() is not None and
+                metadata == self._get_spool_metadata())
+
+    def _get_spool_metadata(self):
+        modification_date = self.get_modification_date()
+        return {"size": self.get_size(), "etag": self.get_etag(),
+                "modified_at": to_epoch(modification_date) if modification_date is not None else None}
+
+    def _get_spool_path(self):
+        return os.path.join(get_spool_dir(), hash_algorithm("\0".join((self._url, self._user))).hexdigest())
+
+    def _set_spool_metadata(self, path):
+        with io.open(path + ".json", "wb") as stream:
+            json.dump(self._get_spool_metadata(), stream)
+
+    def _rehash(self):
+        """
+        Compute the digest and size of the content written to `_content` so
+        far, leaving it positioned at its end.
+        """
+        self._digest, self._length = hash_algorithm(), 0
+        self._content.seek(0)
+        for chunk in iter(lambda: self._content.read(_CHUNK_SIZE), b""):
+            self._digest.update(chunk)
+            self._length += len(chunk)
+
+    def _restart(self):
+        """
+        Discard any content written to `_content`, so that the resource is
+        retrieved from its start.
+        """
+        self._content.seek(0)
+        self._content.truncate()
+        self._digest, self._length = hash_algorithm(), 0
+
+    def _write(self, data):
+        """
+        Append data to `_content`, updating its digest and size.
+
+        :param data: The next part of the resource.
+        :type  data: bytes
+        """
+        self._content.write(data)
+        self._digest.update(data)
+        self._length += len(data)
+
     def _do_get_content(self):
         """
-        Retrieve the resource, writing it to `_content`. Subclasses must
-        override this method.
+        Retrieve the resource, writing it to `_content` with
+        :py:meth:`_write`. Subclasses must override this method.
+
+        Resumable transports retrieve the resource from the current position
+        of `_content`, or call :py:meth:`_restart` if this is not possible.
         """
         raise NotImplementedError
 
 
+class LocalTransport(Transport):
+    """
+    An abstraction for reading resources, such as mirrors maintained by rsync,
+    in place from the local file system.
+
+    Only paths within the directories given by the LOCAL_ROOTS setting can be
+    read. A URL naming a directory is read as an archive of the files beneath
+    it: its size is the total size of those files, its modification date that
+    of the most recently modified file, and its digest is computed from the
+    name, size and modification time of each file rather than its content.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Create an instance of the local transport mechanism.
+
+        :param url: The URL of the resource to be obtained.
+        :type  url: str
+        :param user: Ignored.
+        :type  user: str
+        :param password: Ignored.
+        :type  password: str
+        """
+        super(LocalTransport, self).__init__(*args, **kwargs)
+        self._path = os.path.realpath(urllib.url2pathname(urlparse.urlsplit(self._url).path))
+        self._hashed = False
+        self._listing = None
+
+    def get_archive(self):
+        """
+        Return an archive of the files at this location.
+
+        A directory, or a file that is not itself an archive, is read directly
+        so that its members can be ingested without copying.
+
+        :rtype: Archive
+        """
+        path = self._get_path()
+        if os.path.isdir(path):
+            return LocalArchive(path)
+        archive = Archive.instance(self.get_content(), path)
+        return LocalArchive(path) if isinstance(archive, MockArchive) else archive
+
+    def get_content(self):
+        """
+        Return the file at this location, opened for reading in place.
+
+        :rtype: file
+        :raises TransportError: If the location is a directory or cannot be
+                                read.
+        """
+        if self._content is None:
+            path = self._get_path()
+            if os.path.isdir(path):
+                raise TransportError("{0:s} is a directory.".format(path))
+            try:
+                self._content = io.open(path, "rb")
+            except IOError as error:
+                raise NotFoundError(error) if error.errno == errno.ENOENT else TransportError(error)
+        self._content.seek(0)
+        return self._content
+
+    def get_digest(self):
+        """
+        Return the SHA-1 digest of the file at this location, or of the listing
+        of a directory.
+
+        :rtype: str
+        """
+        if not self._hashed:
+            if os.path.isdir(self._get_path()):
+                self._digest = _get_listing_digest(self._get_listing())
+            else:
+                content = self.get_content()
+                for chunk in iter(lambda: content.read(_CHUNK_SIZE), b""):
+                    self._digest.update(chunk)
+            self._hashed = True
+        return self._digest.hexdigest()
+
+    def get_modification_date(self):
+        """
+        Return the modification date of the file at this location, or of the
+        most recently modified file within a directory.
+
+        :return: The modification date and time, or None if a directory is
+                 empty.
+        :rtype:  datetime | None
+        """
+        listing = self._get_listing()
+        if not listing:
+            return None
+        return datetime.fromtimestamp(max(modified_at for _, _, modified_at in listing), utc)
+
+    def get_size(self):
+        """
+        Return the size of the file at this location, or the total size of the
+        files within a directory.
+
+        :rtype: int
+        """
+        return sum(size for _, size, _ in self._get_listing())
+
+    def _get_listing(self):
+        """
+        Return the name, size and modification time of each file at this
+        location.
+
+        :rtype: list of (str, int, float)
+        :raises TransportError: If the location cannot be read.
+        """
+        if self._listing is None:
+            path = self._get_path()
+            try:
+                if os.path.isdir(path):
+                    archive = LocalArchive(path)
+                    stats = [(name, os.stat(archive.get_path(name))) for name in archive.keys()]
+                else:
+                    stats = [(os.path.basename(path), os.stat(path))]
+            except OSError as error:
+                raise NotFoundError(error) if error.errno == errno.ENOENT else TransportError(error)
+            self._listing = [(name, stat.st_size, stat.st_mtime) for name, stat in stats]
+        return self._listing
+
+    def _get_path(self):
+        """
+        Return the path named by the URL of this resource.
+
+        :raises AuthenticationError: If the path is not within one of the
+                                     LOCAL_ROOTS.
+        """
+        for root in app_settings.LOCAL_ROOTS:
+            root = os.path.join(os.path.realpath(root), "")
+            if os.path.join(self._path, "").startswith(root):
+                return self._path
+        raise AuthenticationError("{0:s} is not within a permitted local root.".format(self._path))
+
+
 class FtpTransport(Transport):
     """
     An abstraction for retrieving resources, and their metadata, from FTP
     servers.
+
+    Downloads are resumed if the server supports the REST command.
+
+    A URL ending with a slash names a directory. The names, sizes and
+    modification dates of the files it contains are obtained with a single
+    MLSD command or, where that is unsupported, a LIST command. The directory
+    is read as an archive of those files, each of which is downloaded only
+    when read, and its size, modification date and digest are derived from
+    the listing.
     """
-    _DEFAULT_TIMEOUT = 30
+    resumable = True
     _date_reply = None
     _feat_reply = None
+    _list_reply = re.compile(r'^-\S{9}\S*\s+\d+\s+\S+\s+\S+\s+(\d+)\s+(\w{3}\s+\d{1,2})\s+(\d{4}|\d{1,2}:\d{2})\s(.+)$')
     _size_reply = None
 
     def __init__(self, *args, **kwargs):
@@ -200,6 +683,7 @@ class FtpTransport(Transport):
         self._host, self._port = components.hostname, components.port or ftplib.FTP_PORT
         self._path, self._name = os.path.dirname(components.path), os.path.basename(components.path)
         self._features = None
+        self._listing = None
         self._modification_date = None
         self._size = -1
         self.__connection = None
@@ -218,6 +702,10 @@ class FtpTransport(Transport):
         :raises TransportError: If an error occurs while communicating with the
                                 server.
         """
+        if self._features is None:
+            pool = ConnectionPool.current()
+            if pool is not None:
+                self._features = pool.get_features((self._host, self._port))
         if self._features is None:
             if self._feat_reply is None:
                 self._feat_reply = re.compile(r'^211([ -])[ \t\x21-\x7e]*'
@@ -232,6 +720,8 @@ class FtpTransport(Transport):
                 match = self._feat_reply.match(reply)
                 self._features = (re.split(r'[\n\r]+ ', match.group(2).lstrip().lower())
                                   if match and match.group(1) == '-' else [])
+            if pool is not None:
+                pool.set_features((self._host, self._port), self._features)
         return self._features
 
     def get_modification_date(self):
@@ -244,6 +734,9 @@ class FtpTransport(Transport):
         :raises TransportError: If an error occurs while communicating with the
                                 server.
         """
+        if not self._name:
+            dates = [modified_at for _, _, modified_at in self._get_listing() if modified_at is not None]
+            return max(dates) if dates else None
         if self._modification_date is None and 'mdtm' in self.features:
             if self._date_reply is None:
                 self._date_reply = re.compile(r'^213 (\d{14})(?:\.\d+)?[\n\r]*')
@@ -266,6 +759,8 @@ class FtpTransport(Transport):
         :raises TransportError: If an error occurs while communicating with the
                                 server.
         """
+        if not self._name:
+            return sum(size for _, size, _ in self._get_listing() if size != -1)
         if self._size == -1 and 'size' in self.features:
             if self._size_reply is None:
                 self._size_reply = re.compile(r'^213 (\d+)[\n\r]*')
@@ -279,38 +774,215 @@ class FtpTransport(Transport):
             self._size = int(match.group(1)) if match else -1
         return self._size
 
+    def close(self):
+        """
+        Release the control connection held by this transport, returning it
+        to the active connection pool if there is one, and discard the
+        retrieved resource, if any.
+        """
+        connection, self.__connection = self.__connection, None
+        if connection is not None:
+            pool = ConnectionPool.current()
+            if pool is not None:
+                pool.release(self._get_pool_key(), connection)
+            else:
+                try:
+                    connection.quit()
+                except ftplib.all_errors + (socket.error,):
+                    connection.close()
+        super(FtpTransport, self).close()
+
     @property
     def _connection(self):
         if self.__connection is None:
-            self.__connection = ftplib.FTP(timeout=self._DEFAULT_TIMEOUT)
-            try:
-                self.__connection.connect(self._host, self._port)
-                self.__connection.login(self._user, self._password)
-            except socket.gaierror as error:
-                raise ConnectionError(error)
-            except ftplib.error_reply as error:
-                raise AuthenticationError(error)
-            except ftplib.all_errors + (socket.error,) as error:
-                raise TransportError(error)
+            pool = ConnectionPool.current()
+            connection = pool.acquire(self._get_pool_key()) if pool is not None else None
+            if connection is not None:
+                # Idle connections may have been closed by the server.
+                try:
+                    connection.voidcmd('NOOP')
+                except ftplib.all_errors + (socket.error,):
+                    connection.close()
+                    connection = None
+            if connection is None:
+                connection = ftplib.FTP(timeout=app_settings.TRANSPORT_TIMEOUT)
+                try:
+                    connection.connect(self._host, self._port)
+                    connection.login(self._user, self._password)
+                except socket.gaierror as error:
+                    raise ConnectionError(error)
+                except ftplib.error_reply as error:
+                    raise AuthenticationError(error)
+                except ftplib.all_errors + (socket.error,) as error:
+                    raise TransportError(error)
 
+            self.__connection = connection
             try:
                 self.__connection.cwd(self._path)
             except ftplib.error_reply as error:
                 raise NotFoundError(error)
         return self.__connection
 
+    def get_archive(self):
+        """
+        Return an archive of the files in this directory, or None if this
+        resource is a single file.
+
+        :rtype: Archive | None
+        :raises TransportError: If an error occurs while communicating with the
+                                server.
+        """
+        if self._name:
+            return None
+        return ListingArchive(self._get_listing(), self._retrieve, self._path)
+
+    def get_content(self):
+        """
+        Return a temporary file containing the requested resource.
+
+        :rtype: file
+        :raises TransportError: If this resource is a directory, or an error
+                                occurs while communicating with the server.
+        """
+        if not self._name:
+            raise TransportError("{0:s} is a directory.".format(self._url))
+        return super(FtpTransport, self).get_content()
+
+    def get_digest(self):
+        """
+        Return the SHA-1 digest of the resource, retrieving it if necessary.
+
+        The digest of a directory is computed from its listing.
+
+        :rtype: str
+        """
+        if not self._name:
+            return _get_listing_digest(self._get_listing()).hexdigest()
+        return super(FtpTransport, self).get_digest()
+
+    def _get_listing(self):
+        """
+        Return the name, size and modification date of each file in this
+        directory. Unknown sizes are given as -1.
+
+        :rtype: list of (str, int, datetime | None)
+        :raises TransportError: If an error occurs while communicating with the
+                                server.
+        """
+        if self._listing is None:
+            lines = []
+            try:
+                # Support for MLSD is advertised by the MLST feature.
+                if any(feature.startswith('mlst') for feature in self.features):
+                    self._connection.retrlines('MLSD', lines.append)
+                    listing = [self._parse_fact_line(line) for line in lines]
+                else:
+                    self._connection.retrlines('LIST', lines.append)
+                    listing = [self._parse_list_line(line) for line in lines]
+            except ftplib.error_perm as error:
+                raise NotFoundError(error)
+            except (ftplib.Error, socket.error) as error:
+                raise TransportError(error)
+            self._listing = sorted(entry for entry in listing if entry is not None)
+        return self._listing
+
+    @staticmethod
+    def _parse_fact_line(line):
+        """
+        Parse a line of an MLSD reply (RFC 3659), returning the name, size and
+        modification date of a file, or None for other entries.
+        """
+        facts, _, name = line.partition(' ')
+        facts = dict(fact.partition('=')[::2] for fact in facts.lower().split(';') if fact)
+        if facts.get('type') != 'file':
+            return None
+        size = int(facts['size']) if facts.get('size', '').isdigit() else -1
+        modify = facts.get('modify', '')[:14]
+        try:
+            modified_at = datetime.strptime(modify, '%Y%m%d%H%M%S').replace(tzinfo=utc)
+        except ValueError:
+            modified_at = None
+        return name, size, modified_at
+
+    @classmethod
+    def _parse_list_line(cls, line):
+        """
+        Parse a line of a LIST reply in the format of ``ls -l``, returning the
+        name, size and modification date of a regular file, or None for other
+        entries.
+
+        Recent dates are listed without a year, and to the minute; the most
+        recent year that does not place the date in the future is assumed.
+        """
+        match = cls._list_reply.match(line)
+        if match is None:
+            return None
+        size, day, time_or_year, name = match.groups()
+        try:
+            if ':' in time_or_year:
+                now = datetime.now(utc)
+                modified_at = datetime.strptime("{0:d} {1:s} {2:s}".format(now.year, day, time_or_year),
+                                                '%Y %b %d %H:%M').replace(tzinfo=utc)
+                if modified_at > now + timedelta(days=1):
+                    modified_at = modified_at.replace(year=now.year - 1)
+            else:
+                modified_at = datetime.strptime("{0:s} {1:s}".format(time_or_year, day),
+                                                '%Y %b %d').replace(tzinfo=utc)
+        except ValueError:
+            modified_at = None
+        return name, int(size), modified_at
+
+    def _retrieve(self, name):
+        """
+        Download the named file in this directory.
+
+        :param name: The name of the file.
+        :type name: str
+        :return: A temporary file containing the file.
+        :rtype: file
+        """
+        transport = FtpTransport(urlparse.urljoin(self._url, urllib.quote(name)), self._user, self._password)
+        try:
+            content, transport._content = transport.get_content(), None
+        finally:
+            transport.close()
+        return content
+
+    def _get_pool_key(self):
+        return self._host, self._port, self._user, self._password
+
     def _do_get_content(self):
         try:
-            self._connection.retrbinary('RETR ' + self._name, self._content.write)
+            offset = self._content.tell()
+            if offset and 'rest stream' not in self.features:
+                self._restart()
+                offset = 0
+            self._connection.retrbinary('RETR ' + self._name, self._write, rest=offset or None)
         except (ftplib.Error, socket.error) as error:
-            raise TransportError(error.message)
+            raise TransportError(error)
 
 
 class HttpTransport(Transport):
     """
     An abstraction for retrieving resources, and their metadata, from HTTP
     servers.
+
+    Metadata is obtained from the headers of a GET request, the body of which
+    is only read if the content is required. Checking for and retrieving a
+    modified resource therefore requires a single request.
+
+    Downloads are resumed using range requests, provided the server supports
+    them. Large resources may also be downloaded in several segments at once:
+    see :py:attr:`~Transport.segments`.
+
+    If a zsync control file is published for the resource, and a previous
+    version is available, the resource is instead rebuilt from the blocks of
+    that version that are unchanged and only the remaining blocks are
+    requested. The rebuilt resource is verified against the digest given by
+    the control file, and the whole resource is downloaded if it differs.
     """
+    resumable = True
+
     def __init__(self, *args, **kwargs):
         """
         Create an instance of the HTTP transport mechanism.
@@ -327,8 +999,36 @@ class HttpTransport(Transport):
         super(HttpTransport, self).__init__(*args, **kwargs)
         self._metadata = None
         self._modification_date = None
+        self._response = None
         self._size = -1
 
+    def close(self):
+        """
+        Release the connection held by this transport and discard the
+        retrieved resource, if any.
+        """
+        self._close_response()
+        super(HttpTransport, self).close()
+
+    def _close_response(self):
+        """
+        Release the connection used to obtain metadata, if any, without
+        reading the content.
+        """
+        response, self._response = self._response, None
+        if response is not None:
+            response.close()
+
+    def get_etag(self):
+        """
+        Return the entity tag that identifies the current version of this
+        resource, as reported by the remote source.
+
+        :return: The entity tag, or None if unknown.
+        :rtype:  str | None
+        """
+        return self._get_metadata().get("etag")
+
     def get_modification_date(self):
         """
         Return the date and time of the last modification to this resource as
@@ -356,29 +1056,230 @@ class HttpTransport(Transport):
             self._size = int(metadata.get("content-length", -1))
         return self._size
 
+    def is_modified(self, etag=None, modified_at=None):
+        """
+        Ask the remote source whether this resource has changed since the
+        version identified by the given validators was retrieved.
+
+        A conditional GET request is made. If the server responds that the
+        resource is unchanged, no content is transferred; otherwise, the
+        response is retained so that the content can be read without another
+        request.
+
+        :param etag: (Optional) The entity tag of the retrieved version.
+        :type  etag: str | None
+        :param modified_at: (Optional) The modification date of the retrieved
+                            version.
+        :type  modified_at: datetime | None
+        :return: True if the resource has changed, False if it is unchanged, or
+                 None if this cannot be determined.
+        :rtype:  bool | None
+        """
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if modified_at is not None:
+            headers["If-Modified-Since"] = http_date(to_epoch(modified_at))
+        if not headers:
+            return None
+
+        if self._metadata is None:
+            response = self._do_request(headers=headers)
+            if response.status_code == 304:
+                response.close()
+                return False
+            self._response, self._metadata = response, response.headers
+
+        # Servers that ignore conditional requests may still report an entity
+        # tag that can be compared.
+        current = self._metadata.get("etag")
+        if etag and current:
+            return current != etag
+        return None
+
     def _get_metadata(self):
         if self._metadata is None:
-            response = self._do_request("HEAD")
-            self._metadata = response.headers
+            self._response = self._do_request()
+            self._metadata = self._response.headers
         return self._metadata
 
-    def _do_request(self, method="GET"):
+    def _do_request(self, method="GET", headers=None, url=None):
+        url = url or self._url
+        pool = ConnectionPool.current()
+        requester = pool.get_session(url) if pool is not None else requests
         try:
-            response = requests.request(method, self._url, auth=(self._user, self._password), stream=True)
+            response = requester.request(method, url, auth=(self._user, self._password), headers=headers,
+                                         stream=True, timeout=app_settings.TRANSPORT_TIMEOUT)
         except requests.RequestException as error:
             raise ConnectionError(error)
 
-        if response == 401:
-            raise AuthenticationError()
-        elif 400 >= response < 500:
-            raise NotFoundError()
-        elif 500 >= response:
-            raise ConnectionError()
+        if response.status_code == 401:
+            raise AuthenticationError(response.reason)
+        elif 400 <= response.status_code < 500:
+            raise NotFoundError(response.reason)
+        elif response.status_code >= 500:
+            raise ConnectionError(response.reason)
 
         return response
 
     def _do_get_content(self):
-        response = self._do_request()
-        if response.status_code != 200:
-            raise TransportError(response.reason)
-        shutil.copyfileobj(response.raw, self._content)
+        offset = self._content.tell()
+        if not offset and self.zsync_url and self.seed is not None:
+            if self._get_changed_blocks():
+                return
+            self._restart()
+        segments = self._get_segments() if not offset else []
+        if len(segments) > 1:
+            self._close_response()
+            self._content.truncate(self.get_size())
+            pool = ThreadPool(len(segments))
+            try:
+                pool.map(self._get_segment, segments)
+            finally:
+                pool.close()
+                pool.join()
+            # Segments arrive out of order, so they are hashed once complete.
+            self._rehash()
+            return
+
+        if offset:
+            # The range is only returned if the resource still matches the
+            # validator; otherwise, the entire resource is returned.
+            validator = self._get_metadata().get("etag") or self._get_metadata().get("last-modified")
+            self._close_response()
+            response = self._do_request(headers={"Range": "bytes={0:d}-".format(offset), "If-Range": validator})
+        else:
+            response, self._response = self._response or self._do_request(), None
+        try:
+            if response.status_code == 200:
+                self._restart()
+            elif response.status_code != 206 or not offset:
+                raise TransportError(response.reason)
+            self._copy_response(response, self._write)
+        finally:
+            response.close()
+
+    def _get_changed_blocks(self):
+        """
+        Rebuild the resource from the unchanged blocks of the version returned
+        by :py:attr:`seed`, downloading the remaining blocks with range
+        requests.
+
+        :return: True if the resource was rebuilt and verified; False if it
+                 must be downloaded in full.
+        :rtype: bool
+        """
+        try:
+            response = self._do_request(url=self.zsync_url)
+            try:
+                control = ControlFile.parse(response.content)
+            finally:
+                response.close()
+        except (TransportError, ValueError, requests.RequestException) as error:
+            _log.warning("%s: the control file could not be read: %s", self.zsync_url, error)
+            return False
+        seed = self.seed()
+        if seed is None:
+            return False
+
+        validator = self._get_metadata().get("etag") or self._get_metadata().get("last-modified")
+        self._close_response()
+        with seed:
+            runs = get_runs(control, match_blocks(control, seed))
+            for first, last, origin in runs:
+                if origin is not None:
+                    seed.seek(origin)
+                    remaining = last - first + 1
+                    while remaining:
+                        chunk = seed.read(min(remaining, _CHUNK_SIZE))
+                        # The final block may extend beyond the previous
+                        # version, which is padded with zeros.
+                        chunk = chunk or b"\0" * min(remaining, _CHUNK_SIZE)
+                        self._write(chunk)
+                        remaining -= len(chunk)
+                    continue
+                headers = {"Range": "bytes={0:d}-{1:d}".format(first, last)}
+                if validator:
+                    headers["If-Range"] = validator
+                try:
+                    response = self._do_request(headers=headers)
+                    try:
+                        if response.status_code != 206:
+                            return False
+                        self._copy_response(response, self._write)
+                    finally:
+                        response.close()
+                except (TransportError, requests.RequestException) as error:
+                    _log.warning("%s: the changed blocks could not be downloaded: %s", self._url, error)
+                    return False
+
+        if self._length != control.length or self._digest.hexdigest() != control.sha1:
+            _log.warning("%s: the rebuilt resource does not match its control file", self._url)
+            return False
+        _log.info("%s: %d of %d bytes were reused", self._url,
+                  sum(last - first + 1 for first, last, origin in runs if origin is not None), control.length)
+        return True
+
+    def _get_segments(self):
+        """
+        Return the byte ranges, as inclusive (first, last) pairs, in which the
+        resource should be downloaded.
+
+        The resource is only split if the server accepts range requests and
+        reports the size of the resource.
+
+        :rtype: list of (int, int)
+        """
+        size = self.get_size()
+        if self.segments < 2 or size <= 0 or self._get_metadata().get("accept-ranges") != "bytes":
+            return []
+        count = min(self.segments, size // max(self.min_segment_size, 1))
+        if count < 2:
+            return []
+        length = -(-size // count)
+        return [(first, min(first + length, size) - 1) for first in xrange(0, size, length)]
+
+    def _get_segment(self, segment):
+        """
+        Download the given range of the resource, writing it at the
+        corresponding position of `_content`.
+
+        :param segment: The first and last bytes of the range.
+        :type  segment: (int, int)
+        """
+        first, last = segment
+        validator = self._get_metadata().get("etag") or self._get_metadata().get("last-modified")
+        headers = {"Range": "bytes={0:d}-{1:d}".format(first, last)}
+        if validator:
+            headers["If-Range"] = validator
+        response = self._do_request(headers=headers)
+        try:
+            if response.status_code != 206:
+                raise TransportError("Range request not satisfied: {0:s}".format(response.reason))
+            # Each segment is written through its own descriptor, as the
+            # content file is opened for appending.
+            with io.open(self._content.name, "r+b") as content:
+                content.seek(first)
+                self._copy_response(response, content.write)
+        finally:
+            response.close()
+
+    @staticmethod
+    def _copy_response(response, write):
+        """
+        Pass the body of ``response`` to ``write`` in chunks.
+
+        :raises TransportError: If the body is incomplete.
+        """
+        received = 0
+        try:
+            for chunk in iter(lambda: response.raw.read(_CHUNK_SIZE), b""):
+                write(chunk)
+                received += len(chunk)
+        except (requests.RequestException, requests.packages.urllib3.exceptions.HTTPError, socket.error) as error:
+            raise TransportError(error)
+        # A connection closed early is not reported as an error, so the length
+        # of the body is checked explicitly.
+        expected = response.headers.get("content-length")
+        if expected is not None and received != int(expected):
+            raise TransportError("Incomplete response: received {0:d} of {1:s} bytes".format(received, expected))
@@ -0,0 +1,268 @@
+"""
+Support for rebuilding a resource from a previous version of it, using the
+block checksums published in a zsync control file.
+
+A control file describes a resource as a sequence of fixed-size blocks, each
+identified by a weak, rolling checksum and a strong (MD4) checksum. Every
+offset of the previous version is compared with these checksums to find the
+blocks that it already contains, so that only the remaining blocks need be
+downloaded.
+
+Only the block checksums are used: the compressed-file extensions of zsync
+(the Z-Map2 and Recompress headers) are not supported.
+"""
+
+from operator import mul
+import hashlib
+import mmap
+import struct
+
+__all__ = ["ControlFile", "get_runs", "match_blocks", "md4", "rsum"]
+__author__ = "Michael Winter (mail@michael-winter.me.uk)"
+__license__ = """
+    Biological Dataset Repository: data archival and retrieval.
+    Copyright (C) 2015  Michael Winter
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+    """
+
+
+class ControlFile(object):
+    """
+    The headers and block checksums of a zsync control file.
+    """
+
+    def __init__(self, block_size, length, sha1, checksums, rsum_bytes, checksum_bytes):
+        """
+        :param block_size: The size, in bytes, of each block.
+        :type block_size: int
+        :param length: The size, in bytes, of the resource.
+        :type length: int
+        :param sha1: The hexadecimal SHA-1 digest of the resource.
+        :type sha1: str
+        :param checksums: The weak and strong checksums of each block.
+        :type checksums: list of (int, bytes)
+        :param rsum_bytes: The number of bytes of each weak checksum.
+        :type rsum_bytes: int
+        :param checksum_bytes: The number of bytes of each strong checksum.
+        :type checksum_bytes: int
+        """
+        self.block_size = block_size
+        self.length = length
+        self.sha1 = sha1.lower()
+        self.checksums = checksums
+        self.rsum_bytes = rsum_bytes
+        self.checksum_bytes = checksum_bytes
+
+    @classmethod
+    def parse(cls, data):
+        """
+        Read a control file.
+
+        :param data: The content of the control file.
+        :type data: bytes
+        :rtype: ControlFile
+        :raises ValueError: if the control file is malformed or uses an
+                            unsupported extension.
+        """
+        header, separator, body = data.partition(b"\n\n")
+        if not separator:
+            raise ValueError("The control file has no block checksums.")
+        headers = {}
+        for line in header.splitlines():
+            key, _, value = line.partition(b":")
+            headers[key.strip().lower()] = value.strip()
+        if b"z-map2" in headers or b"recompress" in headers:
+            raise ValueError("Compressed resources are not supported.")
+
+        try:
+            block_size, length = int(headers[b"blocksize"]), int(headers[b"length"])
+            _, rsum_bytes, checksum_bytes = (int(value) for value in headers[b"hash-lengths"].split(b","))
+            sha1 = headers[b"sha-1"]
+        except (KeyError, ValueError):
+            raise ValueError("The control file headers are malformed.")
+        if block_size <= 0 or not 1 <= rsum_bytes <= 4 or not 1 <= checksum_bytes <= 16:
+            raise ValueError("The control file headers are malformed.")
+
+        count = -(-length // block_size)
+        width = rsum_bytes + checksum_bytes
+        if len(body) < count * width:
+            raise ValueError("The control file is truncated.")
+        checksums = []
+        for offset in xrange(0, count * width, width):
+            weak = struct.unpack(">I", b"\0" * (4 - rsum_bytes) + body[offset:offset + rsum_bytes])[0]
+            checksums.append((weak, body[offset + rsum_bytes:offset + width]))
+        return cls(block_size, length, sha1, checksums, rsum_bytes, checksum_bytes)
+
+
+def rsum(block):
+    """
+    Return the weak checksum of a block, as a 32-bit integer.
+
+    :type block: bytes
+    :rtype: int
+    """
+    data = bytearray(block)
+    a = sum(data) & 0xffff
+    b = sum(map(mul, xrange(len(data), 0, -1), data)) & 0xffff
+    return a << 16 | b
+
+
+def md4(block):
+    """
+    Return the MD4 digest of a block.
+
+    The implementation provided by OpenSSL is used where it is available.
+
+    :type block: bytes
+    :rtype: bytes
+    """
+    try:
+        return hashlib.new("md4", block).digest()
+    except ValueError:
+        return _md4(block)
+
+
+def match_blocks(control, seed):
+    """
+    Find the blocks described by ``control`` that are present in ``seed``.
+
+    A block is found only if both of its checksums match. Short strong
+    checksums may nevertheless match by chance, so a resource rebuilt from the
+    result must be verified against its digest.
+
+    :param control: The control file describing the resource.
+    :type control: ControlFile
+    :param seed: An open file containing a previous version of the resource.
+    :type seed: file
+    :return: The offset in ``seed`` of each block, or None for blocks that
+             are not found.
+    :rtype: list of (int | None)
+    """
+    block_size = control.block_size
+    mask = (1 << 8 * control.rsum_bytes) - 1
+    candidates = {}
+    for index, (weak, _) in enumerate(control.checksums):
+        candidates.setdefault(weak, []).append(index)
+    found = [None] * len(control.checksums)
+
+    with _map(seed) as data:
+        size = len(data)
+
+        def _window(offset):
+            # The final block is padded with zeros.
+            window = data[offset:offset + block_size]
+            return window + b"\0" * (block_size - len(window))
+
+        position = 0
+        weak = rsum(_window(position)) if size else 0
+        while position < size:
+            matched = False
+            indices = candidates.get(weak & mask)
+            if indices:
+                strong = md4(_window(position))[:control.checksum_bytes]
+                for index in indices:
+                    if found[index] is None and control.checksums[index][1] == strong:
+                        found[index] = position
+                        matched = True
+            if matched:
+                # Blocks do not overlap, so the search resumes after the match.
+                position += block_size
+                if position < size:
+                    weak = rsum(_window(position))
+                continue
+            old = ord(data[position])
+            new = ord(data[position + block_size]) if position + block_size < size else 0
+            a = ((weak >> 16) + new - old) & 0xffff
+            b = ((weak & 0xffff) + a - block_size * old) & 0xffff
+            weak = a << 16 | b
+            position += 1
+    return found
+
+
+def get_runs(control, offsets):
+    """
+    Group the blocks of a resource into runs that are either copied from
+    consecutive blocks of the previous version or downloaded together.
+
+    :param control: The control file describing the resource.
+    :type control: ControlFile
+    :param offsets: The offset of each block in the previous version, as
+                    returned by :py:func:`match_blocks`.
+    :type offsets: list of (int | None)
+    :return: The first and last byte of each run, and the offset of the run in
+             the previous version or None if it must be downloaded.
+    :rtype: list of (int, int, int | None)
+    """
+    runs = []
+    block_size = control.block_size
+    for index, origin in enumerate(offsets):
+        first, last = index * block_size, min((index + 1) * block_size, control.length) - 1
+        if runs:
+            start, end, previous = runs[-1]
+            if (origin is None and previous is None or
+                    origin is not None and previous is not None and origin == previous + first - start):
+                runs[-1] = (start, last, previous)
+                continue
+        runs.append((first, last, origin))
+    return runs
+
+
+class _map(object):
+    """
+    A read-only memory map of an open file, which need not be read into
+    memory to be searched. Empty files are represented by an empty string.
+    """
+
+    def __init__(self, file_):
+        self._file = file_
+        self._map = None
+
+    def __enter__(self):
+        self._file.seek(0, 2)
+        if not self._file.tell():
+            return b""
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._map is not None:
+            self._map.close()
+
+
+def _md4(data):
+    """Compute the MD4 digest of ``data`` (RFC 1320)."""
+
+    def _rotate(value, shift):
+        value &= 0xffffffff
+        return (value << shift | value >> 32 - shift) & 0xffffffff
+
+    length = len(data)
+    data = bytes(data) + b"\x80" + b"\0" * ((55 - length) % 64) + struct.pack("<Q", length * 8 & (1 << 64) - 1)
+    state = [0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476]
+    for offset in xrange(0, len(data), 64):
+        x = struct.unpack("<16I", data[offset:offset + 64])
+        a, b, c, d = state
+        for i in xrange(16):
+            k, s = i, (3, 7, 11, 19)[i % 4]
+            a, b, c, d = d, _rotate(a + (b & c | ~b & d) + x[k], s), b, c
+        for i in xrange(16):
+            k, s = i % 4 * 4 + i // 4, (3, 5, 9, 13)[i % 4]
+            a, b, c, d = d, _rotate(a + (b & c | b & d | c & d) + x[k] + 0x5a827999, s), b, c
+        for i in xrange(16):
+            k, s = (0, 8, 4, 12, 2, 10, 6, 14, 1, 9, 5, 13, 3, 11, 7, 15)[i], (3, 9, 11, 15)[i % 4]
+            a, b, c, d = d, _rotate(a + (b ^ c ^ d) + x[k] + 0x6ed9eba1, s), b, c
+        state = [(value + change) & 0xffffffff for value, change in zip(state, (a, b, c, d))]
+    return struct.pack("<4I", *state)
@@ -213,7 +213,7 @@ class FileUploadView(SearchableViewMixin, SessionWizardView):
 
                 member = archive[file_mapping["real_name"]]  # :type: Member
                 data = RemoteFile(member.file, file_mapping["mapped_name"], member.size,
-                                  member.mtime)
+                                  member.mtime, member.digest, member.path)
                 default_format = file_mapping["format"]  # :type: Format
                 self.dataset.add_file(data, update, default_format)
 
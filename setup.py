@@ -16,6 +16,7 @@ setup(
     packages=find_packages(exclude=['repository']),
     include_package_data=True,
     install_requires=['django_bootstrap3', 'django', 'httplib2', 'locket', 'requests'],
+    extras_require={'bsdiff': ['bsdiff4'], 'xz': ['backports.lzma'], 'zstd': ['zstandard']},
     entry_points={'bdr.formats': ['raw    = bdr.formats.raw',
                                   'simple = bdr.formats.simple'],
                   'bdr.views.formats': ['raw = bdr.formats.raw:views',